@@ -9,12 +9,15 @@ from __future__ import print_function
 from builtins import str
 from builtins import range
 from builtins import object
-import time as tm
+
+import time
 
 import numpy as np
 
 import zmq
 
+from pygerm.client import encode_sequence, check_sequence
+
 from pyqtgraph.Qt import QtCore, QtGui
 
 
@@ -33,7 +36,9 @@ class zclient(object):
     TOPIC_DATA = b"data"
     TOPIC_META = b"meta"
 
-    def __init__(self, connect_str):
+    def __init__(self, connect_str, batch=False):
+        # multipart programs need a zmq server that answers them
+        self.batch = batch
         self.__context = zmq.Context()
         self.data_sock = self.__context.socket(zmq.SUB)
         self.ctrl_sock = self.__context.socket(zmq.REQ)
@@ -60,6 +65,20 @@ class zclient(object):
         self.__cntrl_send([0x0, int(addr), 0x0])
         return int(self.__cntrl_recv()[2])
 
+    def execute_sequence(self, program):
+        if not self.batch:
+            # one write per register, delays run here
+            for (addr, val) in program:
+                if addr is None:
+                    time.sleep(val)
+                else:
+                    self.write(addr, val)
+            return
+        # the whole program in one round trip, delays run on the server
+        commands = encode_sequence(program)
+        self.ctrl_sock.send_multipart(list(commands))
+        return check_sequence(commands, self.ctrl_sock.recv())
+
 
 # test subclassing parameters
 # This parameter automatically generates
@@ -407,7 +426,10 @@ p = Parameter.create(name='params', type='group', children=params)
 p2 = Parameter.create(name='params_2', type='group', children=params_2)
 
 ip_addr = "tcp://10.28.0.47"
-zc = zclient(ip_addr)
+# True if the board's zmq server runs register programs, see
+# germ_zserver1.c
+batch = False
+zc = zclient(ip_addr, batch=batch)
 
 
 # If anything changes in the tree, print a message
@@ -575,55 +597,20 @@ def load_MARS():
     save()
 
     print("Load Mars")
-    zc.write(0, 4)
-    zc.write(0, 0)
+    prog = [(0, 4), (0, 0)]
 
-    zc.write(8, mars_msw)
-    zc.write(0, 2)
-    zc.write(0, 0)
-    tm.sleep(0.01)
-
-    zc.write(8, mars_mid13)
-    zc.write(0, 2)
-    zc.write(0, 0)
-    tm.sleep(0.01)
-
-    for i in range(0, 12):
-        zc.write(8, mars_mid[i])
-        zc.write(0, 2)
-        zc.write(0, 0)
-        tm.sleep(0.01)
+    for word in [mars_msw, mars_mid13] + list(mars_mid[:12]):
+        prog += [(8, word), (0, 2), (0, 0), (None, 0.01)]
 
     mars_addr = int(p2.param('Load MARS', 'Load State', 'MARS address').value())
 
-    if (mars_addr == 0):
-        zc.write(0, 0x00010000)
-    elif (mars_addr == 1):
-        zc.write(0, 0x00020000)
-    elif (mars_addr == 2):
-        zc.write(0, 0x00040000)
-    elif (mars_addr == 3):
-        zc.write(0, 0x00080000)
-    elif (mars_addr == 4):
-        zc.write(0, 0x00100000)
-    elif (mars_addr == 5):
-        zc.write(0, 0x00200000)
-    elif (mars_addr == 6):
-        zc.write(0, 0x00400000)
-    elif (mars_addr == 7):
-        zc.write(0, 0x00800000)
-    elif (mars_addr == 8):
-        zc.write(0, 0x01000000)
-    elif (mars_addr == 9):
-        zc.write(0, 0x02000000)
-    elif (mars_addr == 10):
-        zc.write(0, 0x04000000)
-    elif (mars_addr == 11):
-        zc.write(0, 0x08000000)
+    if 0 <= mars_addr < 12:
+        prog.append((0, 0x00010000 << mars_addr))
     else:
-        zc.write(0, 0x0FFF0000)  # configure all
+        prog.append((0, 0x0FFF0000))  # configure all
 
-    zc.write(0, 0)
+    prog.append((0, 0))
+    zc.execute_sequence(prog)
 
 
 def MARS_reset():
@@ -642,11 +629,9 @@ def global_set():
     mars_delays = int(p2.param('Global actons', 'Set actions', 'MARS DAQ delays').value())
     mars_mis = mars1_disable | mars2_disable  | mars3_disable | mars_delays
     print("mars clock %04X" % mars_clock)
-    zc.write(52, mars_clock)
     print("test pulser %X" % test_pulse)
-    zc.write(32, test_pulse)
     print("MARS mis %X" % mars_mis)
-    zc.write(56, mars_mis)
+    zc.execute_sequence([(52, mars_clock), (32, test_pulse), (56, mars_mis)])
 
 
 p2.param('Global actons', 'Set actions').sigActivated.connect(global_set)
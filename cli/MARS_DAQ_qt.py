@@ -4,10 +4,7 @@
 from __future__ import division
 from __future__ import print_function
 import argparse
-from pygerm.zmq import ZClientWriter
-from pygerm import TRIGGER_SETUP_SEQ, START_DAQ, STOP_DAQ
-
-import time as tm
+from pygerm.client.sync_zmq import ZClientWriter
 
 
 import matplotlib
@@ -50,20 +47,10 @@ zmq_ip = args.host
 @QtCore.Slot()
 def on_trig():
     print('triggered')
-    # ip_addr = "tcp://10.0.143.160"
-    ip_addr = f"tcp://{zmq_ip}"
-    zc = ZClientWriter(ip_addr)
-    for (addr, val) in TRIGGER_SETUP_SEQ:
-        if addr is None:
-            tm.sleep(val)
-        else:
-            zc.write(addr, val)
-
-    print("sent DAQ trigger")
-    zc.write(*START_DAQ)
-    totallen, bitrate, pd, td, addr = zc.get_data(0)
-    print("sent DAQ stop")
-    zc.write(*STOP_DAQ)
+    # set up, start, read and stop on the session made at start up
+    totallen, bitrate, pd, td, addr = zc.triggered_frame(
+        0, fname='data_4.bin')
+    print("DAQ stopped")
 
     read_number = zc.read(0x64)
     print("number of data ", read_number)
@@ -106,7 +93,10 @@ btn_trig.clicked.connect(on_trig)
 btn_q.move(10, 10)
 btn_trig.move(150, 10)
 
-# Show window
-w.show()
+# one session for every trigger
+# ip_addr = "tcp://10.0.143.160"
+with ZClientWriter(f"tcp://{zmq_ip}") as zc:
+    # Show window
+    w.show()
 
-a.exec_()
+    a.exec_()
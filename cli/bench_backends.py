@@ -0,0 +1,152 @@
+'''Compare the curio and asyncio clients
+
+The zmq sockets are replaced with in-process fakes so that only the
+event loop (and the client code running on it) is measured.  Reports
+the time to collect a frame less the time the same messages take to
+unpack without a loop, and how late a 1 ms ticker task is woken while
+frames are collected.
+'''
+import argparse
+import contextlib
+import io
+import time
+
+import curio
+import numpy as np
+import zmq
+
+from pygerm.client import event2payload
+from pygerm.client.curio_zmq import ZClientCurio
+from pygerm.client.asyncio_zmq import ZClientAsyncio
+
+
+class FakeRep:
+    # echoes control requests like the zmq server
+    def __init__(self, backend):
+        self.backend = backend
+        self._reply = None
+
+    async def send(self, part):
+        await self.send_multipart([part])
+
+    async def send_multipart(self, parts):
+        self._reply = b''.join(bytes(p) for p in parts)
+
+    async def recv(self):
+        await self.backend.sleep(0)
+        return self._reply
+
+
+class FakeSub:
+    # publishes a frame of `n_messages` once DAQ is started
+    def __init__(self, backend, payload, n_messages):
+        self.backend = backend
+        self.payload = payload
+        self.n_messages = n_messages
+        self.sent = None
+
+    def start(self):
+        self.sent = 0
+
+    async def recv_multipart(self, copy=True):
+        while self.sent is None:
+            await self.backend.sleep(1e-3)
+        # let everything else run between messages, as a socket would
+        await self.backend.sleep(0)
+        if self.sent < self.n_messages:
+            self.sent += 1
+            parts = [b'data', self.payload]
+        else:
+            self.sent = None
+            parts = [b'meta', np.array([1, 0], dtype=np.uint32).tobytes()]
+        if copy:
+            return parts
+        return [zmq.Frame(p) for p in parts]
+
+
+def bench(zclient_class, *, n_frames, n_messages, n_events, decode_workers):
+    context = zmq.Context()
+    zc = zclient_class('tcp://127.0.0.1', zmq=zmq, context=context,
+                       decode_workers=decode_workers)
+    context.destroy(linger=0)
+    backend = zc.backend
+    payload = event2payload(*(np.arange(n_events) % m
+                              for m in (12, 32, 2**9, 2**12, 2**29)))
+    zc.ctrl_sock = FakeRep(backend)
+    zc.data_sock = sub = FakeSub(backend, payload.tobytes(), n_messages)
+    start_daq = zc.start_daq
+
+    async def start():
+        ret = await start_daq()
+        sub.start()
+        return ret
+
+    zc.start_daq = start
+    late = []
+
+    async def ticker():
+        while True:
+            t = time.monotonic()
+            await backend.sleep(1e-3)
+            late.append(time.monotonic() - t - 1e-3)
+
+    async def run():
+        reader = await backend.spawn(zc.read_forever, daemon=True)
+        tick = await backend.spawn(ticker, daemon=True)
+        times = []
+        for _ in range(n_frames):
+            t = time.monotonic()
+            _, ev_count, data, _ = await zc.triggered_frame()
+            times.append(time.monotonic() - t)
+        await backend.cancel(tick)
+        await backend.cancel(reader)
+        return times
+
+    # the clients print every register write
+    with contextlib.redirect_stdout(io.StringIO()):
+        if backend.name == 'curio':
+            # the fake sockets do not need curio.zmq's kernel
+            times = curio.run(run)
+        else:
+            times = backend.run(run)
+
+    # the same work without a loop, to take out of the frame time
+    if decode_workers:
+        def work():
+            zc._decode(b'data', payload)
+    else:
+        def work():
+            zc.parse_message(b'data', payload)
+    t = time.monotonic()
+    for _ in range(n_messages):
+        work()
+    baseline = time.monotonic() - t
+    return np.array(times) - baseline, np.array(late)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=100,
+                        help='data messages per frame')
+    parser.add_argument('--events', type=int, default=10000,
+                        help='events per message')
+    parser.add_argument('--decode-workers', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{args.frames} frames of {args.messages} x {args.events} events')
+    print(f'{"backend":>8} {"overhead/frame":>15} {"per message":>12} '
+          f'{"tick late mean":>15} {"max":>8}')
+    for cls in (ZClientCurio, ZClientAsyncio):
+        overhead, late = bench(cls, n_frames=args.frames,
+                               n_messages=args.messages,
+                               n_events=args.events,
+                               decode_workers=args.decode_workers)
+        per_frame = np.median(overhead)
+        print(f'{cls.backend.name:>8} {1e3 * per_frame:>12.2f} ms '
+              f'{1e6 * per_frame / args.messages:>9.1f} us '
+              f'{1e3 * late.mean():>12.3f} ms {1e3 * late.max():>5.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ from collections import defaultdict
 import time
 import struct
 
-from pygerm.client import event2payload
+from pygerm.client import event2payload, MAX_SEQ
 
 
 class ListenAndSend(DatagramProtocol):
@@ -60,6 +60,7 @@ class CMDS(Enum):
     REG_READ = 0
     REG_WRITE = 1
     START_DMA = 2
+    DELAY = 3
 
 
 FIFODATAREG = 24
@@ -245,23 +246,42 @@ async def recv_and_process():
     while True:
         msg = await responder.recv_multipart()
         print(msg)
+        # a register program comes as one command per part and gets a
+        # single reply with all of the echoes
+        if len(msg) > MAX_SEQ:
+            # refused before any of it is run, as the zmq server does
+            await responder.send(
+                np.array([0xdead, 0xdead, len(msg)], dtype=np.uint32))
+            continue
+        replies = []
+        start_daq = False
         for m in msg:
             cmd, addr, value = np.frombuffer(m, dtype=np.int32)
-            cmd = CMDS(cmd)
+            try:
+                cmd = CMDS(cmd)
+            except ValueError:
+                replies.append(np.ones(3, dtype=np.uint32) * 0xdead)
+                continue
             if cmd == CMDS.REG_WRITE:
                 state[addr] = value
-                await responder.send(m)
+                replies.append(m)
                 if addr == 0 and value == 1:
-                    start_time = time.time()
-                    num_ev = await sim_data()
-                    delta_time = time.time() - start_time
-                    print(f'generated {num_ev} events in {delta_time} s')
+                    start_daq = True
             elif cmd == CMDS.REG_READ:
                 value = state[addr]
-                reply = np.array([cmd.value, addr, value], dtype=np.uint32)
-                await responder.send(reply)
+                replies.append(
+                    np.array([cmd.value, addr, value], dtype=np.uint32))
+            elif cmd == CMDS.DELAY:
+                await asyncio.sleep(value * 1e-6)
+                replies.append(m)
             else:
-                await responder.send(np.ones(3, dtype=np.uint32) * 0xdead)
+                replies.append(np.ones(3, dtype=np.uint32) * 0xdead)
+        await responder.send(b''.join(bytes(r) for r in replies))
+        if start_daq:
+            start_time = time.time()
+            num_ev = await sim_data()
+            delta_time = time.time() - start_time
+            print(f'generated {num_ev} events in {delta_time} s')
 
 
 loop.run_until_complete(recv_and_process())
@@ -1,19 +1,33 @@
-import curio
-import curio.zmq as zmq
-from caproto.curio.server import Context, find_next_tcp_port
-from pygerm.caproto import GeRMIOC
+from caproto.curio.server import find_next_tcp_port
+from pygerm.caproto import GeRMIOCZMQData, GeRMIOCZMQDataAsyncio
 from portable_fs.sqlite.fs import FileStore
 import argparse
 
 prefix = 'XF:28IDC-ES:1{Det:GeRM1}'
 
 
-def create_server(zmq_url, fs):
-    germ = GeRMIOC(zmq_url, fs)
+def create_server(zmq_url, fs, layout='columns', stream=False, journal=None,
+                  ring_words=0, decode_workers=0, memory_budget=None,
+                  spill_dir=None, backend='curio', batch=False,
+                  pixel_index=False):
+    if backend == 'asyncio':
+        from caproto.asyncio.server import Context
+        ioc_class = GeRMIOCZMQDataAsyncio
+    else:
+        from caproto.curio.server import Context
+        ioc_class = GeRMIOCZMQData
+    germ = ioc_class(zmq_url, fs, layout=layout, stream=stream,
+                     journal=journal, ring_words=ring_words,
+                     decode_workers=decode_workers,
+                     memory_budget=memory_budget, spill_dir=spill_dir,
+                     batch=batch, pixel_index=pixel_index)
     pvdb = {f'{prefix}:acquire': germ.acquire_channel,
             f'{prefix}:frametime': germ.frametime_channel,
             f'{prefix}:filepath': germ.filepath_channel,
             f'{prefix}:last_file': germ.last_file_channel,
+            f'{prefix}:write_time': germ.write_time_channel,
+            f'{prefix}:stream': germ.stream_channel,
+            f'{prefix}:pixel_index': germ.pixel_index_channel,
 
             f'{prefix}:overfill': germ.overfill_channel,
             f'{prefix}:last_frame': germ.last_frame_channel,
@@ -24,6 +38,20 @@ def create_server(zmq_url, fs):
             f'{prefix}:UUID:TD': germ.uid_td_channel,
             f'{prefix}:UUID:PD': germ.uid_pd_channel,
             f'{prefix}:UUID:TS': germ.uid_ts_channel,
+            f'{prefix}:num_images': germ.num_images_channel,
+            f'{prefix}:dead_time': germ.dead_time_channel,
+            f'{prefix}:datum_chunk': germ.datum_chunk_channel,
+            f'{prefix}:datum_chunks': germ.datum_chunks_channel,
+            f'{prefix}:registry_latency': germ.registry_latency_channel,
+            f'{prefix}:registry_pending': germ.registry_pending_channel,
+            f'{prefix}:reg_hit_rate': germ.reg_hit_rate_channel,
+            f'{prefix}:reg_latency': germ.reg_latency_channel,
+            f'{prefix}:reg_refresh': germ.reg_refresh_channel,
+            f'{prefix}:ring_occupancy': germ.ring_occupancy_channel,
+            f'{prefix}:ring_high_water': germ.ring_high_water_channel,
+            f'{prefix}:ring_overflows': germ.ring_overflows_channel,
+            f'{prefix}:buffer_high_water': germ.buffer_high_water_channel,
+            f'{prefix}:spilled_events': germ.spilled_events_channel,
             }
     return Context('0.0.0.0', find_next_tcp_port(), pvdb), germ
 
@@ -33,15 +61,47 @@ if __name__ == '__main__':
         description='IOC to front GeRM zmq server')
     parser.add_argument('host', type=str,
                         help='host running GeRM zmq server')
+    parser.add_argument('--layout', choices=('columns', 'raw'),
+                        default='columns',
+                        help='write decoded columns or the raw words')
+    parser.add_argument('--stream', action='store_true',
+                        help='write bunches to disk as they arrive')
+    parser.add_argument('--journal', type=str,
+                        default='/tmp/germ_registry.journal',
+                        help='file to journal registry writes to')
+    parser.add_argument('--ring-mb', type=int, default=0,
+                        help='size of the receive ring buffer (0 for none)')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='threads to decode on (0 for the event loop)')
+    parser.add_argument('--memory-budget-mb', type=int, default=None,
+                        help='memory to hold a frame in before spilling')
+    parser.add_argument('--spill-dir', type=str, default=None,
+                        help='where to spill frames over the budget')
+    parser.add_argument('--backend', choices=('curio', 'asyncio'),
+                        default='curio',
+                        help='the event loop to run the IOC on')
+    parser.add_argument('--batch', action='store_true',
+                        help='send register programs as one message '
+                        '(needs a zmq server that takes sequences)')
+    parser.add_argument('--pixel-index', action='store_true',
+                        help='write the pixel index into each file')
     args = parser.parse_args()
 
     zmq_ip = args.host
 
+    memory_budget = None
+    if args.memory_budget_mb is not None:
+        memory_budget = args.memory_budget_mb * 2**20
+
     fs = FileStore({'dbpath': '/tmp/fs.sqlite'})
-    ctx, germ = create_server(f'tcp://{zmq_ip}', fs)
+    ctx, germ = create_server(f'tcp://{zmq_ip}', fs, args.layout,
+                              args.stream, args.journal,
+                              args.ring_mb * 2**20 // 4, args.decode_workers,
+                              memory_budget, args.spill_dir, args.backend,
+                              args.batch, args.pixel_index)
 
     async def runner():
-        await curio.spawn(germ.zclient.read_forever, daemon=True)
+        await germ.backend.spawn(germ.zclient.read_forever, daemon=True)
         await ctx.run()
 
-    zmq.run(runner)
+    germ.backend.run(runner)
@@ -1,14 +1,20 @@
-import curio.zmq as zmq
-from caproto.curio.server import Context, find_next_tcp_port
-from pygerm.caproto import GeRMIOCUDPData
+from caproto.curio.server import find_next_tcp_port
+from pygerm.caproto import GeRMIOCUDPData, GeRMIOCUDPDataAsyncio
 from databroker.assets.sqlite import Registry
 import argparse
 
 prefix = 'XF:28IDC-ES:1{Det:GeRM1}'
 
 
-def create_server(zync_url, udp_url, reg):
-    germ = GeRMIOCUDPData(zync_url, udp_url, reg)
+def create_server(zync_url, udp_url, reg, journal=None, backend='curio',
+                  batch=False):
+    if backend == 'asyncio':
+        from caproto.asyncio.server import Context
+        ioc_class = GeRMIOCUDPDataAsyncio
+    else:
+        from caproto.curio.server import Context
+        ioc_class = GeRMIOCUDPData
+    germ = ioc_class(zync_url, udp_url, reg, journal=journal, batch=batch)
     pvdb = {f'{prefix}:acquire': germ.acquire_channel,
             f'{prefix}:frametime': germ.frametime_channel,
 
@@ -30,6 +36,21 @@ def create_server(zync_url, udp_url, reg):
             f'{prefix}:UUID:TD': germ.uid_td_channel,
             f'{prefix}:UUID:PD': germ.uid_pd_channel,
             f'{prefix}:UUID:TS': germ.uid_ts_channel,
+            f'{prefix}:num_images': germ.num_images_channel,
+            f'{prefix}:dead_time': germ.dead_time_channel,
+            f'{prefix}:datum_chunk': germ.datum_chunk_channel,
+            f'{prefix}:datum_chunks': germ.datum_chunks_channel,
+            f'{prefix}:registry_latency': germ.registry_latency_channel,
+            f'{prefix}:registry_pending': germ.registry_pending_channel,
+            f'{prefix}:reg_hit_rate': germ.reg_hit_rate_channel,
+            f'{prefix}:reg_latency': germ.reg_latency_channel,
+            f'{prefix}:reg_refresh': germ.reg_refresh_channel,
+            f'{prefix}:copy_queue': germ.copy_queue_channel,
+            f'{prefix}:copy_rate': germ.copy_rate_channel,
+            f'{prefix}:copy_error': germ.copy_error_channel,
+            f'{prefix}:defer_registration': germ.defer_registration_channel,
+            f'{prefix}:copy_wait': germ.copy_wait_channel,
+            f'{prefix}:lost_events': germ.lost_events_channel,
             }
     return Context('0.0.0.0', find_next_tcp_port(), pvdb), germ
 
@@ -41,6 +62,15 @@ if __name__ == '__main__':
                         help='ip of the Zync server')
     parser.add_argument('collector_host', type=str,
                         help='ip of the udp collector')
+    parser.add_argument('--journal', type=str,
+                        default='/tmp/germ_registry_udp.journal',
+                        help='file to journal registry writes to')
+    parser.add_argument('--backend', choices=('curio', 'asyncio'),
+                        default='curio',
+                        help='the event loop to run the IOC on')
+    parser.add_argument('--batch', action='store_true',
+                        help='send register programs as one message '
+                        '(needs a zmq server that takes sequences)')
     args = parser.parse_args()
 
     zync_ip = args.zync_host
@@ -55,10 +85,11 @@ if __name__ == '__main__':
     #print("starting sqlite fs:")
     #reg = Registry({'dbpath': '/tmp/fs.sqlite'})
 
-    ctx, germ = create_server(f'tcp://{zync_ip}', f'tcp://{collector_ip}', reg)
+    ctx, germ = create_server(f'tcp://{zync_ip}', f'tcp://{collector_ip}', reg,
+                              args.journal, args.backend, args.batch)
 
     print("Done. Running...")
     async def runner():
         await ctx.run()
 
-    zmq.run(runner)
+    germ.backend.run(runner)
@@ -0,0 +1,50 @@
+from pygerm.collector import UDPCollector, DATA_PORT
+from pygerm.live import LiveSpectrum
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='collect frames from the GeRM UDP stream')
+    parser.add_argument('fpga_host', type=str,
+                        help='ip of the FPGA (or det_sim.py)')
+    parser.add_argument('--ctrl-port', type=int, default=5557,
+                        help='port for the IOC to talk to')
+    parser.add_argument('--data-port', type=int, default=DATA_PORT,
+                        help='port the FPGA sends data to')
+    parser.add_argument('--buffer-mb', type=int, default=1024,
+                        help='frames bigger than this are written as they '
+                        'arrive')
+    parser.add_argument('--rcvbuf-mb', type=int, default=256,
+                        help='kernel socket buffer to ask for')
+    parser.add_argument('--no-arm', action='store_true',
+                        help='do not enable the FPGA data stream')
+    parser.add_argument('--live-port', type=int, default=None,
+                        help='publish the spectrum of the frame in progress '
+                        'on this port')
+    parser.add_argument('--live-bins', type=int, default=1024,
+                        help='energy bins of the live spectrum')
+    parser.add_argument('--live-interval', type=float, default=1,
+                        help='seconds between live spectra')
+    args = parser.parse_args()
+
+    live = None
+    if args.live_port is not None:
+        live = LiveSpectrum(args.live_bins, url=f'tcp://*:{args.live_port}',
+                            interval=args.live_interval)
+    col = UDPCollector(args.fpga_host,
+                       ctrl_url=f'tcp://*:{args.ctrl_port}',
+                       data_addr=('0.0.0.0', args.data_port),
+                       buffer_bytes=args.buffer_mb * 2**20,
+                       rcvbuf=args.rcvbuf_mb * 2**20,
+                       live=live)
+    if not args.no_arm:
+        print('Enabling UDP interface on the FPGA...')
+        if not col.arm():
+            print('the FPGA did not acknowledge')
+    try:
+        col.serve_forever()
+    finally:
+        col.close()
+        if live is not None:
+            live.close()
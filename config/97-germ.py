@@ -153,7 +153,7 @@ def make_mars_line(h, thresh=1000):
                  .apply(lambda g: np.sum(g > thresh))['germ_pd'])
                 .reset_index()
                 .iterrows()):
-            line[chip*32 + chan] += ct
+            line[int(chip)*32 + int(chan)] += ct
     return line
 
 
@@ -168,7 +168,7 @@ def make_mars_heatmap(h):
         for (chip, chan), group in (df[['germ_chip', 'germ_chan', 'germ_pd']]
                                     .groupby(('germ_chip', 'germ_chan'))):
             gpd = group['germ_pd'].values
-            line[:, int(chip*32 + chan)] += np.bincount(gpd, minlength=bins)
+            line[:, int(chip)*32 + int(chan)] += np.bincount(gpd, minlength=bins)
 
     return line
 
@@ -187,7 +187,7 @@ def make_mars_heatmap_after_correction(h, corr_mat=None,
         for (chip, chan), group in (df[['germ_chip', 'germ_chan', 'germ_pd']]
                                     .groupby(('germ_chip', 'germ_chan'))):
             gpd = group['germ_pd'].values
-            i = int(chip*32+chan)
+            i = int(chip)*32 + int(chan)
             eng_arr = gpd*corr_mat[0, i] + corr_mat[1, i]
             line[:, i] += np.histogram(eng_arr, bins=bin_edges)[0]
             # line[:, i] += np.bincount(gpd, minlength=bins)
@@ -268,7 +268,7 @@ def track_peaks(h, bin_num=3000):
         for (chip, chan), group in (df[['germ_chip', 'germ_chan', 'germ_pd']]
                                     .groupby(('germ_chip', 'germ_chan'))):
             gpd = group['germ_pd'].values
-            i = int(chip*32+chan)
+            i = int(chip)*32 + int(chan)
             eng_arr = gpd*cal_val[0, i] + cal_val[1, i]
             line[:, i] += np.histogram(eng_arr, bins=bin_edges)[0]
 
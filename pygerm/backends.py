@@ -0,0 +1,169 @@
+'''The event loops the clients and the IOC can run on
+
+The zmq clients and the IOC channels only use the few primitives
+collected here, so the same code runs on curio or asyncio.  Pass
+``CURIO`` or ``ASYNCIO`` (or set the class' ``backend``).
+'''
+import abc
+import asyncio
+import functools
+import queue
+import types
+
+
+class Backend(abc.ABC):
+    '''The primitives of one event loop library'''
+    name = None
+
+    @property
+    @abc.abstractmethod
+    def zmq(self):
+        '''The zmq module whose sockets can be awaited on this loop'''
+
+    @abc.abstractmethod
+    async def spawn(self, func, *args, daemon=False):
+        '''Start ``func(*args)`` as a task, returning it'''
+
+    @abc.abstractmethod
+    async def join(self, task):
+        '''Wait for a task from `spawn`, returning its result'''
+
+    @abc.abstractmethod
+    async def cancel(self, task):
+        '''Cancel a task from `spawn` and wait for it to finish'''
+
+    @abc.abstractmethod
+    async def notify_all(self, cond):
+        '''Wake everything waiting on `cond`, which must be held'''
+
+    @abc.abstractmethod
+    async def run_in_thread(self, func, *args):
+        '''Run a blocking ``func(*args)`` on a thread'''
+
+    @abc.abstractmethod
+    async def wait_future(self, fut):
+        '''Wait for a `concurrent.futures.Future`, returning its result'''
+
+    @abc.abstractmethod
+    def run(self, func, *args):
+        '''Run the coroutine function ``func(*args)`` to completion'''
+
+    async def submit(self, executor, func, *args):
+        '''Queue ``func(*args)`` on `executor`, returning the future
+
+        This only leaves the loop (to wait) if the queue is full.
+        '''
+        try:
+            return executor.submit(func, *args, block=False)
+        except queue.Full:
+            return (await self.run_in_thread(executor.submit, func, *args))
+
+    async def run_in_executor(self, executor, func, *args):
+        '''Run ``func(*args)`` on `executor` without blocking the loop'''
+        fut = await self.submit(executor, func, *args)
+        return (await self.wait_future(fut))
+
+
+class CurioBackend(Backend):
+    name = 'curio'
+
+    def __init__(self):
+        import curio
+        self._curio = curio
+        self.Lock = curio.Lock
+        self.Condition = curio.Condition
+        self.Queue = curio.Queue
+        self.sleep = curio.sleep
+
+    @property
+    def zmq(self):
+        import curio.zmq
+        return curio.zmq
+
+    async def spawn(self, func, *args, daemon=False):
+        return (await self._curio.spawn(func, *args, daemon=daemon))
+
+    async def join(self, task):
+        return (await task.join())
+
+    async def cancel(self, task):
+        await task.cancel()
+
+    async def notify_all(self, cond):
+        await cond.notify_all()
+
+    async def run_in_thread(self, func, *args):
+        return (await self._curio.run_in_thread(func, *args))
+
+    async def wait_future(self, fut):
+        return (await self._curio.run_in_thread(fut.result))
+
+    def run(self, func, *args):
+        # curio.zmq's kernel can also wait on zmq sockets
+        return self.zmq.run(func, *args)
+
+
+class AsyncioBackend(Backend):
+    name = 'asyncio'
+    Lock = asyncio.Lock
+    Condition = asyncio.Condition
+    Queue = asyncio.Queue
+    sleep = staticmethod(asyncio.sleep)
+
+    def __init__(self):
+        # the loop only holds weak references to tasks, daemon or not
+        self._tasks = set()
+        self._zmq = None
+
+    @property
+    def zmq(self):
+        # like curio.zmq, pyzmq with the Context swapped for one making
+        # awaitable sockets
+        if self._zmq is None:
+            import zmq
+            import zmq.asyncio
+            ns = types.SimpleNamespace(**vars(zmq))
+            ns.Context = zmq.asyncio.Context
+            ns.Socket = zmq.asyncio.Socket
+            ns.Poller = zmq.asyncio.Poller
+            self._zmq = ns
+        return self._zmq
+
+    async def spawn(self, func, *args, daemon=False):
+        task = asyncio.ensure_future(func(*args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def join(self, task):
+        return (await task)
+
+    async def cancel(self, task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def notify_all(self, cond):
+        cond.notify_all()
+
+    async def run_in_thread(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return (await loop.run_in_executor(
+            None, functools.partial(func, *args)))
+
+    async def wait_future(self, fut):
+        # woken by the loop, no thread is tied up waiting
+        return (await asyncio.wrap_future(fut))
+
+    def run(self, func, *args):
+        # the default loop, as the locks and sockets made before this
+        # are tied to it on python 3.6
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(func(*args))
+
+
+CURIO = CurioBackend()
+ASYNCIO = AsyncioBackend()
+BACKENDS = {b.name: b for b in (CURIO, ASYNCIO)}
@@ -1,62 +1,203 @@
 import numpy as np
-import h5py
+import os
 from pathlib import Path
 import caproto as ca
-from concurrent.futures import ThreadPoolExecutor
 import uuid
 import time
-import curio
-import curio.zmq as zmq
-import shutil
 import struct
 import traceback
-import os
 import datetime
 
 from .client import DATA_TYPES
+from .collector import loss_path
+from .backends import CURIO, ASYNCIO
 from .client.curio_zmq import ZClientCurio, ZClientCurioBase, UClientCurio
-from . import TRIGGER_SETUP_SEQ, START_DAQ, STOP_DAQ
+from .client.asyncio_zmq import (ZClientAsyncio, ZClientAsyncioBase,
+                                 UClientAsyncio)
+from .registry import FrameRegistrar, RegistrationJournal, chunk_datums
+from .transfer import CopyManager
+from .workers import BoundedExecutor
+from .writers import write_h5_frame, StreamingH5Writer
+
+
+def _channel_int(channel):
+    # the initial value is a scalar, values put over CA come as arrays
+    return int(np.ravel(channel.value)[0])
+
+
+def _channel_str(channel, string_encoding='latin-1'):
+    # bytes in a list from older caproto, a str from newer
+    v = channel.value
+    if isinstance(v, (list, tuple)):
+        v, = v
+    if isinstance(v, bytes):
+        v = v.decode(string_encoding)
+    return v.strip('\x00')
+
+
+def _write_frame(fname, data, ev_count, layout, index):
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    write_h5_frame(fname, data, ev_count, layout=layout, index=index)
+
+
+def _open_stream(fname, layout):
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    return StreamingH5Writer(fname, layout=layout)
+
+
+async def _publish_datum_uids(parent):
+    '''Make the datum ids of a frame's columns and put them in the PVs
+
+    Returns
+    -------
+    datum_uids : dict
+        Map of column name to the datum id of the whole column
+    '''
+    datum_uids = {}
+    for short, column in zip(('chip', 'chan', 'td', 'pd', 'ts'),
+                             DATA_TYPES):
+        datum_uids[column] = dset_uid = str(uuid.uuid4())
+        chan = getattr(parent, f'uid_{short}_channel')
+        await chan.write_from_dbr(
+            [dset_uid.encode()], ca.ChannelType.STRING, None)
+    return datum_uids
+
+
+class _FrameSequence:
+    '''Keep the FPGA armed between the triggers of a sequence
+
+    Each trigger collects one frame, so that the UUID PVs read after it
+    point at that frame.  The sequence is `num_images` triggers (e.g.
+    the ``num`` of a ``count``); for all but the last the FPGA is armed
+    for the next frame, and the frame is written out, in the background
+    after the trigger returns.  The last trigger waits for them all.
+    '''
+    def _init_sequence(self):
+        # frames left in the sequence after this one
+        self._remaining = 0
+        # arming the FPGA for the next trigger
+        self._rearm_task = None
+        # when the last frame ended
+        self._last_frame_end = None
+
+    async def _next_trigger(self):
+        # start (or carry on) the sequence, returning if the FPGA is
+        # already armed for this frame
+        if self._remaining <= 0:
+            self._remaining = max(
+                _channel_int(self.parent.num_images_channel), 1)
+            self._last_frame_end = None
+            self._start_sequence()
+        self._remaining -= 1
+        task, self._rearm_task = self._rearm_task, None
+        if task is None:
+            return False
+        try:
+            await self.parent.backend.join(task)
+        except Exception:
+            traceback.print_exc()
+            return False
+        return True
+
+    def _start_sequence(self):
+        pass
+
+    async def end_sequence(self):
+        '''Cut the sequence short, so the next trigger starts afresh
+
+        Done when `num_images` is written, when acquire is set to 0
+        (stop) and when a trigger fails.  The FPGA armed for a frame
+        that will not come is stopped, and whatever the sequence left
+        running in the background is waited on.
+        '''
+        self._remaining = 0
+        self._last_frame_end = None
+        task, self._rearm_task = self._rearm_task, None
+        if task is not None:
+            try:
+                await self.parent.backend.join(task)
+            except Exception:
+                traceback.print_exc()
+            await self.zclient.stop_daq()
+        await self._end_sequence()
+
+    async def _end_sequence(self):
+        pass
+
+
+class ChannelGeRMNumImages(ca.ChannelInteger):
+    '''Frames per sequence, a new value ends the one under way'''
+    def __init__(self, *, parent, **kwargs):
+        super().__init__(**kwargs)
+        self.parent = parent
+
+    async def write_from_dbr(self, data, data_type, metadata):
+        await super().write_from_dbr(data, data_type, metadata)
+        await self.parent.acquire_channel.end_sequence()
 
 
-class ChannelGeRMAcquireUDP(ca.ChannelData):
+class ChannelGeRMAcquireUDP(_FrameSequence, ca.ChannelData):
     def __init__(self, *, zclient, uclient, parent, **kwargs):
         super().__init__(**kwargs)
         self.zclient = zclient
         self.uclient = uclient
         self.parent = parent
-        self.file_copy_executor = ThreadPoolExecutor(max_workers=2)
+        self._init_sequence()
+        # the tasks watching this sequence's copies
+        self._copy_tasks = []
+
+    def _start_sequence(self):
+        self._copy_tasks = []
 
     async def write_from_dbr(self, data, data_type, metadata):
         if self.alarm.status or self.alarm.severity:
             print(f'{self.alarm} {self.alarm.status} {self.alarm.severity})')
             await self.alarm.write(status=0, severity=0)
         await super().write_from_dbr(data, data_type, metadata)
-        if data:
+        if not _channel_int(self):
+            await self.end_sequence()
+        else:
             try:
-                await self.trigger_frame()
+                armed = await self._next_trigger()
+                await self.trigger_frame(armed=armed,
+                                         rearm=self._remaining > 0)
+                if _channel_int(self.parent.copy_wait_channel):
+                    # do not report done until the files are in place
+                    tasks, self._copy_tasks = self._copy_tasks, []
+                    copied = [await self.parent.backend.join(task)
+                              for task in tasks]
+                    if not all(copied):
+                        raise Exception("a frame failed to copy")
             except Exception:
                 traceback.print_exc()
+                await self.end_sequence()
                 await self.alarm.write(status=2, severity=2)
             finally:
+                await self.parent.update_register_channels()
                 await super().write_from_dbr(0, data_type, None)
 
-    async def trigger_frame(self):
+    async def trigger_frame(self, armed=False, rearm=False):
+        '''Collect one frame through the UDP collector
+
+        Parameters
+        ----------
+        armed : bool, optional
+            The FPGA was already set up by the previous frame
+
+        rearm : bool, optional
+            Set the FPGA up for the next frame while the collector is
+            writing this one out, `_next_trigger` waits for it
+        '''
         def _path_channel_to_Path(chanel, string_encoding='latin-1'):
-            # expect this to come back as a length 1 list with
-            # a Bytes object in it
-            v, = chanel.value
-            v = v.decode(string_encoding)
-            return Path(v)
+            return Path(_channel_str(chanel, string_encoding))
 
         zc = self.zclient
         uc = self.uclient
         parent = self.parent
+        backend = parent.backend
 
-        for (addr, val) in TRIGGER_SETUP_SEQ:
-            if addr is None:
-                await curio.sleep(val)
-            else:
-                await zc.write(addr, val)
+        if not armed:
+            await zc.setup_frame()
 
         filepath = _path_channel_to_Path(parent.filepath_channel)
         write_root = _path_channel_to_Path(parent.writeroot_channel)
@@ -93,11 +234,18 @@ class ChannelGeRMAcquireUDP(ca.ChannelData):
             print("DANGER WILL ROBINSON")
             raise Exception("did not get expected handshake from collctor")
 
-        await zc.write(*START_DAQ)
+        await zc.start_daq()
+        if self._last_frame_end is not None:
+            await parent.dead_time_channel.write_from_dbr(
+                [zc.start_time - self._last_frame_end],
+                ca.ChannelType.DOUBLE, None)
         await uc.ctrl_sock.send(b'ack')
         payload = await uc.ctrl_sock.recv()
+        self._last_frame_end = time.time()
 
         await uc.ctrl_sock.send(b'ack')
+        if rearm:
+            self._rearm_task = await backend.spawn(self._rearm)
         written_file = await uc.ctrl_sock.recv()
         # now need to add correct path given by filepath
         written_path = Path(written_file.decode())
@@ -107,8 +255,12 @@ class ChannelGeRMAcquireUDP(ca.ChannelData):
         await parent.last_file_channel.write_from_dbr(
             [written_file], ca.ChannelType.STRING, None)
 
-        await zc.write(*STOP_DAQ)
-        fr_num, ev_count, overfill = struct.unpack('QQQ', payload)
+        if not rearm:
+            await zc.stop_daq()
+        fr_num, ev_count, overfill = struct.unpack_from('QQQ', payload)
+        # older collectors do not report packet loss
+        lost = (struct.unpack_from('Q', payload, 24)[0]
+                if len(payload) >= 32 else 0)
 
         await parent.last_frame_channel.write_from_dbr(
             [fr_num], ca.ChannelType.INT, None)
@@ -116,6 +268,8 @@ class ChannelGeRMAcquireUDP(ca.ChannelData):
             [overfill], ca.ChannelType.INT, None)
         await parent.count_channel.write_from_dbr(
             [ev_count], ca.ChannelType.INT, None)
+        await parent.lost_events_channel.write_from_dbr(
+            [lost], ca.ChannelType.INT, None)
 
         # now use written_path (filename of file on local udp server)
         # to construct the resource kwargs for filestore
@@ -123,117 +277,234 @@ class ChannelGeRMAcquireUDP(ca.ChannelData):
         relative_filename = written_path.relative_to(write_root)
         # now add the base subdir
         write_filename = write_subdir / relative_filename
-        fs = parent._fs
-        res = fs.register_resource(
-            'BinaryGeRM',
-            root=str(read_root),
-            rpath=str(write_filename),
-            rkwargs={})
-
         # relative filename needs to be filename on local server
         src_filename = src_mount / relative_filename
         # write_filename is the desired filepath with relative path added from
         # filepath
         dest_filename = dest_mount / write_filename
 
-        # check if directory exists, if not make it
-        directory = os.path.dirname(dest_filename)
-        os.makedirs(directory, exist_ok=True)
+        # the datum ids are made here so they can be published before
+        # anything is registered
+        datum_uids = await _publish_datum_uids(parent)
+        registration = ('BinaryGeRM', str(write_filename), {}, datum_uids,
+                        ev_count, _channel_int(parent.datum_chunk_channel),
+                        str(read_root))
 
         print(f"Copying from file {str(src_filename)} to {str(dest_filename)}")
-        cp_stat = self.file_copy_executor.submit(shutil.copy,  # noqa: F841
-                                                 str(src_filename),
-                                                 str(dest_filename))
-
-        for short, long_name in (
-                ('chip', 'chip'),
-                ('chan', 'chan'),
-                ('td', 'timestamp_fine'),
-                ('pd', 'energy'),
-                ('ts', 'timestamp_coarse')):
-            print(f'short: {short}')
-            chan_name = f'uid_{short}_channel'
-            print(f'chan_name: {chan_name}')
-            chan = getattr(parent, chan_name)
-            print(f'chan: {chan}')
-            dset_uid = str(uuid.uuid4())
-            dset_uid = fs.register_datum(res, {'column': long_name})
-
-            await chan.write_from_dbr(
-                dset_uid.encode(), ca.ChannelType.STRING, None)
+        copier = parent.copier
+        if os.path.exists(loss_path(src_filename)):
+            # the handler finds the gaps next to the file.  A truncated
+            # frame has one even with nothing lost, so do not go by that
+            fut = await backend.submit(copier, loss_path(src_filename),
+                                       loss_path(dest_filename))
+            self._copy_tasks.append(await backend.spawn(
+                self._watch_copy, fut, None, daemon=True))
+        fut = await backend.submit(copier, src_filename, dest_filename)
+        await parent.copy_queue_channel.write_from_dbr(
+            [copier.depth], ca.ChannelType.INT, None)
+
+        if _channel_int(parent.defer_registration_channel):
+            # only point at the file once it is known to be there
+            self._copy_tasks.append(await backend.spawn(
+                self._watch_copy, fut, registration, daemon=True))
+        else:
+            await backend.spawn(parent.register_frame, *registration,
+                                daemon=True)
+            self._copy_tasks.append(await backend.spawn(
+                self._watch_copy, fut, None, daemon=True))
 
         return fr_num, ev_count, overfill
 
+    async def _rearm(self):
+        await self.zclient.stop_daq()
+        await self.zclient.setup_frame()
 
-class ChannelGeRMAcquire(ca.ChannelData):
+    async def _watch_copy(self, fut, registration):
+        '''Wait on a copy, updating the copy PVs when it is done
+
+        If `registration` is given it is passed to the parent's
+        `register_frame` once the copy succeeds.  Returns whether the
+        copy succeeded.
+        '''
+        parent = self.parent
+        copier = parent.copier
+        try:
+            await parent.backend.wait_future(fut)
+        except Exception as e:
+            print(f'copy failed: {e}')
+            ok = False
+        else:
+            await parent.copy_rate_channel.write_from_dbr(
+                [copier.throughput / 2**20], ca.ChannelType.DOUBLE, None)
+            if registration is not None:
+                await parent.register_frame(*registration)
+            ok = True
+        # CA strings are limited to 40 characters
+        await parent.copy_error_channel.write_from_dbr(
+            [copier.last_error[-39:].encode('latin-1', 'replace')],
+            ca.ChannelType.STRING, None)
+        await parent.copy_queue_channel.write_from_dbr(
+            [copier.depth], ca.ChannelType.INT, None)
+        return ok
+
+
+class ChannelGeRMAcquire(_FrameSequence, ca.ChannelData):
     def __init__(self, *, zclient,
                  parent, **kwargs):
         super().__init__(**kwargs)
         self.zclient = zclient
         self.parent = parent
+        self._init_sequence()
+        # writing and registering the frames of this sequence
+        self._finishing = []
 
     async def write_from_dbr(self, data, data_type, metadata):
         await super().write_from_dbr(data, data_type, metadata)
-        if data:
-            start_time = time.time()
-            fr_num, ev_count, data, overfill = (
-                await self.zclient.triggered_frame())
-            delta_time = time.time() - start_time
-            print(f'read frame: {fr_num} with {ev_count} '
-                  f'events in {delta_time}s ({ev_count / delta_time} ev/s )')
-            await self.parent.count_channel.write_from_dbr(
-                ev_count, ca.DBR_INT.DBR_ID, None)
-            await self.parent.overfill_channel.write_from_dbr(
-                overfill, ca.DBR_INT.DBR_ID, None)
-            await self.parent.last_frame_channel.write_from_dbr(
-                fr_num, ca.DBR_INT.DBR_ID, None)
+        if not _channel_int(self):
+            await self.end_sequence()
+        else:
+            parent = self.parent
+            backend = parent.backend
+            if self._remaining <= 0 and (self.alarm.status or
+                                         self.alarm.severity):
+                # raised by the last sequence; a frame written in the
+                # background fails after its trigger, so keep it until
+                # this one is done
+                await self.alarm.write(status=0, severity=0)
             try:
-                start_time = time.time()
-                write_path = self.parent.filepath_channel.value
-                write_path = bytes(write_path).decode('utf-8').strip('\x00')
+                armed = await self._next_trigger()
+                write_path = _channel_str(parent.filepath_channel, 'utf-8')
+                fname = None
                 if len(write_path):
-                    path = Path(write_path)
-                    path.mkdir(parents=True, exist_ok=True)
-
-                    fname = path / '{}.h5'.format(str(uuid.uuid4()))
-                    with h5py.File(str(fname), 'w-') as fout:
-                        g = fout.create_group('GeRM')
-                        dsets = {k: g.create_dataset(k, shape=(ev_count,),
-                                                     dtype=f'uint{w}')
-                                 for k, w in DATA_TYPES.items()}
-                        offset = 0
-                        for n, payload in enumerate(data):
-                            bunch_len = len(payload[0])
-                            for k, d in zip(DATA_TYPES, payload):
-                                dsets[k][offset:offset+bunch_len] = d
-                            offset += bunch_len
-                    await self.parent.last_file_channel.write_from_dbr(
-                        str(fname.name), ca.DBR_STRING.DBR_ID, None)
-                    if self.parent._fs:
-                        fs = self.parent._fs
-                        res = fs.insert_resource('GeRM',
-                                                 str(fname), {}, '/')
-                        for short, dset in zip(
-                                ('chip', 'chan', 'td', 'pd', 'ts'),
-                                DATA_TYPES):
-                            chan_name = f'uid_{short}_channel'
-                            chan = getattr(self.parent, chan_name)
-                            dset_uid = str(uuid.uuid4())
-                            fs.insert_datum(res, dset_uid, {'column': dset})
-
-                            await chan.write_from_dbr(
-                                dset_uid, ca.DBR_STRING.DBR_ID, None)
-                delta_time = time.time() - start_time
-                print(f'wrote frame: {fr_num} with {ev_count} '
-                      f'events in {delta_time}s '
-                      f'({ev_count / delta_time} ev/s )')
+                    fname = (Path(write_path) /
+                             '{}.h5'.format(str(uuid.uuid4())))
+                stream = fname is not None and _channel_int(
+                    parent.stream_channel)
 
-            except Exception as e:
-                print(data_type)
-                print('failed')
-                print(e)
+                start_time = time.time()
+                if stream:
+                    fr_num, ev_count, overfill, data = (
+                        await self.stream_frame(fname, armed=armed))
+                else:
+                    fr_num, ev_count, data, overfill = (
+                        await self.zclient.triggered_frame(armed=armed))
+                delta_time = time.time() - start_time
+                print(f'read frame: {fr_num} with {ev_count} events in '
+                      f'{delta_time}s ({ev_count / delta_time} ev/s )')
+                if self._last_frame_end is not None:
+                    await parent.dead_time_channel.write_from_dbr(
+                        self.zclient.start_time - self._last_frame_end,
+                        ca.ChannelType.DOUBLE, None)
+                self._last_frame_end = self.zclient.stop_time
+                await parent.update_buffer_channels()
+                if self._remaining:
+                    self._rearm_task = await backend.spawn(
+                        self.zclient.setup_frame)
+
+                await parent.count_channel.write_from_dbr(
+                    ev_count, ca.ChannelType.INT, None)
+                await parent.overfill_channel.write_from_dbr(
+                    overfill, ca.ChannelType.INT, None)
+                await parent.last_frame_channel.write_from_dbr(
+                    fr_num, ca.ChannelType.INT, None)
+                datum_uids = None
+                if fname is not None and parent._fs:
+                    datum_uids = await _publish_datum_uids(parent)
+                # write and register this frame while the next is armed
+                self._finishing.append(await backend.spawn(
+                    self.finish_frame, fname, stream, data,
+                    fr_num, ev_count, datum_uids))
+            except Exception:
+                traceback.print_exc()
+                await self.end_sequence()
+                await self.alarm.write(status=2, severity=2)
+            finally:
+                if not self._remaining:
+                    await self._end_sequence()
+                await parent.update_register_channels()
+                await super().write_from_dbr(0, data_type, None)
 
-            await super().write_from_dbr(0, data_type, None)
+    async def _end_sequence(self):
+        tasks, self._finishing = self._finishing, []
+        for task in tasks:
+            await self.parent.backend.join(task)
+
+    async def finish_frame(self, fname, stream, data,
+                           fr_num, ev_count, datum_uids):
+        '''Write (unless streamed) and register a collected frame
+
+        If streamed, `data` is the list of futures from `stream_frame`.
+        It is registered under `datum_uids`, if given.  As this runs
+        after the frame's trigger returned, a failure raises the
+        acquire alarm for the rest of the sequence: major if the file
+        is not written, minor if only the registration is still to go.
+        '''
+        try:
+            start_time = time.time()
+            if fname is not None:
+                if stream:
+                    # the executor is FIFO, once closed all are done
+                    await self.parent.backend.wait_future(data[-1])
+                    for fut in data:
+                        # raise any error from the appends
+                        fut.result()
+                else:
+                    await self.parent.backend.run_in_executor(
+                        self.parent.write_executor, _write_frame,
+                        fname, data, ev_count, self.parent.layout,
+                        bool(_channel_int(self.parent.pixel_index_channel)))
+                await self.parent.write_time_channel.write_from_dbr(
+                    time.time() - start_time, ca.ChannelType.DOUBLE,
+                    None)
+                await self.parent.last_file_channel.write_from_dbr(
+                    str(fname.name), ca.ChannelType.STRING, None)
+                if datum_uids is not None:
+                    chunk = _channel_int(self.parent.datum_chunk_channel)
+                    if not await self.parent.register_frame(
+                            'GeRM', str(fname), {}, datum_uids, ev_count,
+                            chunk):
+                        # the registrar tries it again later
+                        print(f'frame {fr_num} is not registered yet')
+                        if not self.alarm.severity:
+                            await self.alarm.write(status=2, severity=1)
+            delta_time = time.time() - start_time
+            print(f'wrote frame: {fr_num} with {ev_count} '
+                  f'events in {delta_time}s '
+                  f'({ev_count / delta_time} ev/s )')
+        except Exception:
+            print(f'writing frame {fr_num} to {fname} failed')
+            traceback.print_exc()
+            await self.alarm.write(status=2, severity=2)
+
+    async def stream_frame(self, fname, armed=False):
+        '''Collect a frame, writing each bunch to `fname` as it arrives
+
+        At most the writer's queue worth of bunches are held in memory;
+        if the disk falls behind, reading from the socket waits on it.
+        The returned futures are done when the file is complete.
+        '''
+        backend = self.parent.backend
+        executor = self.parent.write_executor
+        writer = await backend.run_in_executor(
+            executor, _open_stream, fname, self.parent.layout)
+        pending = []
+
+        async def sink(payload):
+            pending.append(
+                await backend.submit(executor, writer.append, payload))
+
+        try:
+            fr_num, ev_count, _, overfill = (
+                await self.zclient.triggered_frame(sink=sink, armed=armed))
+        except Exception:
+            # do not leave the FPGA sending a frame nobody is reading
+            await self.zclient.stop_daq()
+            raise
+        finally:
+            # the executor is FIFO, so this runs after the last append
+            pending.append(
+                await backend.submit(executor, writer.close))
+        return fr_num, ev_count, overfill, pending
 
 
 class ChannelGeRMFrameTime(ca.ChannelDouble):
@@ -260,6 +531,8 @@ class ChannelGeRMFrameTime(ca.ChannelDouble):
         return ret
 
     async def get_dbr_data(self, type_):
+        # from the zclient's shadow unless it is stale, so polling this
+        # does not queue up behind acquisition commands
         v = await self.zclient.read(0xd4)
         v *= self.RESOLUTION
         self.value = [v, ]
@@ -267,9 +540,40 @@ class ChannelGeRMFrameTime(ca.ChannelDouble):
         return ret
 
 
+class ChannelGeRMRegisterRefresh(ca.ChannelData):
+    '''Re-read every shadowed register when written'''
+    def __init__(self, *, zclient, parent, **kwargs):
+        super().__init__(**kwargs)
+        self.zclient = zclient
+        self.parent = parent
+
+    async def write_from_dbr(self, data, data_type, metadata):
+        await super().write_from_dbr(data, data_type, metadata)
+        if data:
+            try:
+                await self.zclient.refresh()
+            finally:
+                await self.parent.update_register_channels()
+                await super().write_from_dbr(0, data_type, None)
+
+
 class GeRMIOCBase:
-    def __init__(self, *, fs):
+    '''The channels common to both ways of collecting
+
+    The event loop (and so the zmq module and clients) is set by
+    `backend`, see `pygerm.backends`.
+    '''
+    backend = CURIO
+
+    def __init__(self, *, fs, journal=None):
         self._fs = fs
+        # the registry is written to from a worker thread, journaled to
+        # `journal` (if given) until each frame is in
+        self.registrar = None
+        if fs is not None:
+            self.registrar = FrameRegistrar(
+                fs, journal=(None if journal is None
+                             else RegistrationJournal(journal)))
 
         # this assumes a sub-class creates self.zclient and then calls
         # super()
@@ -297,25 +601,172 @@ class GeRMIOCBase:
         self.uid_ts_channel = ca.ChannelString(
             value=b'null', string_encoding='latin-1')
 
+        # frames per acquire, and the seconds the detector sat idle
+        # between the last two
+        self.num_images_channel = ChannelGeRMNumImages(value=1,
+                                                       parent=self)
+        self.dead_time_channel = ca.ChannelDouble(value=0, precision=4,
+                                                  units='s')
+
+        # events per extra sliced datum (0 to disable), and how many
+        # slices the last frame was split into
+        self.datum_chunk_channel = ca.ChannelInteger(value=0)
+        self.datum_chunks_channel = ca.ChannelInteger(value=0)
+
+        # seconds the last frame took to register, and the frames not
+        # yet registered
+        self.registry_latency_channel = ca.ChannelDouble(
+            value=0, precision=4, units='s')
+        self.registry_pending_channel = ca.ChannelInteger(value=0)
+
+        # reads served from the register shadow (percent), and the
+        # milliseconds the last command to the Zync took
+        self.reg_hit_rate_channel = ca.ChannelDouble(value=0, precision=1,
+                                                     units='%')
+        self.reg_latency_channel = ca.ChannelDouble(value=0, precision=2,
+                                                    units='ms')
+        self.reg_refresh_channel = ChannelGeRMRegisterRefresh(
+            value=0, zclient=self.zclient, parent=self)
+
+    async def update_register_channels(self):
+        zc = self.zclient
+        await self.reg_hit_rate_channel.write_from_dbr(
+            [100 * zc.hit_rate], ca.ChannelType.DOUBLE, None)
+        await self.reg_latency_channel.write_from_dbr(
+            [1e3 * zc.last_latency], ca.ChannelType.DOUBLE, None)
+
+    async def register_frame(self, spec, rpath, rkwargs, datum_uids,
+                             ev_count, chunk, root='/'):
+        '''Register a frame without blocking the event loop
+
+        The resource and all of the datums go to the registry in one
+        batch on the registrar's thread.
+
+        Parameters
+        ----------
+        spec, rpath, rkwargs, root
+            As for ``Registry.insert_resource``
+
+        datum_uids : dict
+            Map of column name to the datum id of the whole column
+
+        ev_count : int
+            Events in the frame
+
+        chunk : int
+            Events per extra sliced datum, see `chunk_datums`
+
+        Returns
+        -------
+        registered : bool
+            False if it failed, the registrar tries it again later
+        '''
+        datums = []
+        n_chunks = 0
+        for column, dset_uid in datum_uids.items():
+            chunks = chunk_datums(column, dset_uid, ev_count, chunk)
+            datums.append((dset_uid, {'column': column}))
+            datums.extend(chunks)
+            n_chunks = len(chunks)
+        await self.datum_chunks_channel.write_from_dbr(
+            [n_chunks], ca.ChannelType.INT, None)
+
+        reg = self.registrar
+        if reg is None:
+            return False
+        fut = await self.backend.submit(reg, spec, rpath, rkwargs, datums,
+                                        root)
+        await self.registry_pending_channel.write_from_dbr(
+            [reg.outstanding], ca.ChannelType.INT, None)
+        try:
+            await self.backend.wait_future(fut)
+        except Exception:
+            registered = False
+        else:
+            await self.registry_latency_channel.write_from_dbr(
+                [reg.last_latency], ca.ChannelType.DOUBLE, None)
+            registered = True
+        await self.registry_pending_channel.write_from_dbr(
+            [reg.outstanding], ca.ChannelType.INT, None)
+        return registered
 
-class GeRMIOCZMQData(GeRMIOCBase):
-    def __init__(self, zync_url, fs):
-        self.zclient = ZClientCurio(zync_url, zmq=zmq)
 
-        super().__init__(fs=fs)
+class GeRMIOCZMQData(GeRMIOCBase):
+    _zclient_class = ZClientCurio
+
+    def __init__(self, zync_url, fs, *, layout='columns', stream=False,
+                 journal=None, ring_words=0, decode_workers=0,
+                 memory_budget=None, spill_dir=None, batch=False,
+                 pixel_index=False):
+        self.zclient = self._zclient_class(
+            zync_url, zmq=self.backend.zmq, ring_words=ring_words,
+            decode_workers=decode_workers, memory_budget=memory_budget,
+            spill_dir=spill_dir, batch=batch)
+        # see writers.write_h5_frame
+        self.layout = layout
+        # h5py runs here, not on the event loop.  When streaming, the
+        # queue is the ring of bunches in flight to the disk
+        self.write_executor = BoundedExecutor(max_workers=1, maxsize=4,
+                                              name='germ-writer')
+
+        super().__init__(fs=fs, journal=journal)
 
         self.acquire_channel = ChannelGeRMAcquire(
             value=0, zclient=self.zclient, parent=self)
+        # seconds from the end of the frame to the file being written
+        self.write_time_channel = ca.ChannelDouble(value=0, precision=3,
+                                                   units='s')
+        # 1 to write bunches while the frame is collected
+        self.stream_channel = ca.ChannelInteger(value=int(stream))
+        # 1 to write the pixel index into each file (not when streaming)
+        self.pixel_index_channel = ca.ChannelInteger(value=int(pixel_index))
+
+        # how full the receive ring is now and at most during the last
+        # frame (percent), and messages that did not fit in it
+        self.ring_occupancy_channel = ca.ChannelDouble(value=0, precision=1,
+                                                       units='%')
+        self.ring_high_water_channel = ca.ChannelDouble(
+            value=0, precision=1, units='%')
+        self.ring_overflows_channel = ca.ChannelInteger(value=0)
+        # the most memory the last frame held (MB), and the events of it
+        # that went to the spill file
+        self.buffer_high_water_channel = ca.ChannelDouble(
+            value=0, precision=1, units='MB')
+        self.spilled_events_channel = ca.ChannelInteger(value=0)
+
+    async def update_buffer_channels(self):
+        zc = self.zclient
+        await self.buffer_high_water_channel.write_from_dbr(
+            zc.high_water / 2**20, ca.ChannelType.DOUBLE, None)
+        await self.spilled_events_channel.write_from_dbr(
+            zc.spilled_events, ca.ChannelType.INT, None)
+        ring = zc.ring
+        if ring is None:
+            return
+        await self.ring_occupancy_channel.write_from_dbr(
+            100 * ring.occupancy, ca.ChannelType.DOUBLE, None)
+        await self.ring_high_water_channel.write_from_dbr(
+            100 * ring.high_water / ring.capacity, ca.ChannelType.DOUBLE,
+            None)
+        await self.ring_overflows_channel.write_from_dbr(
+            ring.overflows, ca.ChannelType.INT, None)
 
 
 class GeRMIOCUDPData(GeRMIOCBase):
-    def __init__(self, zync_url, udp_ctrl_url, fs):
+    _zclient_class = ZClientCurioBase
+    _uclient_class = UClientCurio
+
+    def __init__(self, zync_url, udp_ctrl_url, fs, *, journal=None,
+                 batch=False):
+        zmq = self.backend.zmq
         context = zmq.Context()
 
-        self.zclient = ZClientCurioBase(zync_url, zmq=zmq, context=context)
-        self.udp_client = UClientCurio(udp_ctrl_url, zmq=zmq, context=context)
+        self.zclient = self._zclient_class(zync_url, zmq=zmq, context=context,
+                                           batch=batch)
+        self.udp_client = self._uclient_class(udp_ctrl_url, zmq=zmq,
+                                              context=context)
 
-        super().__init__(fs=fs)
+        super().__init__(fs=fs, journal=journal)
 
         self.acquire_channel = ChannelGeRMAcquireUDP(
             value=0, zclient=self.zclient, uclient=self.udp_client,
@@ -333,6 +784,22 @@ class GeRMIOCUDPData(GeRMIOCBase):
         self.destmount_channel = ca.ChannelString(
             value=b'/', string_encoding='latin-1')
 
+        # frames are copied from the collector to their final home here
+        self.copier = CopyManager(max_workers=2, maxsize=8)
+        # copies queued or running, MB/s of the last one, and the last
+        # error ('' once a copy succeeds again)
+        self.copy_queue_channel = ca.ChannelInteger(value=0)
+        self.copy_rate_channel = ca.ChannelDouble(value=0, precision=1,
+                                                  units='MB/s')
+        self.copy_error_channel = ca.ChannelString(
+            value=b'', string_encoding='latin-1')
+        # 1 to register frames only once copied, 1 for acquire to wait
+        # for the copies to finish
+        self.defer_registration_channel = ca.ChannelInteger(value=0)
+        self.copy_wait_channel = ca.ChannelInteger(value=0)
+        # events in the UDP packets the collector never got, last frame
+        self.lost_events_channel = ca.ChannelInteger(value=0)
+
     def stage(self, *args, **kwargs):
         print("staging")
         super().stage(*args, **kwargs)
@@ -340,6 +807,17 @@ class GeRMIOCUDPData(GeRMIOCBase):
         self.filepath_channel.put(f"{now.year}/{now.month}/{now.day}")
 
 
+class GeRMIOCZMQDataAsyncio(GeRMIOCZMQData):
+    backend = ASYNCIO
+    _zclient_class = ZClientAsyncio
+
+
+class GeRMIOCUDPDataAsyncio(GeRMIOCUDPData):
+    backend = ASYNCIO
+    _zclient_class = ZClientAsyncioBase
+    _uclient_class = UClientAsyncio
+
+
 async def runner(germ):
-    await curio.spawn(germ.zclient.read_forever, daemon=True)
+    await germ.backend.spawn(germ.zclient.read_forever, daemon=True)
     return (await germ.zclient.triggered_frame())
@@ -1,5 +1,7 @@
 import numpy as np
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import threading
+import weakref
 
 CHIP_BITMASK = 0xf
 CHAN_BITMASK = 0x1f
@@ -7,6 +9,191 @@ TD_BITMASK = 0x1ff
 TS_BITMASK = 0x1fffffff
 PD_BITMASK = 0xfff
 
+DATA_TYPES = OrderedDict((('chip', 8),
+                          ('chan', 8),
+                          ('timestamp_fine', 16),
+                          ('energy', 16),
+                          ('timestamp_coarse', 32)))
+
+# build a lookup table of the data types listed in zmq.py
+DATA_TYPEMAP = {name: num for num, name in enumerate(list(DATA_TYPES))}
+
+N_CHIPS = 12
+N_CHANS = 32
+N_PIXELS = N_CHIPS * N_CHANS
+
+# events decoded per pass, sized so the scratch buffer stays in cache
+DECODE_CHUNK = 2**16
+
+# control commands understood by the zmq server, each sent as the
+# 32 bit words (cmd, addr, value).  CMD_DELAY sleeps `value` us and is
+# only used inside a sequence
+CMD_REG_READ = 0
+CMD_REG_WRITE = 1
+CMD_START_DMA = 2
+CMD_DELAY = 3
+# the most commands the server takes in one sequence, it refuses longer
+# ones outright with a single (0xdead, 0xdead, N) reply
+MAX_SEQ = 256
+
+# (word, shift, mask) for each column, in the order of DATA_TYPES
+COLUMN_LAYOUT = OrderedDict((('chip', (0, 27, CHIP_BITMASK)),
+                             ('chan', (0, 22, CHAN_BITMASK)),
+                             ('timestamp_fine', (0, 12, TD_BITMASK)),
+                             ('energy', (0, 0, PD_BITMASK)),
+                             ('timestamp_coarse', (1, 0, TS_BITMASK))))
+
+
+def empty_events(n, columns=None):
+    '''Allocate un-initialized output columns for `decode_events`
+
+    Parameters
+    ----------
+    n : int
+        The number of events
+
+    columns : iterable of str, optional
+        The columns to allocate, defaults to all of `DATA_TYPES`
+
+    Returns
+    -------
+    out : tuple of arrays
+        One array per column using the width from `DATA_TYPES`
+    '''
+    if columns is None:
+        columns = DATA_TYPES
+    return tuple(np.empty(n, dtype=f'uint{DATA_TYPES[k]}') for k in columns)
+
+
+def decode_events(data, out=None, *, columns=None, chunk_size=DECODE_CHUNK):
+    '''Decode raw words into event columns without full-size temporaries
+
+    The words are processed `chunk_size` events at a time, shifting
+    into a single scratch buffer and masking directly into the output
+    columns.
+
+    Parameters
+    ----------
+    data : array
+        The raw 32 bit words, either flat with word1/word2 interleaved
+        or shaped (N, 2).  Any byte order is accepted.
+
+    out : sequence of arrays, optional
+        Where to put the decoded columns, one per entry of `columns`.
+        Each must have length N; values are cast to the dtype of the
+        buffer.  If not given, buffers from `empty_events` are used.
+
+    columns : iterable of str, optional
+        The columns to decode, defaults to all of `DATA_TYPES`
+
+    chunk_size : int, optional
+        The number of events to decode per pass
+
+    Returns
+    -------
+    out : tuple of arrays
+        The decoded columns in the order of `columns`
+    '''
+    data = np.asarray(data)
+    if data.ndim == 1 and len(data) % 2:
+        raise ValueError(f"Expected an even number of words, got {len(data)}")
+    words = data.reshape(-1, 2)
+    n = len(words)
+
+    if columns is None:
+        columns = list(DATA_TYPES)
+    if out is None:
+        out = empty_events(n, columns)
+    out = tuple(out)
+    if len(out) != len(columns):
+        raise ValueError(f"Expected {len(columns)} output buffers, "
+                         f"got {len(out)}")
+    for k, o in zip(columns, out):
+        if len(o) != n:
+            raise ValueError(f"Output buffer for {k!r} has length {len(o)}, "
+                             f"expected {n}")
+
+    layout = [COLUMN_LAYOUT[k] for k in columns]
+    scratch = np.empty(min(chunk_size, n), dtype=np.uint32)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        buf = scratch[:stop - start]
+        for (word, shift, mask), o in zip(layout, out):
+            src = words[start:stop, word]
+            if shift:
+                np.right_shift(src, shift, out=buf)
+                src = buf
+            np.bitwise_and(src, mask, out=o[start:stop], casting='unsafe')
+
+    return out
+
+
+def _is_aligned(words, chunk_size=DECODE_CHUNK):
+    scratch = np.empty(min(chunk_size, len(words)), dtype=np.uint32)
+    for start in range(0, len(words), chunk_size):
+        stop = min(start + chunk_size, len(words))
+        buf = scratch[:stop - start]
+        # word1 must start with "0"
+        np.right_shift(words[start:stop, 0], 31, out=buf)
+        if buf.any():
+            return False
+        # word2 must start with "100" (TS_BITMASK claims the 4th bit)
+        np.right_shift(words[start:stop, 1], 29, out=buf)
+        np.bitwise_xor(buf, 0x4, out=buf)
+        if buf.any():
+            return False
+    return True
+
+
+def validate_payload(data, *, chunk_size=DECODE_CHUNK):
+    '''Check the marker bits and drop words that are out of step
+
+    Every event should be a word1 with a leading "0" followed by a
+    word2 with the leading "100" (the last bit of the documented
+    "1000" marker overlaps `TS_BITMASK`).  If a word has been lost the
+    stream is re-synchronised at the next valid pair, discarding the
+    words that do not belong to one.
+
+    Parameters
+    ----------
+    data : array
+        The raw 32 bit words with word1/word2 interleaved
+
+    chunk_size : int, optional
+        The number of events to check per pass in the common case
+        where the stream is aligned
+
+    Returns
+    -------
+    words : array
+        The valid words.  This is `data` itself if nothing was dropped.
+
+    dropped_words : int
+        The number of words discarded
+
+    dropped_events : int
+        The (estimated) number of events lost, counting half a run of
+        dropped words, rounded up, per run
+    '''
+    data = np.asarray(data)
+    if len(data) % 2 == 0 and _is_aligned(data.reshape(-1, 2), chunk_size):
+        return data, 0, 0
+
+    data = data.ravel()
+    first = (data >> 31) == 0
+    second = (data >> 29) == 0x4
+    # word2 can never look like a word1, so valid pairs never overlap
+    starts = np.flatnonzero(first[:-1] & second[1:])
+    keep = np.zeros(len(data), dtype=bool)
+    keep[starts] = True
+    keep[starts + 1] = True
+
+    edges = np.diff(np.concatenate(([0], ~keep, [0])).astype(np.int8))
+    runs = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+    return data[keep], int(runs.sum()), int(((runs + 1) // 2).sum())
+
+
 def payload2event(data):
     '''Split up the raw data coming over the socket.
 
@@ -18,26 +205,14 @@ def payload2event(data):
        "0" [[4 bit chip addr] [5 bit channel addr]] [10 bit TD] [12 bit PD]
        "1000" [28 bit time stamp]
 
-    '''
+    The columns are uint32 so arithmetic on them (e.g. the pixel id
+    ``chip * 32 + chan``) does not wrap.  `decode_events` and
+    `EventBlock` give the narrow widths from `DATA_TYPES`.
 
-    # TODO sort out if this can be made faster!
-    word1 = data[::2]
-    word2 = data[1::2]
-
-    # chip addr
-    chip = word1 >> 27 & CHIP_BITMASK
-    # chan addr
-    chan = word1 >> 22 & CHAN_BITMASK
-    # fine ts
-    td = word1 >> 12 & TD_BITMASK
-
-    # evergy readings
-    pd = word1 & PD_BITMASK
-
-    # FPGA tick
-    ts = word2 & TS_BITMASK
-
-    return chip, chan, td, pd, ts
+    '''
+    n = np.asarray(data).size // 2
+    return decode_events(
+        data, tuple(np.empty(n, dtype=np.uint32) for _ in DATA_TYPES))
 
 
 def event2payload(chip, chan, td, pd, ts):
@@ -59,6 +234,9 @@ def event2payload(chip, chan, td, pd, ts):
     # insigned little-endian, default
     # 2 words of 32 bit per data
     payload = np.zeros(len(chip)*2, dtype='<u4')
+    # promote the (possibly narrow) decoded columns before shifting
+    chip, chan, td, pd, ts = (np.asarray(v, dtype='<u4')
+                              for v in (chip, chan, td, pd, ts))
     # TODO sort out if this can be made faster!
     # word1 = data[::2]
     # word2 = data[1::2]
@@ -72,14 +250,497 @@ def event2payload(chip, chan, td, pd, ts):
     return payload
 
 
-DATA_TYPES = OrderedDict((('chip', 8),
-                          ('chan', 8),
-                          ('timestamp_fine', 16),
-                          ('energy', 16),
-                          ('timestamp_coarse', 32)))
+def pixel_index(chip, chan):
+    '''Group the events of a frame by pixel
+
+    The pixel id is ``chip * N_CHANS + chan``.
+
+    Parameters
+    ----------
+    chip, chan : array
+        The decoded chip and channel columns
+
+    Returns
+    -------
+    order : array
+        The event indices sorted by pixel, keeping time order within
+        each pixel
+
+    offsets : array
+        The events of pixel ``p`` are ``order[offsets[p]:offsets[p+1]]``.
+        At least ``N_PIXELS + 1`` long.
+    '''
+    pix = np.multiply(chip, N_CHANS, dtype=np.uint16, casting='unsafe')
+    np.add(pix, chan, out=pix, casting='unsafe')
+    counts = np.bincount(pix, minlength=N_PIXELS)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    # a stable sort of 16 bit keys is a radix (counting) sort in numpy
+    order = np.argsort(pix, kind='stable')
+    if len(order) < 2**32:
+        order = order.astype(np.uint32)
+    return order, offsets
+
+
+class TimestampUnwrapper:
+    '''Turn the wrapping coarse FPGA tick into a monotonic 64 bit count
+
+    The state is carried from call to call so a stream can be fed
+    through one message (or frame) at a time.  Any backwards step of
+    more than half the period is taken to be a roll-over, and any
+    forwards step of more than half the period an event from before the
+    last roll-over arriving late.
+
+    Parameters
+    ----------
+    period : int, optional
+        The number of coarse ticks before the counter wraps
+
+    fine_scale : int, optional
+        The number of fine (TD) ticks per coarse tick
+    '''
+    def __init__(self, period=TS_BITMASK + 1, fine_scale=TD_BITMASK + 1):
+        self.period = period
+        self.fine_scale = fine_scale
+        self.reset()
+
+    def reset(self):
+        self.wraps = 0
+        self.last = None
+
+    def unwrap(self, ts):
+        '''Unwrap the next chunk of coarse timestamps
+
+        Parameters
+        ----------
+        ts : array
+            The coarse timestamps as decoded
+
+        Returns
+        -------
+        ticks : array
+            int64 coarse ticks, continuing from the previous call
+        '''
+        out = np.array(ts, dtype=np.int64)
+        if not len(out):
+            return out
+        prev = out[0] if self.last is None else self.last
+        self.last = out[-1]
+
+        steps = np.empty_like(out)
+        steps[0] = out[0] - prev
+        np.subtract(out[1:], out[:-1], out=steps[1:])
+        half = self.period // 2
+        wrapped = (steps < -half).astype(np.int64)
+        wrapped -= steps > half
+        np.cumsum(wrapped, out=steps)
+        steps += self.wraps
+        self.wraps = int(steps[-1])
+
+        steps *= self.period
+        out += steps
+        return out
+
+    def event_time(self, ts, td):
+        '''Combine the coarse and fine timestamps into one time column
+
+        Parameters
+        ----------
+        ts, td : array
+            The coarse and fine timestamps as decoded
+
+        Returns
+        -------
+        time : array
+            int64 time in units of the fine tick
+        '''
+        out = self.unwrap(ts)
+        out *= self.fine_scale
+        out += td
+        return out
+
+
+class EventBlock:
+    '''A block of events backed by the raw words
+
+    The raw words are held without copying and each column is only
+    decoded (and then cached) the first time it is accessed.  Slicing
+    and concatenation re-use the raw words.
+
+    For compatibility with the tuple returned by `payload2event`,
+    integer indexing and iteration give the columns in the order of
+    `DATA_TYPES` (but in its narrow dtypes, promote before doing
+    arithmetic on them).
+
+    Parameters
+    ----------
+    raw : array
+        The raw 32 bit words, either flat with word1/word2 interleaved
+        or shaped (N, 2).
+    '''
+    def __init__(self, raw):
+        raw = np.asarray(raw)
+        if raw.ndim == 1 and len(raw) % 2:
+            raise ValueError(
+                f"Expected an even number of words, got {len(raw)}")
+        raw = raw.reshape(-1, 2)
+        self._segments = [raw] if len(raw) else []
+        self._len = len(raw)
+        self._cache = {}
+
+    @classmethod
+    def _from_segments(cls, segments):
+        block = cls.__new__(cls)
+        block._segments = [s for s in segments if len(s)]
+        block._len = sum(len(s) for s in block._segments)
+        block._cache = {}
+        return block
+
+    @classmethod
+    def concatenate(cls, blocks):
+        '''Join blocks end-to-end without copying the raw words
+
+        The columns already decoded in every block are joined as well,
+        so they are not decoded again.
+        '''
+        blocks = list(blocks)
+        block = cls._from_segments([s for b in blocks for s in b._segments])
+        if blocks:
+            shared = set.intersection(*(set(b._cache) for b in blocks))
+            block._cache = {k: np.concatenate([b._cache[k] for b in blocks])
+                            for k in shared}
+        return block
+
+    @property
+    def segments(self):
+        '''The raw words as a tuple of (N, 2) arrays'''
+        return tuple(self._segments)
+
+    @property
+    def nbytes(self):
+        '''The size of the raw words in bytes'''
+        return sum(s.nbytes for s in self._segments)
+
+    @property
+    def cached_nbytes(self):
+        '''The size of the decoded columns held in bytes'''
+        return sum(v.nbytes for v in self._cache.values())
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for k in DATA_TYPES:
+            yield self[k]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._slice(key)
+        if isinstance(key, (int, np.integer)):
+            key = list(DATA_TYPES)[key]
+        if key not in self._cache:
+            if key not in COLUMN_LAYOUT:
+                raise KeyError(key)
+            self.decode([key])
+        return self._cache[key]
+
+    def decode(self, columns=None):
+        '''Decode several columns in one pass over the raw words
+
+        Parameters
+        ----------
+        columns : iterable of str, optional
+            Defaults to all of `DATA_TYPES`
+
+        Returns
+        -------
+        out : tuple of arrays
+        '''
+        if columns is None:
+            columns = list(DATA_TYPES)
+        todo = [k for k in columns if k not in self._cache]
+        if todo:
+            out = empty_events(self._len, todo)
+            offset = 0
+            for seg in self._segments:
+                n = len(seg)
+                decode_events(seg, [o[offset:offset + n] for o in out],
+                              columns=todo)
+                offset += n
+            self._cache.update(zip(todo, out))
+        return tuple(self._cache[k] for k in columns)
+
+    def release(self, columns=None):
+        '''Drop decoded columns (all by default) from the block
+
+        For when something else (e.g. `handler.FrameCache`) holds on to
+        them, so that they are freed once it lets them go.
+        '''
+        if columns is None:
+            self._cache.clear()
+        for k in columns or ():
+            self._cache.pop(k, None)
+
+    def event_time(self, unwrapper):
+        '''Compute (and cache as 'time') the monotonic event times
+
+        Parameters
+        ----------
+        unwrapper : TimestampUnwrapper
+            Blocks must be passed through in stream order
+        '''
+        if 'time' not in self._cache:
+            self._cache['time'] = unwrapper.event_time(
+                self['timestamp_coarse'], self['timestamp_fine'])
+        return self._cache['time']
+
+    def take(self, indices):
+        '''Gather the events at `indices` into a new block'''
+        indices = np.asarray(indices)
+        block = type(self)(self.raw_words()[indices])
+        block._cache = {k: v[indices] for k, v in self._cache.items()}
+        return block
+
+    def raw_words(self):
+        '''The raw words as one (N, 2) array, copying only if needed'''
+        if len(self._segments) == 1:
+            return self._segments[0]
+        if not self._segments:
+            return np.empty((0, 2), dtype=np.uint32)
+        return np.concatenate(self._segments)
+
+    def _slice(self, key):
+        start, stop, step = key.indices(self._len)
+        if step != 1:
+            raise ValueError("EventBlock only supports contiguous slices")
+        stop = max(start, stop)
+        segments = []
+        offset = 0
+        for seg in self._segments:
+            n = len(seg)
+            lo, hi = max(start - offset, 0), min(stop - offset, n)
+            if lo < hi:
+                segments.append(seg[lo:hi])
+            offset += n
+        block = self._from_segments(segments)
+        block._cache = {k: v[start:stop] for k, v in self._cache.items()}
+        return block
+
+
+class ColumnBuffer:
+    '''A growable 1D array for accumulating a column
+
+    The storage doubles when full, so appending N values costs O(N)
+    copies in total rather than boxing each one into a list.
+
+    Parameters
+    ----------
+    dtype : dtype
+
+    capacity : int, optional
+        The initial number of elements
+    '''
+    def __init__(self, dtype, capacity=2**16):
+        self._buf = np.empty(max(int(capacity), 1), dtype=dtype)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def values(self):
+        '''A view of the values appended so far'''
+        return self._buf[:self._len]
+
+    def append(self, values):
+        '''Append an array of values, growing the storage if needed'''
+        values = np.asarray(values)
+        stop = self._len + len(values)
+        if stop > len(self._buf):
+            buf = np.empty(max(stop, 2 * len(self._buf)),
+                           dtype=self._buf.dtype)
+            buf[:self._len] = self.values
+            self._buf = buf
+        self._buf[self._len:stop] = values
+        self._len = stop
+
+    def clear(self):
+        '''Drop the values, keeping the storage'''
+        self._len = 0
+
+
+class _Lease:
+    # exposes a region of a RawRing to numpy.  Arrays made from it
+    # keep it (and not the ring) as their base, so it is only collected
+    # once nothing refers to the region
+    def __init__(self, buf, start, stop):
+        self._buf = buf
+        self.__array_interface__ = {
+            'data': (buf.ctypes.data + start * buf.itemsize, False),
+            'shape': (stop - start,),
+            'typestr': buf.dtype.str,
+            'version': 3}
+
+
+class RawRing:
+    '''A preallocated ring buffer of raw words
+
+    Messages are copied in once and handed out as views.  A region is
+    returned to the ring when the last array using it is garbage
+    collected, so blocks may be held (e.g. until written to disk) for
+    as long as needed; if the ring is full `put` returns None and the
+    caller keeps its own copy.
+
+    Parameters
+    ----------
+    n_words : int
+        The capacity in 32 bit words
+    '''
+    def __init__(self, n_words):
+        self._buf = np.empty(int(n_words), dtype=np.uint32)
+        # finalizers can run at any allocation, even while it is held
+        self._lock = threading.RLock()
+        # [start, stop, released] of each region, oldest first
+        self._regions = deque()
+        self._head = 0
+        # words in use, the most since the last reset and the messages
+        # that did not fit
+        self.used = 0
+        self.high_water = 0
+        self.overflows = 0
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    @property
+    def occupancy(self):
+        '''The fraction of the ring in use'''
+        return self.used / max(self.capacity, 1)
+
+    def reset_high_water(self):
+        self.high_water = self.used
+
+    def put(self, words):
+        '''Copy `words` into the ring
+
+        Returns
+        -------
+        view : array or None
+            A read-only view of the copy, None if there was no room
+        '''
+        words = np.asarray(words, dtype=np.uint32).ravel()
+        n = len(words)
+        with self._lock:
+            start = self._alloc(n)
+            if start is None:
+                self.overflows += 1
+                return None
+            region = [start, start + n, False]
+            self._regions.append(region)
+            self.used += n
+            self.high_water = max(self.high_water, self.used)
+        self._buf[start:start + n] = words
+        lease = _Lease(self._buf, start, start + n)
+        weakref.finalize(lease, self._release, region)
+        view = np.asarray(lease)
+        view.flags.writeable = False
+        return view
+
+    def _alloc(self, n):
+        if not n:
+            return None
+        if not self._regions:
+            self._head = 0
+        tail = self._regions[0][0] if self._regions else 0
+        if self._head >= tail:
+            # free space is the end of the buffer, then the start
+            if self._head + n <= self.capacity:
+                start = self._head
+            elif n < tail:
+                start = 0
+            else:
+                return None
+        elif self._head + n < tail:
+            start = self._head
+        else:
+            return None
+        self._head = start + n
+        return start
+
+    def _release(self, region):
+        with self._lock:
+            region[2] = True
+            self.used -= region[1] - region[0]
+            # regions are given out in order, so only reclaim from the
+            # oldest one
+            while self._regions and self._regions[0][2]:
+                self._regions.popleft()
+
+
+def encode_sequence(program):
+    '''Build the parts of a multipart control message
+
+    Parameters
+    ----------
+    program : iterable
+        ``(addr, value)`` to write a register or ``(None, seconds)`` to
+        pause, the format of `pygerm.TRIGGER_SETUP_SEQ`
+
+    Returns
+    -------
+    commands : array
+        (N, 3) uint32 of ``(cmd, addr, value)``, one row per part
+
+    Raises
+    ------
+    ValueError
+        If there are more than `MAX_SEQ` commands
+    '''
+    commands = []
+    for addr, value in program:
+        if addr is None:
+            commands.append((CMD_DELAY, 0, int(round(value * 1e6))))
+        else:
+            commands.append((CMD_REG_WRITE, int(addr), int(value)))
+    if len(commands) > MAX_SEQ:
+        raise ValueError(f"A sequence is at most {MAX_SEQ} commands, "
+                         f"got {len(commands)}")
+    return np.array(commands, dtype=np.uint32).reshape(-1, 3)
 
-# build a lookup table of the data types listed in zmq.py
-DATA_TYPEMAP = {name: num for num, name in enumerate(list(DATA_TYPES))}
+
+def check_sequence(commands, reply):
+    '''Check the single reply to a sequence against what was sent
+
+    Every write and delay is echoed back as sent, reads come back with
+    the value filled in.
+
+    Returns
+    -------
+    reply : array
+        (N, 3) uint32
+
+    Raises
+    ------
+    RuntimeError
+        If the reply is the wrong length (or the server refused the
+        sequence) or any echo does not match
+    '''
+    reply = np.frombuffer(reply, dtype=np.uint32)
+    if len(reply) != commands.size:
+        if len(reply) == 3 and reply[0] == reply[1] == 0xdead:
+            raise RuntimeError(f"The server refused a sequence of "
+                               f"{reply[2]} commands")
+        raise RuntimeError(f"Expected {len(commands)} replies, got "
+                           f"{len(reply) // 3}")
+    reply = reply.reshape(-1, 3)
+    compare = commands[:, 0] != CMD_REG_READ
+    bad = np.flatnonzero(compare & (reply != commands).any(axis=1))
+    if len(bad):
+        n = bad[0]
+        raise RuntimeError(f"Command {n} {commands[n].tolist()} came back "
+                           f"as {reply[n].tolist()}")
+    return reply
 
 
 class ZClient:
@@ -92,28 +753,87 @@ class ZClient:
     TOPIC_META = b"meta"
 
     def __init__(self, url, *, zmq, context=None):
+        # only a context made here is terminated by `close`
+        self._own_context = context is None
         if context is None:
             context = zmq.Context()
         self.__context = context
+        self._zmq = zmq
+        self.url = url
         self._data_sock_class = zmq.SUB
         self.data_sock = self.__context.socket(self._data_sock_class)
         self.ctrl_sock = self.__context.socket(zmq.REQ)
         self.udp_ctrl_sock = self.__context.socket(zmq.REQ)
 
-        self.data_sock.connect("{}:{}".format(url, self.ZMQ_DATA_PORT))
+        self._connect_data_sock()
+
+        self.ctrl_sock.connect("{}:{}".format(url, self.ZMQ_CNTL_PORT))
+
+        # running totals of what validate_payload had to throw away
+        self.dropped_words = 0
+        self.dropped_events = 0
+        # if set, a RawRing the data messages are copied into
+        self.ring = None
+
+    def _connect_data_sock(self):
+        # subscribe first so the subscriptions go out with the handshake
+        zmq = self._zmq
         self.data_sock.setsockopt(zmq.SUBSCRIBE, self.TOPIC_DATA)
         self.data_sock.setsockopt(zmq.SUBSCRIBE, self.TOPIC_META)
+        self.data_sock.connect("{}:{}".format(self.url, self.ZMQ_DATA_PORT))
 
-        self.ctrl_sock.connect("{}:{}".format(url, self.ZMQ_CNTL_PORT))
+    def close(self, linger=0):
+        '''Close the sockets (and the context, if it was made here)'''
+        for sock in (self.data_sock, self.ctrl_sock, self.udp_ctrl_sock):
+            sock.close(linger=linger)
+        if self._own_context:
+            self.__context.term()
 
     def parse_message(self, topic, payload):
+        '''Unpack a message
+
+        `payload` may be bytes or a (``copy=False``) zmq frame.  Data
+        is copied into `ring` if there is one and it has space, else it
+        is used in place.
+        '''
+        topic, payload, dropped_words, dropped_events = self.unpack_message(
+            topic, payload)
+        self.count_dropped(dropped_words, dropped_events)
+        return topic, payload
+
+    def unpack_message(self, topic, payload):
+        '''`parse_message` without updating any state
 
+        This is safe to call from worker threads.
+
+        Returns
+        -------
+        topic : bytes
+
+        payload : EventBlock or array
+
+        dropped_words, dropped_events : int
+            See `validate_payload`
+        '''
+        dropped_words = dropped_events = 0
         if topic == self.TOPIC_DATA:
-            payload = payload2event(
-                np.frombuffer(payload, np.uint32))
+            words = np.frombuffer(payload, np.uint32)
+            if self.ring is not None:
+                view = self.ring.put(words)
+                if view is not None:
+                    words = view
+            words, dropped_words, dropped_events = validate_payload(words)
+            payload = EventBlock(words)
         else:
             payload = np.frombuffer(payload, np.uint32)
-        return topic, payload
+        return topic, payload, dropped_words, dropped_events
+
+    def count_dropped(self, dropped_words, dropped_events):
+        if dropped_words:
+            print(f'dropped {dropped_words} words '
+                  f'({dropped_events} events) to resync')
+            self.dropped_words += dropped_words
+            self.dropped_events += dropped_events
 
     def refresh_data_sock(self):
         print('a')
@@ -0,0 +1,20 @@
+'''The curio clients running on asyncio
+
+These are used with ``zmq=zmq.asyncio`` and behave exactly as their
+curio counterparts in `curio_zmq`, which are written against
+`pygerm.backends`.
+'''
+from .curio_zmq import ZClientCurioBase, ZClientCurio, UClientCurio
+from ..backends import ASYNCIO
+
+
+class ZClientAsyncioBase(ZClientCurioBase):
+    backend = ASYNCIO
+
+
+class ZClientAsyncio(ZClientCurio):
+    backend = ASYNCIO
+
+
+class UClientAsyncio(UClientCurio):
+    backend = ASYNCIO
@@ -1,38 +1,195 @@
-from . import ZClient, UClient
+from . import (ZClient, UClient, RawRing, EventBlock,
+               encode_sequence, check_sequence, CMD_REG_READ, CMD_REG_WRITE,
+               MAX_SEQ)
 from .. import TRIGGER_SETUP_SEQ, START_DAQ, STOP_DAQ
+from ..backends import CURIO
+from ..workers import BoundedExecutor
 import numpy as np
-import curio
+import tempfile
+import time
+
+
+# read() with the client's max_age
+_DEFAULT_AGE = object()
+
+
+def _block_nbytes(block):
+    return block.nbytes + block.cached_nbytes
+
+
+def _spill_blocks(fout, blocks):
+    for block in blocks:
+        for seg in block.segments:
+            fout.write(np.ascontiguousarray(seg, dtype=np.uint32).data)
 
 
 class ZClientCurioBase(ZClient):
-    def __init__(self, *args, max_events=None, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.cmd_lock = curio.Lock()
+    '''Control the detector through the zmq server
 
-    async def __cntrl_recv(self):
-        msg = await self.ctrl_sock.recv()
-        return np.frombuffer(msg, dtype=np.uint32)
+    Every register written or read is kept in a shadow so that `read`
+    can usually be answered without going to the server.
 
-    async def __cntrl_send(self, payload):
-        payload = np.asarray(payload, dtype=np.uint32)
-        return (await self.ctrl_sock.send(payload))
+    Parameters
+    ----------
+    batch : bool, optional
+        Send register programs (`setup_frame`, `refresh`) as multipart
+        messages.  Off by default as only a server that understands
+        sequences (germ_zserver1.c from CMD_DELAY on) can answer them
+
+    max_age : float or None, optional
+        Seconds a shadowed value may be served for before `read` goes
+        back to the server; None to trust it until the next write
+
+    The event loop is set by `backend`, see `pygerm.backends`.
+    '''
+    backend = CURIO
+
+    def __init__(self, *args, max_events=None, batch=False, max_age=1.0,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cmd_lock = self.backend.Lock()
+        self.batch = batch
+        # wall-clock time of the last START_DAQ / STOP_DAQ
+        self.start_time = None
+        self.stop_time = None
+        self.max_age = max_age
+        # addr -> (value, time.monotonic() it was known to be right)
+        self.shadow = {}
+        self.hits = 0
+        self.misses = 0
+        # seconds the last command took to come back
+        self.last_latency = 0
+
+    @property
+    def hit_rate(self):
+        '''The fraction of reads served from the shadow'''
+        return self.hits / max(self.hits + self.misses, 1)
 
-    async def read(self, addr):
+    async def _round_trip(self, commands):
+        # send (N, 3) commands as one (multipart) message and unpack
+        # the reply
         async with self.cmd_lock:
-            await self.__cntrl_send([0x0, addr, 0x0])
-            ret = await self.__cntrl_recv()
-            return ret[2]
+            start = time.monotonic()
+            if len(commands) == 1:
+                await self.ctrl_sock.send(commands[0])
+            else:
+                await self.ctrl_sock.send_multipart(list(commands))
+            reply = await self.ctrl_sock.recv()
+            self.last_latency = time.monotonic() - start
+        return reply
+
+    def _record(self, reply):
+        now = time.monotonic()
+        for cmd, addr, value in reply.tolist():
+            if cmd in (CMD_REG_READ, CMD_REG_WRITE):
+                self.shadow[addr] = (value, now)
+
+    async def read(self, addr, max_age=_DEFAULT_AGE):
+        '''Read a register, from the shadow if it is fresh enough
+
+        Parameters
+        ----------
+        max_age : float or None, optional
+            Override `max_age` for this read, 0 to always go to the
+            server
+        '''
+        if max_age is _DEFAULT_AGE:
+            max_age = self.max_age
+        if addr in self.shadow:
+            value, when = self.shadow[addr]
+            if max_age is None or time.monotonic() - when <= max_age:
+                self.hits += 1
+                return np.uint32(value)
+        self.misses += 1
+        commands = np.array([[CMD_REG_READ, addr, 0x0]], dtype=np.uint32)
+        ret = np.frombuffer(await self._round_trip(commands), np.uint32)
+        self._record(ret.reshape(-1, 3))
+        return ret[2]
 
     async def write(self, addr, value):
         print(f'writting addr 0x{addr:x} val {value}')
-        async with self.cmd_lock:
-            await self.__cntrl_send([0x1, addr, value])
-            # bounce the whole message back
-            ret = await self.__cntrl_recv()
-            return ret
+        commands = np.array([[CMD_REG_WRITE, addr, value]], dtype=np.uint32)
+        # bounce the whole message back
+        ret = np.frombuffer(await self._round_trip(commands), np.uint32)
+        self._record(ret.reshape(-1, 3))
+        return ret
+
+    async def refresh(self, addrs=None):
+        '''Re-read registers into the shadow, in one round trip if `batch`
+
+        Parameters
+        ----------
+        addrs : iterable of int, optional
+            Defaults to every register in the shadow
+        '''
+        if addrs is None:
+            addrs = list(self.shadow)
+        if not self.batch:
+            return {int(a): int(await self.read(a, max_age=0))
+                    for a in addrs}
+        commands = np.array([(CMD_REG_READ, a, 0x0) for a in addrs],
+                            dtype=np.uint32).reshape(-1, 3)
+        values = {}
+        for n in range(0, len(commands), MAX_SEQ):
+            part = commands[n:n + MAX_SEQ]
+            reply = check_sequence(part, await self._round_trip(part))
+            self._record(reply)
+            values.update((int(a), int(v)) for _, a, v in reply)
+        return values
+
+    async def execute_sequence(self, program):
+        '''Run a register program in one round trip
+
+        The program is sent as one multipart message, with any delays
+        done by the server, and every echo is checked.
+
+        Parameters
+        ----------
+        program : iterable
+            ``(addr, value)`` writes and ``(None, seconds)`` delays, see
+            `encode_sequence`
+
+        Returns
+        -------
+        reply : array
+            (N, 3) of the echoed ``(cmd, addr, value)``
+        '''
+        commands = encode_sequence(program)
+        if not len(commands):
+            return commands
+        reply = check_sequence(commands, await self._round_trip(commands))
+        self._record(reply)
+        return reply
+
+    async def write_many(self, pairs):
+        '''Write several ``(addr, value)`` in one round trip'''
+        return (await self.execute_sequence(pairs))
+
+    async def setup_frame(self):
+        '''Reset the FPGA and arm it for the next frame'''
+        if self.batch:
+            await self.execute_sequence(TRIGGER_SETUP_SEQ)
+            return
+        for (addr, val) in TRIGGER_SETUP_SEQ:
+            if addr is None:
+                await self.backend.sleep(val)
+            else:
+                await self.write(addr, val)
+
+    async def start_daq(self):
+        ret = await self.write(*START_DAQ)
+        self.start_time = time.time()
+        return ret
+
+    async def stop_daq(self):
+        ret = await self.write(*STOP_DAQ)
+        self.stop_time = time.time()
+        return ret
 
 
 class UClientCurio(UClient):
+    backend = CURIO
+
     async def __cntrl_recv(self):
         return (await self.ctrl_sock.recv())
 
@@ -45,74 +202,218 @@ class UClientCurio(UClient):
 
 
 class ZClientCurio(ZClientCurioBase):
-    def __init__(self, *args, max_events=None, **kwargs):
+    '''Collect frames from the zmq data stream
+
+    Parameters
+    ----------
+    max_events : int, optional
+        Give up on a frame after this many events
+
+    ring_words : int, optional
+        If non-zero, the size (in 32 bit words) of a `RawRing` that
+        data messages are copied into straight from the zmq frame
+
+    decode_workers : int, optional
+        If non-zero, messages are validated and decoded on this many
+        threads (numpy releases the GIL) rather than on the event loop,
+        and put back in order before they are used
+
+    memory_budget : int, optional
+        Bytes of bunches to hold for the frame being collected.  Past
+        this the oldest are written to a temporary file, which is mapped
+        back in as the first bunch of the frame once it is complete.
+
+    spill_dir : str, optional
+        Where to put the temporary files, see `tempfile.TemporaryFile`
+    '''
+    def __init__(self, *args, max_events=None, ring_words=0,
+                 decode_workers=0, memory_budget=None, spill_dir=None,
+                 **kwargs):
         super().__init__(*args, **kwargs)
-        self.acq_done = curio.Condition()
+        self.acq_done = self.backend.Condition()
         self.collecting = False
         self.data_buffer = []
+        # if set, an async callable fed each bunch instead of data_buffer
+        self.sink = None
         self.last_frame = None
         self.overfill = 0
         self.max_events = max_events
+        if ring_words:
+            self.ring = RawRing(ring_words)
+        self.decode_workers = decode_workers
+        self.decode_pool = None
+        if decode_workers:
+            self.decode_pool = BoundedExecutor(
+                max_workers=decode_workers, maxsize=2 * decode_workers,
+                name='germ-decode')
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spill_executor = None
+        if memory_budget is not None:
+            self.spill_executor = BoundedExecutor(max_workers=1, maxsize=4,
+                                                  name='germ-spill')
+        # bytes held for the current frame now and at most, and the
+        # events written out to the spill file
+        self.buffered_bytes = 0
+        self.high_water = 0
+        self.spilled_events = 0
+        self._spill_file = None
+        self._spill_futures = []
 
     async def read_forever(self):
+        if self.decode_pool is not None:
+            return (await self._read_forever_pooled())
         while True:
-            # just read from the zmq socket
-            topic, payload = await self.data_sock.recv_multipart()
+            # just read from the zmq socket, the data is not copied out
+            # of the message (parse_message copies it into the ring)
+            topic, payload = await self.data_sock.recv_multipart(copy=False)
             # if we are not collecting, then bail and read again!
             if not self.collecting:
                 continue
-            # if we are collecting, unpack the payload
-            topic, data = self.parse_message(topic, payload)
-            if topic == self.TOPIC_META:
-                self.last_frame, self.overfill = data
-
-                # if we saw a frame meta, we are done
-                async with self.acq_done:
-                    await self.acq_done.notify_all()
-            elif topic == self.TOPIC_DATA:
-                # if just data update the internal state
-                self.data_buffer.append(data)
-                new_ev = len(data[0])
-                self.total_events += new_ev
+            await self._handle(*self.parse_message(topic.bytes, payload))
+
+    async def _read_forever_pooled(self):
+        # the messages go to the pool in order, and their futures into
+        # this queue, so awaiting them in turn restores the order
+        backend = self.backend
+        decoded = backend.Queue(maxsize=4 * self.decode_workers)
+        assembler = await backend.spawn(self._assemble, decoded, daemon=True)
+        try:
+            while True:
+                topic, payload = await self.data_sock.recv_multipart(
+                    copy=False)
+                if not self.collecting:
+                    continue
+                await decoded.put(await backend.submit(
+                    self.decode_pool, self._decode, topic.bytes, payload))
+        finally:
+            await backend.cancel(assembler)
+
+    def _decode(self, topic, payload):
+        topic, data, *dropped = self.unpack_message(topic, payload)
+        if topic == self.TOPIC_DATA:
+            data.decode()
+        return (topic, data, *dropped)
+
+    async def _assemble(self, decoded):
+        while True:
+            fut = await decoded.get()
+            topic, data, *dropped = await self.backend.wait_future(fut)
+            self.count_dropped(*dropped)
+            await self._handle(topic, data)
+
+    async def _handle(self, topic, data):
+        if topic == self.TOPIC_META:
+            self.last_frame, self.overfill = data
+
+            # if we saw a frame meta, we are done
+            async with self.acq_done:
+                await self.backend.notify_all(self.acq_done)
+        elif topic == self.TOPIC_DATA:
+            # if just data update the internal state
+            if self.sink is not None:
+                await self.sink(data)
             else:
-                raise RuntimeError("should never get here")
-            # if we have seen more than the maximum number of events
-            if (self.max_events is not None and
-                    self.total_events > self.max_events):
-                # set the last frame to `None` (because we are now out
-                # of sync!)
-                self.last_frame = None
-                # and report that we are done
-                async with self.acq_done:
-                    await self.acq_done.notify_all()
-
-    async def trigger_frame(self):
-        self.data_buffer.clear()
+                self.data_buffer.append(data)
+                self.buffered_bytes += _block_nbytes(data)
+                self.high_water = max(self.high_water, self.buffered_bytes)
+                if (self.memory_budget is not None and
+                        self.buffered_bytes > self.memory_budget):
+                    await self._spill()
+            new_ev = len(data)
+            self.total_events += new_ev
+        else:
+            raise RuntimeError("should never get here")
+        # if we have seen more than the maximum number of events
+        if (self.max_events is not None and
+                self.total_events > self.max_events):
+            # set the last frame to `None` (because we are now out
+            # of sync!)
+            self.last_frame = None
+            # and report that we are done
+            async with self.acq_done:
+                await self.backend.notify_all(self.acq_done)
+
+    async def _spill(self):
+        # move the oldest bunches out until back under half the budget
+        n = 0
+        while (n < len(self.data_buffer) and
+               self.buffered_bytes > self.memory_budget // 2):
+            self.buffered_bytes -= _block_nbytes(self.data_buffer[n])
+            n += 1
+        blocks, self.data_buffer = self.data_buffer[:n], self.data_buffer[n:]
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        self.spilled_events += sum(len(b) for b in blocks)
+        # the executor is FIFO so the file stays in order
+        self._spill_futures.append(await self.backend.submit(
+            self.spill_executor, _spill_blocks, self._spill_file, blocks))
+
+    async def _merge_spill(self):
+        # put what was spilled back at the front of the frame
+        fout, self._spill_file = self._spill_file, None
+        futures, self._spill_futures = self._spill_futures, []
+        try:
+            await self.backend.wait_future(futures[-1])
+            for fut in futures:
+                fut.result()
+            fout.flush()
+            # the mapping outlives the (already unlinked) file
+            words = np.memmap(fout, dtype=np.uint32, mode='r')
+        finally:
+            fout.close()
+        self.data_buffer.insert(0, EventBlock(words))
+
+    async def trigger_frame(self, sink=None):
+        # a new list, the last frame may still be being written out
+        self.data_buffer = []
+        self.sink = sink
         self.total_events = 0
+        self.buffered_bytes = 0
+        self.high_water = 0
+        self.spilled_events = 0
+        if self._spill_file is not None:
+            # left over from a frame that never finished
+            self._spill_file.close()
+            self._spill_file = None
+            self._spill_futures = []
+        if self.ring is not None:
+            self.ring.reset_high_water()
         self.collecting = True
 
         async with self.acq_done:
             await self.acq_done.wait()
             self.collecting = False
+            self.sink = None
+        if self._spill_file is not None:
+            await self._merge_spill()
 
-    async def read_frame(self):
-        await self.trigger_frame()
+    async def read_frame(self, sink=None):
+        await self.trigger_frame(sink=sink)
         return (self.last_frame, self.total_events,
                 self.data_buffer, self.overfill)
 
-    async def triggered_frame(self):
+    async def triggered_frame(self, sink=None, armed=False):
+        '''Set up, start, collect and stop one frame
+
+        Parameters
+        ----------
+        sink : coroutine function, optional
+            If given it is awaited with each bunch as it arrives and
+            the returned data list is empty
+
+        armed : bool, optional
+            `setup_frame` was already done for this frame
+        '''
         zc = self
-        for (addr, val) in TRIGGER_SETUP_SEQ:
-            if addr is None:
-                await curio.sleep(val)
-            else:
-                await zc.write(addr, val)
+        if not armed:
+            await zc.setup_frame()
 
-        await zc.write(*START_DAQ)
+        await zc.start_daq()
         # cal pulse for debugging sometimes
         # await zc.write(0x10, 0xfff)
         # await zc.write(0x10, 0x0)
-        fr_num, ev_count, data, overfill = await zc.read_frame()
-        await zc.write(*STOP_DAQ)
+        fr_num, ev_count, data, overfill = await zc.read_frame(sink=sink)
+        await zc.stop_daq()
 
         return fr_num, ev_count, data, overfill
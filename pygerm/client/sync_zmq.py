@@ -1,17 +1,119 @@
-from . import ZClient, parse_event_payload
+from . import (ZClient, ColumnBuffer, DATA_TYPES, encode_sequence,
+               check_sequence)
+from .. import TRIGGER_SETUP_SEQ, START_DAQ, STOP_DAQ
+import contextlib
 import numpy as np
-import datetime
+import time
+import zmq
+from zmq.utils.monitor import recv_monitor_message
 
 
 class ZClientWriter(ZClient):
     '''Synchronous class for accessing the ZMQ server that writes data files
 
-    This is to maintain MARS_DAQ gui
+    This is to maintain MARS_DAQ gui.  It is meant to be made once and
+    reused for every trigger, and can be used as a context manager to
+    close the sockets when done.
 
+    Parameters
+    ----------
+    connect_str : str
+        The server, as ``'tcp://host'``
+
+    context : zmq.Context, optional
+        Share a context instead of making one
+
+    rcvhwm : int, optional
+        Messages the data socket may queue, 0 for no limit so nothing
+        is dropped while waiting to be read
+
+    prewarm : float, optional
+        Seconds to wait for the data socket to connect (see `prewarm`),
+        0 to not wait
+
+    batch : bool, optional
+        Send `setup_frame` as one multipart message, see
+        `ZClientCurioBase`
     '''
-    def __init__(self, connect_str):
-        import zmq
-        super().__init__(connect_str, zmq=zmq)
+    def __init__(self, connect_str, *, context=None, rcvhwm=0, prewarm=1.0,
+                 batch=False):
+        self._rcvhwm = rcvhwm
+        self.batch = batch
+        self._monitor = None
+        self.last_frame = self.overfill = None
+        self.stats = {}
+        super().__init__(connect_str, zmq=zmq, context=context)
+        if prewarm:
+            self.prewarm(prewarm)
+
+    def _connect_data_sock(self):
+        # these only apply to connections made after they are set
+        self.data_sock.setsockopt(zmq.RCVHWM, self._rcvhwm)
+        self._monitor = self.data_sock.get_monitor_socket(
+            getattr(zmq, 'EVENT_HANDSHAKE_SUCCEEDED', zmq.EVENT_CONNECTED))
+        super()._connect_data_sock()
+
+    def prewarm(self, timeout=1.0, settle=0.05):
+        '''Wait until the data socket is connected and subscribed
+
+        A SUB socket drops whatever is published before its
+        subscriptions reach the server, which would lose the start of
+        the first frame.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for the connection
+
+        settle : float, optional
+            Seconds to allow the subscriptions to be processed
+
+        Returns
+        -------
+        connected : bool
+        '''
+        if self._monitor is None:
+            return True
+        connected = bool(self._monitor.poll(timeout * 1000))
+        if connected:
+            recv_monitor_message(self._monitor)
+            self._close_monitor()
+            time.sleep(settle)
+        else:
+            print(f'data socket did not connect in {timeout}s')
+        return connected
+
+    def _close_monitor(self):
+        if self._monitor is not None:
+            self.data_sock.disable_monitor()
+            self._monitor.close(linger=0)
+            self._monitor = None
+
+    def drain(self):
+        '''Throw away anything left on the data socket
+
+        Returns
+        -------
+        n : int
+            The number of messages discarded
+        '''
+        n = 0
+        while True:
+            try:
+                self.data_sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return n
+            n += 1
+
+    def close(self, linger=0):
+        self._close_monitor()
+        super().close(linger=linger)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def __cntrl_recv(self):
         msg = self.ctrl_sock.recv()
@@ -29,62 +131,146 @@ class ZClientWriter(ZClient):
         self.__cntrl_send([0x0, int(addr), 0x0])
         return int(self.__cntrl_recv()[2])
 
+    def execute_sequence(self, program):
+        '''Run a register program in one round trip
+
+        See `ZClientCurioBase.execute_sequence`
+        '''
+        commands = encode_sequence(program)
+        if not len(commands):
+            return commands
+        self.ctrl_sock.send_multipart(list(commands))
+        return check_sequence(commands, self.ctrl_sock.recv())
+
+    def write_many(self, pairs):
+        '''Write several ``(addr, value)`` in one round trip'''
+        return self.execute_sequence(pairs)
+
+    def setup_frame(self):
+        '''Reset the FPGA and arm it for the next frame'''
+        if self.batch:
+            self.execute_sequence(TRIGGER_SETUP_SEQ)
+            return
+        for (addr, val) in TRIGGER_SETUP_SEQ:
+            if addr is None:
+                time.sleep(val)
+            else:
+                self.write(addr, val)
+
+    def triggered_frame(self, chkdata=0, **kwargs):
+        '''Set up, start, collect (see `get_data`) and stop one frame'''
+        # a stale meta from an earlier frame would end this one early
+        self.drain()
+        self.setup_frame()
+        self.write(*START_DAQ)
+        try:
+            return self.get_data(chkdata, **kwargs)
+        finally:
+            self.write(*STOP_DAQ)
+
     def set_trigdaq(self, value):
         self.write(0x00, value)
         # print("Trigger DAQ")
 
-    def get_data(self, chkdata):
-        self.nbr = 0
-        totallen = 0
-        pd = []
-        td = []
-        addr = []
-        start = datetime.datetime.now()
-
-        print("In Get Data")
-        with open('data_4.bin', 'wb') as fd:
-            while True:
-                [address, msg] = self.data_sock.recv_multipart()
-
-                if msg == b'END':
-                    print("Received %s messages" % str(self.nbr))
-                    print("Message END received")
+    def iter_blocks(self, fout=None, max_messages=None):
+        '''Yield the data messages of a frame as they arrive
+
+        Stops at the frame's meta message (or ``END``), which sets
+        `last_frame` and `overfill`.  `stats` is updated when the
+        generator finishes.
+
+        Parameters
+        ----------
+        fout : file, optional
+            The raw messages are written to this binary file as they
+            are received
+
+        max_messages : int, optional
+            Stop after this many data messages
+
+        Yields
+        ------
+        block : EventBlock
+        '''
+        n_messages = n_events = n_bytes = 0
+        start = time.monotonic()
+        try:
+            while max_messages is None or n_messages < max_messages:
+                topic, msg = self.data_sock.recv_multipart(copy=False)
+                topic = topic.bytes
+                if len(msg) == 3 and msg.bytes == b'END':
                     break
-                if (address == self.TOPIC_META):
-                    print("Meta data received")
-                    meta_data = np.frombuffer(msg, dtype=np.uint32)
-                    print(meta_data)
-                    np.savetxt("meta.txt", meta_data, fmt="%x")
+                if topic == self.TOPIC_META:
+                    meta = np.frombuffer(msg, dtype=np.uint32)
+                    self.last_frame, self.overfill = (int(v)
+                                                      for v in meta[:2])
                     break
-                if (address == self.TOPIC_DATA):
-                    print("Event data received")
-                    data = np.frombuffer(msg, dtype=np.uint64)
-                    fd.write(data)
-                    # counting number of words, getting words out as one
-                    # 64bit number
-                    totallen = totallen + len(data) * 2
-                    print("Msg Num: %d, Msg len: %d, Tot len: %d" % (
-                        self.nbr, len(data) * 2, totallen))
-
-                    _chip, _chan, _td, _pd, _ = parse_event_payload(data)
-
-                    pd.extend(_pd)
-                    td.extend(_td)
-                    addr.extend((_chan << 5) + _chip)
-
-                    if self.nbr > 5000:
-                        break
-                    self.nbr += 1
-
-        stop = datetime.datetime.now()
-
-        elapsed = stop - start
-        sec = elapsed.seconds + elapsed.microseconds*1.0e-6
-        print("Processing time:", elapsed, sec)
-
-        print("Total Size: %d (%d bytes)" % (totallen * 2, totallen * 8))
-        bitrate = (totallen*2) / sec
-        print('Received %d messages at %f MBps' % (self.nbr, bitrate))
-        print('Received %d events at %f ev/s' % (len(pd), len(pd) / sec))
-
-        return totallen, bitrate, pd, td, addr
+                if topic != self.TOPIC_DATA:
+                    continue
+                if fout is not None:
+                    fout.write(msg.buffer)
+                _, block = self.parse_message(topic, msg)
+                n_messages += 1
+                n_events += len(block)
+                n_bytes += len(msg)
+                yield block
+        finally:
+            elapsed = max(time.monotonic() - start, 1e-9)
+            self.stats = {'messages': n_messages,
+                          'events': n_events,
+                          'bytes': n_bytes,
+                          'elapsed': elapsed,
+                          'events_per_sec': n_events / elapsed,
+                          'bytes_per_sec': n_bytes / elapsed}
+
+    def get_data(self, chkdata=0, *, fname=None, max_messages=None):
+        '''Collect a frame into arrays for the MARS_DAQ gui
+
+        Parameters
+        ----------
+        chkdata : int
+            Unused, kept for compatibility
+
+        fname : str, optional
+            Write the raw messages to this file
+
+        max_messages : int, optional
+            Stop after this many data messages
+
+        Returns
+        -------
+        totallen : int
+            The number of words received
+
+        bitrate : float
+            Bytes received per second
+
+        pd, td : array
+            The energy and fine timestamp of each event
+
+        addr : array
+            ``(chan << 5) + chip`` of each event
+        '''
+        pd = ColumnBuffer(f"uint{DATA_TYPES['energy']}")
+        td = ColumnBuffer(f"uint{DATA_TYPES['timestamp_fine']}")
+        addr = ColumnBuffer(np.uint16)
+        with contextlib.ExitStack() as stack:
+            fout = (stack.enter_context(open(fname, 'wb'))
+                    if fname is not None else None)
+            for block in self.iter_blocks(fout, max_messages):
+                chip, chan, _td, _pd = block.decode(
+                    ['chip', 'chan', 'timestamp_fine', 'energy'])
+                pd.append(_pd)
+                td.append(_td)
+                _addr = chan.astype(np.uint16)
+                _addr <<= 5
+                _addr += chip
+                addr.append(_addr)
+
+        stats = self.stats
+        print(f"Received {stats['messages']} messages, "
+              f"{stats['events']} events in {stats['elapsed']:.3f}s "
+              f"({stats['events_per_sec']:.0f} ev/s, "
+              f"{stats['bytes_per_sec'] / 1e6:.1f} MB/s)")
+        return (stats['bytes'] // 4, stats['bytes_per_sec'],
+                pd.values, td.values, addr.values)
@@ -0,0 +1,624 @@
+'''Collect frames from the FPGA's UDP data stream into files
+
+This does what ``src/germ_udpsrvr.c`` does, and is what `UClient` and
+`GeRMIOCUDPData` talk to on port 5557.  Each datagram is a 32 bit
+(big endian) packet counter followed by the body; the first body of a
+frame starts with ``0xfeedface`` and the frame number and the last one
+ends with the overflow count and ``0xdecafbad``.  The counter carries on
+from frame to frame (wrapping at 32 bits), so a frame's packets are
+counted from its first.  The file written is the bodies in counter
+order, less any that were lost (see `loss_path`).
+'''
+import json
+import socket
+import struct
+import time
+
+import numpy as np
+import zmq
+
+
+GIGE_KEY = 0xdeadbeef
+REG_ACCESS_OKAY = 0x4f6b6179
+REGISTER_WRITE_PORT = 0x7D00
+REGISTER_RX_PORT = 0x7D02
+DATA_PORT = 0x7D03
+
+SOF_MARKER = 0xfeedface
+EOF_MARKER = 0xdecafbad
+# words in the body of every packet but the last
+PACKET_WORDS = 1022
+COUNTER_BYTES = 4
+COUNTER_MASK = 0xffffffff
+# the largest datagram taken, as the C collector
+MAX_PACKET = 8192
+
+_SOF = struct.pack('!I', SOF_MARKER)
+_EOF = struct.pack('!I', EOF_MARKER)
+# the packet counter and the first word of the body
+_HEAD = struct.Struct('!II')
+
+
+def loss_path(fpath):
+    '''The path of the packet loss sidecar for a frame file'''
+    return f'{fpath}.loss.json'
+
+
+def _runs(bits, value):
+    # [start, stop) of each run of `value` in a 0/1 array
+    edges = np.diff(np.concatenate([[1 - value], bits, [1 - value]])
+                    .astype(np.int8))
+    starts = np.flatnonzero(edges == (1 if value else -1))
+    stops = np.flatnonzero(edges == (-1 if value else 1))
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def packetize(words, frame, overfill=0, counter=0):
+    '''Split a frame into the datagrams the FPGA sends
+
+    Parameters
+    ----------
+    words : array
+        The event words of the frame
+
+    frame : int
+        The frame number
+
+    overfill : int, optional
+        The events lost to overflow
+
+    counter : int, optional
+        The packet counter of the first datagram
+
+    Returns
+    -------
+    packets : list of bytes
+    '''
+    body = np.concatenate([[SOF_MARKER, frame], np.asarray(words),
+                           [overfill, EOF_MARKER]]).astype('>u4')
+    return [struct.pack('!I', (counter + n) & COUNTER_MASK) +
+            body[start:start + PACKET_WORDS].tobytes()
+            for n, start in enumerate(range(0, len(body), PACKET_WORDS))]
+
+
+class UDPCollector:
+    '''Receive frames over UDP and write each to a file on request
+
+    Each datagram is received straight into the buffer at the slot after
+    the newest packet, its counter landing on (and then being swapped
+    back out of) the end of the previous body, so packets that arrive in
+    order are never copied.  The counters are tracked in a bitmap.
+    As in ``gige_data_recv``, packets are placed by their counter less
+    that of the start of the frame: the packet ``k`` on from it belongs
+    ``k`` bodies into the frame, so one that arrives out of order is
+    moved to its slot (those before the start are held until it
+    comes), duplicates and strays
+    are dropped, and whatever is still missing when the frame is written
+    is left out (a lost first packet's header is written in its place).
+    Every body is a whole number of events, so the events stay aligned
+    across the gaps; they are listed in the sidecar from `loss_path`.
+
+    A frame bigger than the buffer is written out as it comes in,
+    holding back the last `window` packets so that late ones can still
+    be put in place.
+
+    Parameters
+    ----------
+    fpga_host : str, optional
+        Where to send the register write enabling the data stream, see
+        `arm`
+    ctrl_url : str, optional
+        The zmq REP address for the filename handshake
+    data_addr : tuple, optional
+        The (host, port) to receive the datagrams on
+    buffer_bytes : int, optional
+        The size of the receive buffer
+    rcvbuf : int, optional
+        The kernel's socket buffer to ask for, which is all that covers
+        for the time spent writing files and talking to the IOC
+    write_chunk : int, optional
+        Bytes per write
+    window : int, optional
+        How many packets out of order one may arrive
+    frame_timeout : float, optional
+        Seconds without a packet (counted from the IOC's ack) before a
+        frame is given up on, one that never ended is closed off with a
+        footer
+    settle : float, optional
+        Seconds to wait for missing packets once the end is seen
+    live : LiveSpectrum, optional
+        Fed the events as they arrive, see `pygerm.live`
+    live_packets : int, optional
+        Packets between feeding `live`
+    '''
+    def __init__(self, fpga_host='127.0.0.1', *, ctrl_url='tcp://*:5557',
+                 data_addr=('0.0.0.0', DATA_PORT), buffer_bytes=2**30,
+                 rcvbuf=2**28, write_chunk=2**22, window=64,
+                 frame_timeout=5, settle=0.05, live=None, live_packets=256,
+                 context=None):
+        if buffer_bytes < 2 * (window + 2) * MAX_PACKET:
+            raise ValueError(f"{buffer_bytes} bytes can not hold a window "
+                             f"of {window} packets")
+        self.fpga_host = fpga_host
+        self.write_chunk = write_chunk
+        self.window = window
+        self.frame_timeout = frame_timeout
+        self.settle = settle
+        self.live = live
+        self.live_packets = live_packets
+        # COUNTER_BYTES of head room for the first packet's counter
+        self._buf = bytearray(COUNTER_BYTES + buffer_bytes + MAX_PACKET)
+        self._view = memoryview(self._buf)
+        # for moves that may overlap
+        self._arr = np.frombuffer(self._buf, dtype=np.uint8)
+        self._limit = len(self._buf) - MAX_PACKET
+
+        self.data_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.data_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  rcvbuf)
+        got = self.data_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if got < rcvbuf:
+            print(f'socket buffer is {got} bytes, raise net.core.rmem_max '
+                  'to avoid dropped packets')
+        self.data_sock.bind(data_addr)
+
+        self._own_context = context is None
+        self._context = zmq.Context() if context is None else context
+        self.ctrl_sock = self._context.socket(zmq.REP)
+        self.ctrl_sock.bind(ctrl_url)
+
+        self._fout = None
+        # for a frame whose start is lost
+        self._next_frame = 0
+        self._next_counter = None
+        self._reset()
+
+    def _reset(self):
+        if self._fout is not None:
+            # from a frame that was restarted
+            self._fout.close()
+        self.frame = None
+        self.sof_lost = False
+        self.overfill = 0
+        self.nbytes = 0
+        self.packets = 0
+        self.path = None
+        self.elapsed = 0
+        # packets that came after their slot was written out, too far
+        # ahead (or past the end), twice, or were the wrong size
+        self.late = 0
+        self.strays = 0
+        self.duplicates = 0
+        self.malformed = 0
+        # [start, stop) packet ranges never received, and if the end
+        # of the frame was
+        self.missing = []
+        self.truncated = False
+        self._fout = None
+        self._seen = bytearray(1024)
+        # packets before _base are written out, _top is one past the
+        # newest, and _last (if the end was seen) is the last
+        self._base = self._top = 0
+        self._last = None
+        self._last_len = 0
+        self._packet_bytes = 4 * PACKET_WORDS
+        # packets before _fed (that were received) have gone to `live`
+        self._fed = 0
+
+    @property
+    def count(self):
+        '''The events in the last frame'''
+        # with the header and footer written in place of lost ones
+        words = (self.nbytes // 4 + (2 if self.truncated else 0) +
+                 (2 if self.sof_lost else 0))
+        return (words - 4) // 2
+
+    @property
+    def lost_events(self):
+        '''The events in the packets missing from the last frame'''
+        # the first packet's header takes an event's worth of words
+        head = int(bool(self.missing) and self.missing[0][0] == 0)
+        return (sum(b - a for a, b in self.missing) *
+                self._packet_bytes // 8 - head)
+
+    def arm(self, enable=True, timeout=3):
+        '''Turn the FPGA's UDP data stream on (or off)
+
+        Returns
+        -------
+        ok : bool
+            If the FPGA acknowledged the write
+        '''
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(('0.0.0.0', REGISTER_RX_PORT))
+            sock.settimeout(timeout)
+            sock.sendto(struct.pack('!III', GIGE_KEY, 1, int(enable)),
+                        (self.fpga_host, REGISTER_WRITE_PORT))
+            try:
+                reply = sock.recv(64)
+            except socket.timeout:
+                print(f'no reply from {self.fpga_host}')
+                return False
+        return struct.unpack_from('!xxxxI', reply)[0] == REG_ACCESS_OKAY
+
+    def receive(self, base):
+        '''Receive one frame
+
+        Packets are put in place as they come, counted from the start
+        of the frame.  Until it comes (up to `window` packets late) the
+        others are held aside; if it is lost, the frame is taken to
+        start where the last one ended, or at 0.  Ones more than
+        `window` past the newest, or past the end, are dropped as
+        strays, which throws away the tail of any earlier frame.
+
+        Parameters
+        ----------
+        base : str
+            The file is ``f'{base}_{frame:03d}.bin'``, only opened here
+            if the frame does not fit in the buffer
+
+        Returns
+        -------
+        frame, count, overfill : int
+        '''
+        self._reset()
+        self._name = base
+        buf = self._buf
+        view = self._view
+        sock = self.data_sock
+        # the IOC has started the frame, see `serve_once`
+        sock.settimeout(self.frame_timeout)
+        recv_into = sock.recv_into
+        unpack = _HEAD.unpack_from
+        limit = self._limit
+        window = self.window
+        seen = self._seen
+        live = self.live
+        live_packets = self.live_packets if live is not None else 2**63
+        next_feed = live_packets
+        if live is not None:
+            live.start(None)
+        pb = self._packet_bytes
+        base = top = packets = nbytes = 0
+        last = None
+        pos = COUNTER_BYTES
+        start = None
+        # the counter of the start of the frame, the datagrams that came
+        # before it (oldest first), and those to go through again
+        # (newest first)
+        origin = None
+        early = []
+        replay = []
+        timed_out = False
+        while True:
+            if pos > limit:
+                base = self._spill(base, max(base, top - window), top)
+                pos = COUNTER_BYTES + (top - base) * pb
+            # the counter goes over the last word of the previous body
+            saved = buf[pos - COUNTER_BYTES:pos]
+            if replay:
+                packet = replay.pop()
+                n = len(packet)
+                buf[pos - COUNTER_BYTES:pos - COUNTER_BYTES + n] = packet
+            else:
+                try:
+                    if timed_out:
+                        raise socket.timeout
+                    n = recv_into(view[pos - COUNTER_BYTES:], MAX_PACKET)
+                except socket.timeout:
+                    if early:
+                        # the start never came, place what did
+                        origin = self._guess_origin(early)
+                        replay, early = early[::-1], []
+                        timed_out = True
+                        continue
+                    if last is None:
+                        print(f'frame {self.frame} timed out before its end')
+                        self.truncated = True
+                    break
+            k, word = unpack(buf, pos - COUNTER_BYTES)
+            if origin is None and word != SOF_MARKER:
+                early.append(bytes(buf[pos - COUNTER_BYTES:pos + n -
+                                       COUNTER_BYTES]))
+                buf[pos - COUNTER_BYTES:pos] = saved
+                if len(early) > window:
+                    # the start is lost, place them as best we can
+                    origin = self._guess_origin(early)
+                    replay, early = early[::-1], []
+                continue
+            buf[pos - COUNTER_BYTES:pos] = saved
+            n -= COUNTER_BYTES
+            if start is None:
+                start = time.monotonic()
+            if origin is None:
+                origin = k
+                # the ones that came first go in after it
+                replay, early = early[::-1], []
+            elif (word == SOF_MARKER and seen[0] & 1 and
+                    struct.unpack_from('!I', buf, pos + 4)[0] != self.frame):
+                print('start of frame before the end of the last')
+                # restart the frame at the front of the buffer
+                if pos != COUNTER_BYTES:
+                    buf[COUNTER_BYTES:COUNTER_BYTES + n] = buf[pos:pos + n]
+                pos = COUNTER_BYTES
+                self._reset()
+                seen = self._seen
+                base = top = packets = nbytes = 0
+                next_feed = live_packets
+                last = None
+                start = time.monotonic()
+                origin = k
+                if live is not None:
+                    live.start(None)
+            k = (k - origin) & COUNTER_MASK
+
+            eof = buf[pos + n - 4:pos + n] == _EOF
+            refeed = False
+            if k != top or last is not None or (n != pb and not eof):
+                if self._misplaced(k, n, pos, base, top, eof):
+                    continue
+                base = self._base
+                # it missed being fed with its neighbours
+                refeed = k < self._fed
+            if k >> 3 >= len(seen):
+                seen.extend(bytes(len(seen) + (k >> 3)))
+            seen[k >> 3] |= 1 << (k & 7)
+            packets += 1
+            nbytes += n
+            if not k and word == SOF_MARKER:
+                self.frame, = struct.unpack_from(
+                    '!I', buf, COUNTER_BYTES - base * pb + 4)
+                if live is not None:
+                    live.frame = self.frame
+            if k >= top:
+                top = k + 1
+                pos = COUNTER_BYTES + (top - base) * pb
+            if eof:
+                if top > k + 1:
+                    # strays that came before the end
+                    dropped = self._drop_strays(k + 1, top)
+                    packets -= dropped
+                    nbytes -= dropped * pb
+                    top = k + 1
+                    pos = COUNTER_BYTES + (top - base) * pb
+                self._last = last = k
+                self._last_len = n
+                self.overfill, = struct.unpack_from(
+                    '!I', buf, COUNTER_BYTES + (k - base) * pb + n - 8)
+            if refeed:
+                self._feed(base, k, k + 1)
+            elif packets >= next_feed:
+                next_feed = packets + live_packets
+                self._feed(base, self._fed, top)
+                self._fed = top
+                live.poll()
+            if last is not None:
+                if packets == last + 1:
+                    break
+                # only wait a little for the stragglers
+                sock.settimeout(self.settle)
+        sock.settimeout(None)
+        self.elapsed = 0 if start is None else time.monotonic() - start
+        self.packets, self.nbytes = packets, nbytes
+        self._base, self._top = base, top
+        if origin is not None:
+            self._next_counter = (origin + top) & COUNTER_MASK
+
+        bits = np.unpackbits(np.frombuffer(seen, dtype=np.uint8),
+                             bitorder='little')[:top]
+        self.missing = _runs(bits, 0)
+        self.sof_lost = not seen[0] & 1
+        if self.frame is None:
+            print('the start of the frame was lost')
+            self.frame = self._next_frame
+            if live is not None:
+                live.frame = self.frame
+        self._next_frame = self.frame + 1
+        if live is not None:
+            self._feed(base, self._fed, top)
+            self._fed = top
+            live.publish(final=True, lost_events=self.lost_events)
+        print(f'frame {self.frame}: {self.packets} packets, '
+              f'{self.nbytes / 1e6:.2f} MB at '
+              f'{self.nbytes / 1e6 / max(self.elapsed, 1e-9):.1f} MB/s')
+        if self.missing or self.truncated:
+            print(f'frame {self.frame}: lost {self.lost_events} events in '
+                  f'{len(self.missing)} gaps'
+                  f'{", never ended" if self.truncated else ""}')
+        return self.frame, self.count, self.overfill
+
+    def _guess_origin(self, early):
+        # the counter of a lost start of frame: where the last frame
+        # ended, else 0 (counting from each frame), if either is within
+        # `window` before the packets that came; else the first of them
+        first = min(_HEAD.unpack_from(p)[0] for p in early)
+        for origin in (self._next_counter, 0):
+            if (origin is not None and
+                    (first - origin) & COUNTER_MASK <= self.window):
+                return origin
+        return first
+
+    def _misplaced(self, k, n, pos, base, top, eof):
+        # a packet that is not simply the next one: returns True if it
+        # is to be dropped, else moves it to its slot (which may need
+        # `_base` to move on)
+        self._base = base
+        last = self._last
+        if k < base:
+            self.late += 1
+            return True
+        if k > top + self.window or (last is not None and k > last):
+            self.strays += 1
+            return True
+        seen = self._seen
+        if k >> 3 < len(seen) and seen[k >> 3] >> (k & 7) & 1:
+            self.duplicates += 1
+            return True
+        pb = self._packet_bytes
+        if (n != pb and not eof) or n > pb:
+            self.malformed += 1
+            return True
+        if k != top:
+            data = self._buf[pos:pos + n]
+            dest = COUNTER_BYTES + (k - base) * pb
+            if dest + n > len(self._buf):
+                # write out what can no longer be filled in
+                self._base = base = self._spill(
+                    base, max(base, k - self.window), top)
+                dest = COUNTER_BYTES + (k - base) * pb
+            self._buf[dest:dest + n] = data
+        return False
+
+    def _drop_strays(self, start, stop):
+        # forget the packets received in [start, stop), returning how
+        # many there were
+        seen = self._seen
+        dropped = 0
+        for k in range(start, stop):
+            if seen[k >> 3] >> (k & 7) & 1:
+                seen[k >> 3] &= ~(1 << (k & 7)) & 0xff
+                dropped += 1
+        self.strays += dropped
+        return dropped
+
+    def _spill(self, base, upto, top):
+        # write out the packets before `upto` and move the rest to the
+        # front of the buffer, returning the new base
+        pb = self._packet_bytes
+        if self.live is not None:
+            # before any are written out
+            self._feed(base, self._fed, top)
+            self._fed = top
+        self._write_packets(base, min(upto, top))
+        if upto < top:
+            start = COUNTER_BYTES + (upto - base) * pb
+            stop = min(COUNTER_BYTES + (top - base) * pb + MAX_PACKET,
+                       len(self._buf))
+            arr = self._arr
+            arr[COUNTER_BYTES:COUNTER_BYTES + stop - start] = arr[start:stop]
+        return upto
+
+    def _write_packets(self, base, stop):
+        # write the packets received in [base, stop), in runs
+        if self._fout is None:
+            frame = self._next_frame if self.frame is None else self.frame
+            self.path = f'{self._name}_{frame:03d}.bin'
+            self._fout = open(self.path, 'wb', buffering=0)
+            if base == 0 and not self._seen[0] & 1:
+                # the first packet never came, it can not now
+                self._fout.write(struct.pack('!II', SOF_MARKER, frame))
+        if self._last is not None:
+            # nothing goes after the end
+            stop = min(stop, self._last + 1)
+        view = self._view
+        for _, _, begin, end in self._spans(base, base, stop):
+            for chunk in range(begin, end, self.write_chunk):
+                self._fout.write(
+                    view[chunk:min(chunk + self.write_chunk, end)])
+
+    def _feed(self, base, start, stop):
+        # pass the events of the packets received in [start, stop) to
+        # `live`, less the header and footer
+        arr = self._arr
+        for a, b, begin, end in self._spans(base, start, stop):
+            if a == 0:
+                begin += 8
+            if b - 1 == self._last:
+                end -= 8
+            self.live.add(arr[begin:end].view('>u4'))
+
+    def _spans(self, base, start, stop):
+        # (first, stop, begin, end) for each run of packets received in
+        # [start, stop): the packets, then their bytes in the buffer
+        if stop <= start:
+            return
+        pb = self._packet_bytes
+        lo = start >> 3
+        seen = np.frombuffer(self._seen, dtype=np.uint8)[lo:(stop + 7) >> 3]
+        bits = np.unpackbits(seen, bitorder='little')[start - 8 * lo:
+                                                      stop - 8 * lo]
+        del seen
+        for a, b in _runs(bits, 1):
+            a += start
+            b += start
+            begin = COUNTER_BYTES + (a - base) * pb
+            end = COUNTER_BYTES + (b - 1 - base) * pb + (
+                self._last_len if b - 1 == self._last else pb)
+            yield a, b, begin, end
+
+    def loss_report(self):
+        '''What was lost from the last frame, as written to the sidecar'''
+        pb = self._packet_bytes
+        gaps = []
+        received = 0
+        prev = 0
+        for a, b in self.missing:
+            received += a - prev
+            prev = b
+            # the events in the file before the gap, less the header
+            # (which is written in place of a lost first packet)
+            gaps.append([received * pb // 8 - 1 + self.sof_lost,
+                         (b - a) * pb // 8 - (a == 0)])
+        return {'frame': self.frame,
+                'packet_words': pb // 4,
+                'packets': self.packets,
+                'missing': [list(r) for r in self.missing],
+                'gaps': gaps,
+                'lost_events': self.lost_events,
+                'truncated': self.truncated,
+                'sof_lost': self.sof_lost,
+                'late': self.late,
+                'strays': self.strays,
+                'duplicates': self.duplicates,
+                'malformed': self.malformed}
+
+    def write(self):
+        '''Write the frame from `receive`, returning the path
+
+        If anything was lost it is described in the `loss_path` sidecar.
+        '''
+        start = time.monotonic()
+        try:
+            self._write_packets(self._base, self._top)
+            if self.truncated:
+                self._fout.write(struct.pack('!II', 0, EOF_MARKER))
+        finally:
+            if self._fout is not None:
+                self._fout.close()
+                self._fout = None
+        if self.missing or self.truncated:
+            with open(loss_path(self.path), 'w') as fout:
+                json.dump(self.loss_report(), fout)
+        print(f'wrote {self.path} in {time.monotonic() - start:.3f}s')
+        return self.path
+
+    def serve_once(self):
+        '''Collect one frame for the IOC (see `ChannelGeRMAcquireUDP`)
+
+        1. filename -> ``b'Received Filename'``
+        2. ack, once the IOC has started the frame ->
+           ``struct.pack('QQQQ', frame, count, overfill, lost)``
+           where ``lost`` is the events in packets that never arrived
+        3. ack -> the path written
+
+        The frame is received between the ack and the reply, so that
+        it is given up on `frame_timeout` after it should have started.
+        '''
+        base = self.ctrl_sock.recv().decode()
+        self.ctrl_sock.send(b'Received Filename')
+        # the packets wait in the socket buffer until this
+        self.ctrl_sock.recv()
+        meta = self.receive(base)
+        self.ctrl_sock.send(struct.pack('QQQQ', *meta, self.lost_events))
+        self.ctrl_sock.recv()
+        self.ctrl_sock.send(self.write().encode())
+
+    def serve_forever(self):
+        while True:
+            self.serve_once()
+
+    def close(self):
+        self.data_sock.close()
+        self.ctrl_sock.close(linger=0)
+        if self._own_context:
+            self._context.term()
@@ -1,50 +1,371 @@
+from collections import OrderedDict
 from databroker.assets.handlers_base import HandlerBase
 import h5py
+import json
 import numpy as np
+import os
+import tempfile
+import threading
+import zipfile
 
-from .client import payload2event, DATA_TYPEMAP
+from .client import (EventBlock, TimestampUnwrapper, validate_payload,
+                     pixel_index)
+from .collector import loss_path
 
 
-class GeRMHandler(HandlerBase):
+class FrameCache:
+    '''A process-wide LRU cache of decoded columns
+
+    Entries are keyed on (path, mtime, column, ...) so a re-written
+    file is never served stale.  Cached arrays are made read-only as
+    they are shared between all readers.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The budget for the cached arrays, least recently used entries
+        are dropped to stay under it
+    '''
+    def __init__(self, max_bytes=2**30):
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._evict()
+
+    @staticmethod
+    def key(fpath, column, *extra):
+        fpath = os.path.abspath(fpath)
+        return (fpath, os.stat(fpath).st_mtime_ns, column) + extra
+
+    def fetch(self, key, compute):
+        '''Return the cached value for `key`, calling `compute` on a miss'''
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = compute()
+        value.setflags(write=False)
+        with self._lock:
+            if key not in self._data and value.nbytes <= self._max_bytes:
+                self._data[key] = value
+                self.nbytes += value.nbytes
+                self._evict()
+        return value
+
+    def get(self, key):
+        '''The cached value for `key`, or None (not counted as a miss)'''
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def invalidate(self, fpath=None):
+        '''Drop the entries for `fpath`, or everything if not given'''
+        if fpath is not None:
+            fpath = os.path.abspath(fpath)
+        with self._lock:
+            for key in list(self._data):
+                if fpath is None or key[0] == fpath:
+                    self.nbytes -= self._data.pop(key).nbytes
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes:
+            _, value = self._data.popitem(last=False)
+            self.nbytes -= value.nbytes
+
+
+frame_cache = FrameCache()
+
+
+def _decode_column(block, column):
+    # the FrameCache keeps (and budgets for) the decoded columns, so
+    # the block the handler holds must not keep them as well
+    value = block[column]
+    block.release([column])
+    return value
+
+
+def index_path(fpath):
+    '''The path of the pixel index sidecar for a frame file'''
+    return f'{fpath}.pidx.npz'
+
+
+def write_pixel_index(fpath, chip, chan):
+    '''Build the pixel index of a frame and write it next to the file
+
+    Returns
+    -------
+    order, offsets : array
+        As from `pixel_index`
+    '''
+    order, offsets = pixel_index(chip, chan)
+    path = index_path(fpath)
+    # written aside and moved into place, so no reader sees it half done
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.savez(fout, order=order, offsets=offsets)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return order, offsets
+
+
+class PixelIndexMixin:
+    '''Per-pixel access to a frame through a (cached) pixel index
+
+    The index is taken from the frame file itself if it was written
+    with one, else from the sidecar from `index_path` if it is newer
+    than the frame, else it is built from the chip / chan columns and
+    the sidecar is written (if the directory is writable).
+
+    Sub-classes provide `_embedded_index` and `_take`.
+    '''
+    def pixel_index(self):
+        '''The (order, offsets) pixel index, see `client.pixel_index`'''
+        try:
+            return (self.cache.fetch(
+                        self.cache.key(self._fpath, 'pixel_order'),
+                        lambda: self._load_index()[0]),
+                    self.cache.fetch(
+                        self.cache.key(self._fpath, 'pixel_offsets'),
+                        lambda: self._load_index()[1]))
+        finally:
+            # only held while both are fetched, after that the cache
+            # decides how long they live
+            self._index = None
+
+    def pixel_counts(self):
+        '''The number of events per pixel'''
+        return np.diff(self.pixel_index()[1])
+
+    def pixel_events(self, pixel, column='energy'):
+        '''The values of `column` for the events of one pixel'''
+        order, offsets = self.pixel_index()
+        return self._take(column, order[offsets[pixel]:offsets[pixel + 1]])
+
+    def _load_index(self):
+        index = getattr(self, '_index', None)
+        if index is not None:
+            return index
+        index = self._embedded_index()
+        if index is None:
+            sidecar = index_path(self._fpath)
+            try:
+                fresh = (os.stat(sidecar).st_mtime_ns >=
+                         os.stat(self._fpath).st_mtime_ns)
+            except FileNotFoundError:
+                fresh = False
+            if fresh:
+                try:
+                    with np.load(sidecar) as fin:
+                        index = fin['order'], fin['offsets']
+                except (OSError, EOFError, ValueError, KeyError,
+                        zipfile.BadZipFile) as e:
+                    print(f'rebuilding the pixel index, {sidecar}: {e}')
+                    fresh = False
+            if not fresh:
+                chip, chan = self('chip'), self('chan')
+                try:
+                    index = write_pixel_index(self._fpath, chip, chan)
+                except OSError:
+                    index = pixel_index(chip, chan)
+        self._index = index
+        return index
+
+
+class GeRMHandler(PixelIndexMixin, HandlerBase):
     specs = {'GeRM'}
+    cache = frame_cache
 
     def __init__(self, fpath):
-        self._file = h5py.File(fpath, 'r')
-        self._g = self._file['GeRM']
+        self._fpath = fpath
+        self._file = None
+        self._data = None
+
+    @property
+    def _g(self):
+        # only opened on a cache miss
+        if self._file is None:
+            self._file = h5py.File(self._fpath, 'r')
+        return self._file['GeRM']
+
+    def __call__(self, column, start=None, stop=None):
+        return self.cache.fetch(
+            self.cache.key(self._fpath, column, start, stop),
+            lambda: self._read(column, start, stop))
+
+    @property
+    def data(self):
+        '''The events of a 'raw' layout file, see `writers.write_h5_frame`'''
+        if self._data is None:
+            self._data = EventBlock(self._g['raw'][:])
+        return self._data
 
-    def __call__(self, column):
-        return self._g[column][:]
+    def _read(self, column, start, stop):
+        if column == 'time':
+            if start is not None or stop is not None:
+                # unwrap from the start of the frame, not of the slice
+                return self('time')[start:stop].copy()
+            # each file is a frame, so the unwrapping starts fresh
+            return TimestampUnwrapper().event_time(
+                self('timestamp_coarse'), self('timestamp_fine'))
+        if 'raw' in self._g:
+            if start is None and stop is None:
+                return _decode_column(self.data, column)
+            return EventBlock(self._g['raw'][start:stop])[column]
+        return self._g[column][start:stop]
+
+    def _embedded_index(self):
+        if 'pixel_offsets' in self._g:
+            return self._g['pixel_order'][:], self._g['pixel_offsets'][:]
+
+    def _take(self, column, indices):
+        if column == 'time':
+            return self('time')[indices]
+        raw = 'raw' in self._g
+        dset = self._g['raw' if raw else column]
+        # the indices of one pixel are increasing, as h5py requires
+        values = dset[indices] if len(indices) else dset[:0]
+        return EventBlock(values)[column] if raw else values
 
     def close(self):
-        self._file.close()
+        self._data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
-class BinaryGeRMHandler(HandlerBase):
+class BinaryGeRMHandler(PixelIndexMixin, HandlerBase):
     specs = {'BinaryGeRM'}
+    cache = frame_cache
 
     def __init__(self, fpath):
-        # TODO : don't save the raw data (here for debugging)
-        raw_data = np.fromfile(fpath, dtype='>u4')
+        self._fpath = fpath
+        # only mapped (and checked) on a cache miss
+        self._mapped = None
+        self._data = None
+        self.dropped_words = None
+        self.dropped_events = None
+
+    @property
+    def _raw(self):
+        if self._mapped is not None:
+            return self._mapped
+        # map rather than read the file, nothing is paged in until a
+        # column is asked for
+        raw = np.memmap(self._fpath, dtype='>u4', mode='r')
         # TODO : when simulated data comes in, verify this is correct
         # endianness and correct for it, don't just raise error
-        first_word = raw_data[0]
+        first_word = raw[0]
         if first_word != 0xfeedface:
             msg = "Error, first 32 bit word not 0xfeedface"
             msg += f"\n Got {first_word:#x} instead"
             raise ValueError(msg)
 
-        last_word = raw_data[-1]
+        last_word = raw[-1]
         if last_word != 0xdecafbad:
             msg = "Error, first 32 bit word not 0xdecafbad"
             msg += f"\n Got {last_word:#x} instead"
             raise ValueError(msg)
+        self._mapped = raw
+        return raw
+
+    @property
+    def data(self):
+        '''The validated events, decoded as the columns are asked for'''
+        if self._data is None:
+            # remove first and last region
+            raw_data, self.dropped_words, self.dropped_events = (
+                validate_payload(self._raw[2:-2]))
+            self._data = EventBlock(raw_data)
+            # so that later handlers know if they can read in place
+            self.cache.fetch(
+                self.cache.key(self._fpath, 'dropped'),
+                lambda: np.array([self.dropped_words, self.dropped_events]))
+        return self._data
+
+    def __call__(self, column, start=None, stop=None):
+        return self.cache.fetch(
+            self.cache.key(self._fpath, column, start, stop),
+            lambda: self._read(column, start, stop))
+
+    def _read(self, column, start, stop):
+        if column == 'time':
+            if start is not None or stop is not None:
+                # unwrap from the start of the frame, not of the slice
+                return self('time')[start:stop].copy()
+            # each file is a frame, so the unwrapping starts fresh
+            return TimestampUnwrapper().event_time(
+                self('timestamp_coarse'), self('timestamp_fine'))
+        if start is None and stop is None:
+            return _decode_column(self.data, column)
+        # only the words in the window are read and decoded
+        block = self._in_place(slice(start, stop))
+        if block is None:
+            block = self.data[start:stop]
+        return block[column]
+
+    def _in_place(self, index):
+        '''The events at `index` straight from the mapped words
+
+        Event i is word pair i of the body only if validating the frame
+        dropped nothing, so this is None (go through the validated
+        `data`) unless an earlier validation of the frame, kept in the
+        cache, found it clean.  Also None if `data` is already loaded.
+        '''
+        if self._data is not None:
+            return None
+        dropped = self.cache.get(self.cache.key(self._fpath, 'dropped'))
+        if dropped is None or dropped[0]:
+            return None
+        return EventBlock(self._raw[2:-2].reshape(-1, 2)[index])
+
+    def loss(self):
+        '''The UDP packets lost from the frame, or None if it is whole
+
+        See `pygerm.collector.UDPCollector.loss_report`.
+        '''
+        try:
+            with open(loss_path(self._fpath)) as fin:
+                return json.load(fin)
+        except FileNotFoundError:
+            return None
 
-        # remove first and last region
-        raw_data = raw_data[2:-2]
-        self.data = payload2event(raw_data)
+    def _embedded_index(self):
+        return None
 
-    def __call__(self, column):
-        return self.data[DATA_TYPEMAP[column]]
+    def _take(self, column, indices):
+        if column == 'time':
+            return self('time')[indices]
+        # only the words of the selected events are read and decoded
+        block = self._in_place(np.asarray(indices, dtype=np.intp))
+        if block is None:
+            block = self.data.take(indices)
+        return block[column]
 
     def close(self):
-        self._file.close()
+        self._data = None
+        self._mapped = None
@@ -0,0 +1,201 @@
+'''Bin events into a spectrum while a frame is still coming in
+
+`LiveSpectrum` is fed raw event words (by `UDPCollector` as packets
+arrive) and publishes the running energy vs pixel spectrum on a zmq PUB
+socket, so a long exposure can be judged before it is written, copied
+and read back.  `recv_spectrum` is the other end.
+'''
+import json
+import time
+
+import numpy as np
+import zmq
+
+from .client import (ColumnBuffer, decode_events, N_CHANS, N_PIXELS,
+                     CHIP_BITMASK, CHAN_BITMASK, PD_BITMASK)
+
+# every pixel id the words can hold, the ones past N_PIXELS are junk
+_N_IDS = (CHIP_BITMASK + 1) * (CHAN_BITMASK + 1)
+
+
+def recv_spectrum(sock, flags=0):
+    '''Receive a spectrum published by `LiveSpectrum`
+
+    Parameters
+    ----------
+    sock : zmq.Socket
+        A SUB socket subscribed to ``b'spectrum'``
+
+    flags : int, optional
+        Passed to ``recv_multipart``
+
+    Returns
+    -------
+    header : dict
+        ``frame``, ``events`` binned, ``elapsed`` seconds since the
+        frame started, ``final`` and, once final, ``lost_events``
+
+    bin_edges : array
+        The energy / ADU bin edges (including the right most edge)
+
+    spectrum : array
+        Shaped (len(bin_edges) - 1, 12*32), as from `bin_frame`
+    '''
+    _, header, edges, spectrum = sock.recv_multipart(flags)
+    header = json.loads(header)
+    bin_edges = np.frombuffer(edges, dtype=np.float64)
+    spectrum = np.frombuffer(spectrum, dtype=np.int64).reshape(
+        len(bin_edges) - 1, N_PIXELS)
+    return header, bin_edges, spectrum
+
+
+class LiveSpectrum:
+    '''A running energy vs pixel spectrum of the frame in progress
+
+    The words passed to `add` are decoded at once but only reduced to
+    their bins; the counts are summed into the spectrum when it is
+    asked for (or the backlog gets big), so feeding it often is cheap.
+
+    Parameters
+    ----------
+    bins : int or sequence, optional
+        As for `bin_frame`
+
+    corr_mat : array, optional
+        As for `bin_frame`
+
+    url : str, optional
+        Where to bind the PUB socket, if None nothing is published and
+        the spectrum is only available as `spectrum`
+
+    interval : float, optional
+        The least seconds between publishing partial spectra
+
+    context : zmq.Context, optional
+
+    backlog : int, optional
+        The events to hold before summing them into the spectrum
+    '''
+    def __init__(self, bins=1024, corr_mat=None, *, url=None, interval=1,
+                 context=None, backlog=2**22):
+        if np.isscalar(bins):
+            if corr_mat is not None:
+                bin_edges = np.linspace(0, 70, bins+1)
+            else:
+                bin_edges = np.linspace(0, 4095, bins+1)
+        else:
+            bin_edges = bins
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.nbins = nbins = len(self.bin_edges) - 1
+        self.interval = interval
+        self.backlog = backlog
+
+        if corr_mat is None:
+            # the energy is 12 bits, so look the bin of each value up
+            pd = np.arange(PD_BITMASK + 1)
+            self._lut = self._bin(pd).astype(np.uint32) * _N_IDS
+            self._corr = None
+        else:
+            corr = np.zeros((2, _N_IDS))
+            corr[:, :N_PIXELS] = corr_mat
+            self._corr = corr
+
+        # a row past the last bin for everything out of range
+        self._counts = np.zeros((nbins + 1) * _N_IDS, dtype=np.int64)
+        self._pending = ColumnBuffer(np.uint32, backlog)
+        self._scratch = None
+
+        self.sock = None
+        if url is not None:
+            self._own_context = context is None
+            self._context = zmq.Context() if context is None else context
+            self.sock = self._context.socket(zmq.PUB)
+            self.sock.bind(url)
+        self.start(None)
+
+    def _bin(self, energy):
+        # the bin of each energy, nbins if out of range.  The right
+        # most edge is in the last bin as with np.histogram
+        idx = np.searchsorted(self.bin_edges, energy, side='right') - 1
+        idx[energy == self.bin_edges[-1]] = self.nbins - 1
+        idx[(idx < 0) | (idx >= self.nbins)] = self.nbins
+        return idx
+
+    def start(self, frame):
+        '''Start over for a new frame'''
+        self.frame = frame
+        self.events = 0
+        self._counts[:] = 0
+        self._pending.clear()
+        self._start = time.monotonic()
+        self._published = self._start
+
+    def add(self, words):
+        '''Bin raw event words (word1/word2 interleaved, any byte order)'''
+        n = len(words) // 2
+        if not n:
+            return
+        if self._scratch is None or len(self._scratch[0]) < n:
+            self._scratch = tuple(np.empty(max(n, 2**16), dtype=np.uint32)
+                                  for _ in range(3))
+        chip, chan, pd = decode_events(
+            words, tuple(s[:n] for s in self._scratch),
+            columns=('chip', 'chan', 'energy'))
+        pixel = np.multiply(chip, N_CHANS, out=chip)
+        pixel |= chan
+        if self._corr is None:
+            flat = np.take(self._lut, pd, out=pd)
+        else:
+            flat = self._bin(pd * self._corr[0, pixel] +
+                             self._corr[1, pixel]).astype(np.uint32)
+            flat *= _N_IDS
+        flat += pixel
+        self._pending.append(flat)
+        self.events += n
+        if len(self._pending) >= self.backlog:
+            self._reduce()
+
+    def _reduce(self):
+        pending = self._pending.values
+        if len(pending):
+            self._counts += np.bincount(pending, minlength=len(self._counts))
+            self._pending.clear()
+
+    @property
+    def spectrum(self):
+        '''The counts so far, shaped (len(bin_edges) - 1, 12*32)'''
+        self._reduce()
+        return self._counts.reshape(-1, _N_IDS)[:self.nbins, :N_PIXELS]
+
+    def poll(self):
+        '''Publish the partial spectrum if `interval` has passed'''
+        if time.monotonic() - self._published >= self.interval:
+            self.publish()
+
+    def publish(self, final=False, **kwargs):
+        '''Publish the spectrum so far
+
+        Parameters
+        ----------
+        final : bool, optional
+            If the frame is over
+
+        kwargs
+            Added to the header
+        '''
+        now = time.monotonic()
+        self._published = now
+        if self.sock is None:
+            return
+        header = dict(frame=self.frame, events=self.events,
+                      elapsed=now - self._start, final=final, **kwargs)
+        self.sock.send_multipart(
+            [b'spectrum', json.dumps(header).encode(),
+             self.bin_edges.tobytes(),
+             np.ascontiguousarray(self.spectrum).tobytes()])
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close(linger=0)
+            if self._own_context:
+                self._context.term()
@@ -21,6 +21,11 @@ class GeRM(Device):
     acquire = Cpt(EpicsSignal, ':acquire', put_complete=True)
     # exposure per frame
     frametime = Cpt(EpicsSignal, ':frametime', put_complete=True)
+    # triggers in a sequence (e.g. the num of a count), the detector is
+    # armed for the next while the last is written; and the idle time
+    # between two frames
+    num_images = Cpt(EpicsSignal, ':num_images', put_complete=True)
+    dead_time = Cpt(EpicsSignalRO, ':dead_time')
     # data path
     filepath = Cpt(EpicsSignal, ':filepath',
                    string=True, put_complete=True)
@@ -39,13 +44,34 @@ class GeRM(Device):
     td = Cpt(GeRMSRO, ':UUID:TD', string=True)
     pd = Cpt(GeRMSRO, ':UUID:PD', string=True)
     ts = Cpt(GeRMSRO, ':UUID:TS', string=True)
+    # extra datums ``f'{uid}/{n}'`` covering `datum_chunk` events each
+    datum_chunk = Cpt(EpicsSignal, ':datum_chunk', put_complete=True)
+    datum_chunks = Cpt(EpicsSignalRO, ':datum_chunks')
+    registry_latency = Cpt(EpicsSignalRO, ':registry_latency')
+    registry_pending = Cpt(EpicsSignalRO, ':registry_pending')
+    # the IOC's shadow of the Zync registers
+    reg_hit_rate = Cpt(EpicsSignalRO, ':reg_hit_rate')
+    reg_latency = Cpt(EpicsSignalRO, ':reg_latency')
+    reg_refresh = Cpt(EpicsSignal, ':reg_refresh', put_complete=True)
 
     def trigger(self):
         return self.acquire.set(1)
 
+    def stop(self, *, success=False):
+        # ends a sequence cut short, so the next trigger arms afresh
+        self.acquire.put(0)
+        super().stop(success=success)
+
 
 class GeRMUDP(GeRM):
     write_root = Cpt(EpicsSignal, ':write_root', put_complete=True)
     read_root = Cpt(EpicsSignal, ':read_root', put_complete=True)
     src_mount = Cpt(EpicsSignal, ':src_mount', put_complete=True)
     dest_mount = Cpt(EpicsSignal, ':dest_mount', put_complete=True)
+
+    copy_queue = Cpt(EpicsSignalRO, ':copy_queue')
+    copy_rate = Cpt(EpicsSignalRO, ':copy_rate')
+    copy_error = Cpt(EpicsSignalRO, ':copy_error', string=True)
+    defer_registration = Cpt(EpicsSignal, ':defer_registration')
+    copy_wait = Cpt(EpicsSignal, ':copy_wait')
+    lost_events = Cpt(EpicsSignalRO, ':lost_events')
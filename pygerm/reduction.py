@@ -5,6 +5,8 @@ from skimage.filters import threshold_otsu
 from skimage.transform import (hough_line, hough_line_peaks,
                                probabilistic_hough_line)
 
+from .client import TimestampUnwrapper, N_PIXELS
+
 
 def bin_frame(data, bins, corr_mat=None):
     """Bin a single GeRM frame to Energy/ADU vs channel spectrum
@@ -51,7 +53,8 @@ def bin_frame(data, bins, corr_mat=None):
 
     for (chip, chan), group in (df.groupby(('germ_chip', 'germ_chan'))):
         gpd = group['germ_pd'].values
-        i = int(chip*32+chan)
+        # the columns may be narrow, so this must not be done in them
+        i = int(chip)*32 + int(chan)
         if corr_mat is not None:
             gpd *= corr_mat[0, i]
             gpd += corr_mat[1, i]
@@ -60,6 +63,87 @@ def bin_frame(data, bins, corr_mat=None):
     return spectrum, bin_edges
 
 
+def bin_pixels(energy, offsets, bins, corr_mat=None):
+    """Bin a frame that is already grouped by pixel
+
+    This is `bin_frame` without the group-by, for use with the pixel
+    index the handlers provide (``handler.pixel_index()``).
+
+    Parameters
+    ----------
+    energy : array
+        The energy column in pixel order, i.e. ``energy[order]``
+
+    offsets : array
+        The pixel offsets from the index
+
+    bins : int or sequence
+        As for `bin_frame`
+
+    corr_mat : array, optional
+        As for `bin_frame`
+
+    Returns
+    -------
+    spectrum : array
+        This will be shaped (len(bin_edges) - 1, 12*32)
+
+    bin_edges : array
+        The energy / ADU bin edges (including the right most edge)
+
+    """
+    if np.isscalar(bins):
+        if corr_mat is not None:
+            bin_edges = np.linspace(0, 70, bins+1)
+        else:
+            bin_edges = np.linspace(0, 4095, bins+1)
+    else:
+        bin_edges = bins
+
+    spectrum = np.zeros((len(bin_edges) - 1, N_PIXELS))
+    for i in range(N_PIXELS):
+        gpd = energy[offsets[i]:offsets[i+1]]
+        if not len(gpd):
+            continue
+        if corr_mat is not None:
+            gpd = gpd * corr_mat[0, i] + corr_mat[1, i]
+        spectrum[:, i] = np.histogram(gpd, bins=bin_edges)[0]
+
+    return spectrum, bin_edges
+
+
+def event_rate(data, bins, unwrapper=None):
+    """Histogram the events of a frame in time
+
+    Parameters
+    ----------
+    data : dict
+        must have the keys {'germ_ts', 'germ_td'}
+
+    bins : int or sequence
+        Passed through to `np.histogram`, in units of the fine tick
+        from the start of the frame
+
+    unwrapper : TimestampUnwrapper, optional
+        Pass the same unwrapper for successive frames to keep the time
+        axis continuous, otherwise each frame starts fresh
+
+    Returns
+    -------
+    counts : array
+
+    bin_edges : array
+        The time bin edges (including the right most edge)
+
+    """
+    if unwrapper is None:
+        unwrapper = TimestampUnwrapper()
+    t = unwrapper.event_time(data['germ_ts'], data['germ_td'])
+    if len(t):
+        t -= t[0]
+    return np.histogram(t, bins=bins)
+
+
 def select_energy_band(spectrum, energy_bins, lo, hi):
     lo_ind, hi_ind = energy_bins.searchsorted([lo, hi])
     return spectrum[lo_ind:hi_ind].sum(axis=0)
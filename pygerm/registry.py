@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from .workers import BoundedExecutor
+
+
+def chunk_datums(column, dset_uid, ev_count, chunk):
+    '''The datums for consecutive `chunk` event slices of a column
+
+    The datum ids are ``f'{dset_uid}/{n}'`` so they can be found from
+    the datum of the whole column.
+
+    Returns
+    -------
+    datums : list of (str, dict)
+        ``(datum_id, datum_kwargs)``, empty if the frame fits in a chunk
+    '''
+    if chunk <= 0 or ev_count <= chunk:
+        return []
+    return [(f'{dset_uid}/{n}',
+             {'column': column,
+              'start': start,
+              'stop': min(start + chunk, ev_count)})
+            for n, start in enumerate(range(0, ev_count, chunk))]
+
+
+class RegistrationJournal:
+    '''A write-ahead log of frames waiting to be registered
+
+    Each registration is appended (and synced) before it is sent to the
+    registry and marked done once it is in, so nothing is lost if the
+    registry or the IOC goes down in between.  The file is emptied
+    whenever nothing is outstanding.
+
+    Parameters
+    ----------
+    path : str
+        The journal file, created if needed
+    '''
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._pending = {e['uid']: e for e in self._read()}
+
+    def _read(self):
+        pending = {}
+        try:
+            with open(self.path) as fin:
+                for line in fin:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # a torn last line from a crash mid-write
+                        continue
+                    if rec['op'] == 'pending':
+                        pending[rec['entry']['uid']] = rec['entry']
+                    else:
+                        pending.pop(rec['uid'], None)
+        except FileNotFoundError:
+            pass
+        return list(pending.values())
+
+    def _write(self, rec):
+        with open(self.path, 'a') as fout:
+            fout.write(json.dumps(rec) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    def pending(self):
+        '''The entries not yet marked done, oldest first'''
+        with self._lock:
+            return list(self._pending.values())
+
+    def __len__(self):
+        return len(self._pending)
+
+    def append(self, entry):
+        with self._lock:
+            self._write({'op': 'pending', 'entry': entry})
+            self._pending[entry['uid']] = entry
+
+    def done(self, uid):
+        with self._lock:
+            self._pending.pop(uid, None)
+            if self._pending:
+                self._write({'op': 'done', 'uid': uid})
+            else:
+                open(self.path, 'w').close()
+
+
+class FrameRegistrar:
+    '''Register frames with an asset registry on a worker thread
+
+    Each frame is one resource insert and one bulk datum insert.
+
+    Parameters
+    ----------
+    fs : Registry
+        The asset registry
+
+    journal : RegistrationJournal, optional
+        If given, frames are journaled before they are sent and any left
+        over from a previous run are sent again
+
+    maxsize : int, optional
+        Frames that may wait to be registered before `submit` blocks
+    '''
+    def __init__(self, fs, *, journal=None, maxsize=16):
+        self.fs = fs
+        self.journal = journal
+        self._executor = BoundedExecutor(max_workers=1, maxsize=maxsize,
+                                         name='germ-registry')
+        # seconds the last frame took to register
+        self.last_latency = 0
+        # the last error message, '' once a frame registers again
+        self.last_error = ''
+        # journaled entries waiting on a retry, added to by the worker
+        self._failed = {}
+        self._lock = threading.Lock()
+        if journal is not None:
+            for entry in journal.pending():
+                self._failed[entry['uid']] = entry
+            self.retry()
+
+    @property
+    def depth(self):
+        '''The number of frames queued or being registered'''
+        return self._executor.depth
+
+    @property
+    def outstanding(self):
+        '''The number of frames not yet in the registry'''
+        return self.depth + len(self._failed)
+
+    def submit(self, spec, rpath, rkwargs, datums, root='/', *, block=True):
+        '''Queue a frame
+
+        Parameters
+        ----------
+        spec, rpath, rkwargs, root
+            As for ``Registry.insert_resource``
+
+        datums : list of (str, dict)
+            The ``(datum_id, datum_kwargs)`` of the frame
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            The result is the resource uid
+        '''
+        entry = {'uid': str(uuid.uuid4()),
+                 'spec': spec,
+                 'root': root,
+                 'rpath': rpath,
+                 'rkwargs': rkwargs,
+                 'datum_ids': [d for d, _ in datums],
+                 'datum_kwargs': [k for _, k in datums]}
+        self.retry()
+        # journaled on the worker: this is called from the event loop,
+        # which must not wait on the fsync
+        return self._executor.submit(self._insert, entry, journal=True,
+                                     block=block)
+
+    def retry(self):
+        '''Queue the frames that failed to register again
+
+        This is done on every `submit`, and never waits on the queue.
+        '''
+        while True:
+            with self._lock:
+                if not self._failed:
+                    return
+                uid, entry = self._failed.popitem()
+            try:
+                self._executor.submit(self._insert, entry, retry=True,
+                                      block=False)
+            except queue.Full:
+                with self._lock:
+                    self._failed[uid] = entry
+                return
+
+    def _insert(self, entry, retry=False, journal=False):
+        if journal and self.journal is not None:
+            self.journal.append(entry)
+        fs = self.fs
+        start = time.monotonic()
+        try:
+            # a retry may have got part way through before
+            res = fs.insert_resource(
+                entry['spec'], entry['rpath'], entry['rkwargs'],
+                root=entry['root'], uid=entry['uid'],
+                ignore_duplicate_error=retry)
+            datums = zip(entry['datum_ids'], entry['datum_kwargs'])
+            if retry or not hasattr(fs, 'bulk_insert_datum'):
+                for datum_id, kwargs in datums:
+                    fs.insert_datum(res, datum_id, kwargs,
+                                    ignore_duplicate_error=retry)
+            else:
+                fs.bulk_insert_datum(res, entry['datum_ids'],
+                                     entry['datum_kwargs'])
+        except Exception as e:
+            self.last_error = f"{entry['rpath']}: {e}"
+            print(f'registering {entry["rpath"]} failed: {e}')
+            with self._lock:
+                self._failed[entry['uid']] = entry
+            raise
+        self.last_latency = time.monotonic() - start
+        self.last_error = ''
+        if self.journal is not None:
+            self.journal.done(entry['uid'])
+        return entry['uid']
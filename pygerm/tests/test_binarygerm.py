@@ -1,8 +1,11 @@
 import numpy as np
+import os
+import pytest
 import tempfile
 
 from pygerm.client import payload2event, event2payload
-from pygerm.handler import BinaryGeRMHandler
+from pygerm.handler import (BinaryGeRMHandler, FrameCache, frame_cache,
+                            index_path)
 
 '''
 numpy issue with anding np.uint64 see here:
@@ -96,3 +99,162 @@ def test_binary_germ():
     assert np.allclose(read_td, td)
     assert np.allclose(read_ps, ps)
     assert np.allclose(read_ts, ts)
+
+
+def test_binary_germ_lazy():
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    germ_data.astype('>u4').tofile(fpath)
+
+    handler = BinaryGeRMHandler(fpath)
+    assert handler._mapped is None
+    assert isinstance(handler._raw, np.memmap)
+    assert handler._data is None
+
+    energy = handler('energy')
+    # held by the frame cache alone, so it is freed when evicted
+    assert handler.data.cached_nbytes == 0
+    assert handler('energy') is energy
+    assert np.array_equal(energy, payload2event(germ_data[2:-2])[3])
+    handler.close()
+
+
+def test_frame_cache():
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    germ_data.astype('>u4').tofile(fpath)
+
+    cache = FrameCache()
+    BinaryGeRMHandler.cache = cache
+    try:
+        first = BinaryGeRMHandler(fpath)('chip')
+        second = BinaryGeRMHandler(fpath)
+        assert second('chip') is first
+        # a hit does not touch the file
+        assert second._mapped is None
+        assert second._data is None
+        # the column, and whether the frame was clean
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert cache.nbytes == first.nbytes + 16
+        assert not first.flags.writeable
+
+        energy = second('energy')
+        cache.max_bytes = energy.nbytes
+        assert cache.nbytes == energy.nbytes
+
+        cache.invalidate(fpath)
+        assert cache.nbytes == 0
+        assert BinaryGeRMHandler(fpath)('energy') is not energy
+    finally:
+        BinaryGeRMHandler.cache = frame_cache
+
+
+def test_binary_germ_slice():
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    germ_data.astype('>u4').tofile(fpath)
+    chip, chan, td, pd, ts = payload2event(germ_data[2:-2])
+
+    # the first read of a frame validates all of it
+    handler = BinaryGeRMHandler(fpath)
+    assert np.array_equal(handler('energy', start=10, stop=500), pd[10:500])
+    assert handler.dropped_words == 0
+
+    # once it is known to be clean nothing outside of a window is read
+    handler = BinaryGeRMHandler(fpath)
+    assert np.array_equal(handler('chip', stop=100), chip[:100])
+    assert np.array_equal(handler('chip', start=-10), chip[-10:])
+    assert handler._data is None
+    assert np.array_equal(handler('time', start=5, stop=10),
+                          handler('time')[5:10])
+
+
+@pytest.mark.parametrize('damage', ['odd', 'even'])
+def test_binary_germ_slice_dropped(damage):
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    if damage == 'odd':
+        # a word lost at event 1000 puts the rest of the frame out of
+        # step (a junk word at the end keeps it a whole number of
+        # events)
+        germ_data = np.insert(np.delete(germ_data, 2 + 2 * 1000), -2,
+                              0xffffffff)
+    else:
+        # a bad word1 drops its whole event, the rest stays in step
+        germ_data[2 + 2 * 1000] |= 0x80000000
+    germ_data.astype('>u4').tofile(fpath)
+    # this also tells later handlers the frame is not clean
+    whole = BinaryGeRMHandler(fpath).data
+    assert len(whole) == 2999
+
+    # so windows past the damage are found in the validated frame
+    handler = BinaryGeRMHandler(fpath)
+    assert np.array_equal(handler('energy', start=1500, stop=1510),
+                          whole['energy'][1500:1510])
+    assert handler.dropped_words == 2
+
+
+def test_pixel_index():
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    germ_data.astype('>u4').tofile(fpath)
+    chip, chan, td, pd, ts = payload2event(germ_data[2:-2])
+    pix = chip.astype(int) * 32 + chan
+
+    handler = BinaryGeRMHandler(fpath)
+    counts = handler.pixel_counts()
+    # the cache, not the handler, keeps the index
+    assert handler._index is None
+    assert np.array_equal(counts, np.bincount(pix, minlength=len(counts)))
+    assert os.path.exists(index_path(fpath))
+    for p in (0, 217, 383):
+        assert np.array_equal(handler.pixel_events(p), pd[pix == p])
+
+    # a new handler picks up the sidecar, and reads the events of a
+    # pixel in place as the frame is known to be clean
+    frame_cache.invalidate(fpath)
+    frame_cache.fetch(frame_cache.key(fpath, 'dropped'),
+                      lambda: np.array([0, 0]))
+    handler = BinaryGeRMHandler(fpath)
+    assert np.array_equal(handler.pixel_events(217, 'timestamp_coarse'),
+                          ts[pix == 217])
+    assert handler._data is None
+
+
+def test_pixel_index_dropped():
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    # a bad word1 drops its event, the index is of the validated frame
+    germ_data[2 + 2 * 1000] |= 0x80000000
+    germ_data.astype('>u4').tofile(fpath)
+
+    handler = BinaryGeRMHandler(fpath)
+    order, offsets = handler.pixel_index()
+    expected = handler.data.take(order[offsets[217]:offsets[218]])
+
+    # from the sidecar, not knowing the frame dropped words
+    frame_cache.invalidate(fpath)
+    handler = BinaryGeRMHandler(fpath)
+    assert np.array_equal(handler.pixel_events(217), expected['energy'])
+    # told so by the cache
+    handler = BinaryGeRMHandler(fpath)
+    assert np.array_equal(handler.pixel_events(217, 'chip'),
+                          expected['chip'])
+
+
+def test_pixel_index_sidecar_torn():
+    fpath = tempfile.mktemp()
+    germ_data = generate_germ_data()
+    germ_data.astype('>u4').tofile(fpath)
+    counts = BinaryGeRMHandler(fpath).pixel_counts()
+    assert not [f for f in os.listdir(os.path.dirname(fpath))
+                if f.startswith(os.path.basename(fpath)) and
+                f.endswith('.part')]
+
+    # as a reader might see it part way through being written
+    with open(index_path(fpath), 'r+b') as fout:
+        fout.truncate(100)
+    frame_cache.invalidate(fpath)
+    assert np.array_equal(BinaryGeRMHandler(fpath).pixel_counts(), counts)
+    with np.load(index_path(fpath)) as fin:
+        assert np.array_equal(np.diff(fin['offsets']), counts)
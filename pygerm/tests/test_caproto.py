@@ -0,0 +1,323 @@
+import json
+import os
+import struct
+import time
+
+import caproto as ca
+import numpy as np
+
+from pygerm.backends import ASYNCIO
+from pygerm.caproto import (GeRMIOCZMQDataAsyncio, GeRMIOCUDPDataAsyncio,
+                            _channel_str)
+from pygerm.client import event2payload, EventBlock
+from pygerm.collector import loss_path
+from pygerm.transfer import CopyManager
+
+from .test_registry import FlakyRegistry
+
+
+class FakeZClient:
+    # stands in for ZClientAsyncio, each frame is `n_events` events
+    def __init__(self, url, *, zmq=None, n_events=100, **kwargs):
+        self.n_events = n_events
+        self.calls = []
+        self.frames = 0
+        self.fail = False
+        self.start_time = self.stop_time = None
+        self.hit_rate = 0
+        self.last_latency = 0
+        self.high_water = 0
+        self.spilled_events = 0
+        self.ring = None
+
+    async def setup_frame(self):
+        self.calls.append('setup')
+
+    async def start_daq(self):
+        self.calls.append('start')
+        self.start_time = time.time()
+
+    async def stop_daq(self):
+        self.calls.append('stop')
+        self.stop_time = time.time()
+
+    async def triggered_frame(self, sink=None, armed=False):
+        if not armed:
+            await self.setup_frame()
+        await self.start_daq()
+        if self.fail:
+            raise IOError('lost the Zync')
+        self.frames += 1
+        n = self.n_events
+        payload = event2payload(*(np.arange(n) % m
+                                  for m in (12, 32, 2**9, 2**12, 2**29)))
+        data = [EventBlock(payload)]
+        if sink is not None:
+            await sink(payload)
+            data = []
+        await self.stop_daq()
+        return self.frames, n, data, 0
+
+
+class FakeCollectorSock:
+    # the collector's end of the handshake in `UDPCollector.serve_once`
+    def __init__(self, n_events=100):
+        self.n_events = n_events
+        self.frame = 0
+        # frame numbers to not write the file of, or to mark truncated
+        self.unwritten = set()
+        self.truncated = set()
+        self._step = 0
+        self._reply = self._path = None
+
+    async def send(self, msg):
+        # filename, ack once the frame is started, ack for the path
+        if self._step == 0:
+            self._path = msg.decode('latin-1')
+            self._reply = b'Received Filename'
+        elif self._step == 1:
+            self._reply = self._collect()
+        else:
+            self._reply = self._path.encode()
+        self._step = (self._step + 1) % 3
+
+    async def recv(self):
+        return self._reply
+
+    def _collect(self):
+        self.frame += 1
+        n = self.n_events
+        if self.frame not in self.unwritten:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path, 'wb') as fout:
+                fout.write(struct.pack('!II', 0xfeedface, self.frame))
+                fout.write(bytes(8 * n))
+                fout.write(struct.pack('!II', 0, 0xdecafbad))
+        if self.frame in self.truncated:
+            with open(loss_path(self._path), 'w') as fout:
+                json.dump({'truncated': True, 'lost_events': 0}, fout)
+        return struct.pack('QQQQ', self.frame, n, 0, 0)
+
+
+class FakeUClient:
+    def __init__(self, url, *, zmq=None, context=None):
+        self.ctrl_sock = FakeCollectorSock()
+
+
+class FakeZMQIOC(GeRMIOCZMQDataAsyncio):
+    _zclient_class = FakeZClient
+
+
+class FakeUDPIOC(GeRMIOCUDPDataAsyncio):
+    _zclient_class = FakeZClient
+    _uclient_class = FakeUClient
+
+
+def uids(germ):
+    return [_channel_str(getattr(germ, f'uid_{short}_channel'))
+            for short in ('chip', 'chan', 'td', 'pd', 'ts')]
+
+
+def put(channel, value):
+    async def put():
+        await channel.write_from_dbr([value], ca.ChannelType.INT, None)
+    ASYNCIO.run(put)
+
+
+def acquire(germ):
+    async def put():
+        await germ.acquire_channel.write_from_dbr(
+            [1], ca.ChannelType.INT, None)
+    ASYNCIO.run(put)
+
+
+def set_path(germ, path, channel='filepath'):
+    async def put():
+        await getattr(germ, f'{channel}_channel').write_from_dbr(
+            [str(path).encode()], ca.ChannelType.STRING, None)
+    ASYNCIO.run(put)
+
+
+def udp_ioc(tmpdir, fs):
+    germ = FakeUDPIOC('tcp://127.0.0.1', 'tcp://127.0.0.1', fs)
+    # no waiting between attempts
+    germ.copier = CopyManager(retries=0)
+    # the collector and the IOC see its disk at the same place
+    src = tmpdir.join('collector')
+    for channel, path in (('filepath', 'data'), ('writeroot', src),
+                          ('srcmount', src),
+                          ('destmount', tmpdir.join('dest'))):
+        set_path(germ, path, channel)
+    return germ
+
+
+def copied(tmpdir):
+    return sorted(p.basename for p in tmpdir.join('dest').visit()
+                  if p.isfile())
+
+
+def test_stream_failure_resets_acquire(tmpdir):
+    germ = FakeZMQIOC('tcp://127.0.0.1', None, stream=True)
+    # the file can not be made under a file
+    tmpdir.join('file').write('')
+    set_path(germ, tmpdir.join('file'))
+    acquire(germ)
+    assert germ.acquire_channel.value == 0
+    assert 'start' not in germ.zclient.calls
+
+    # a frame that fails part way stops the FPGA
+    set_path(germ, tmpdir)
+    germ.zclient.fail = True
+    acquire(germ)
+    assert germ.acquire_channel.value == 0
+    assert germ.zclient.calls[-2:] == ['start', 'stop']
+
+
+def test_sequence_of_triggers(tmpdir):
+    fs = FlakyRegistry()
+    germ = FakeZMQIOC('tcp://127.0.0.1', fs)
+    set_path(germ, tmpdir)
+    put(germ.num_images_channel, 3)
+    zc = germ.zclient
+    seen = []
+    for n in range(3):
+        acquire(germ)
+        assert germ.acquire_channel.value == 0
+        assert germ.count_channel.value == zc.n_events
+        assert germ.last_frame_channel.value == n + 1
+        # read as a bluesky event would be, after each trigger
+        seen.append(uids(germ))
+    # armed once, then again while each frame but the last is written
+    assert zc.calls == ['setup', 'start', 'stop'] * 3
+    assert germ.acquire_channel._remaining == 0
+    assert germ.acquire_channel._rearm_task is None
+    # every frame is registered under the ids read for it
+    assert len(fs.resources) == 3
+    assert all(uid in fs.datums for frame in seen for uid in frame)
+    assert len(tmpdir.listdir()) == 3
+
+    # the next sequence starts by arming again
+    put(germ.num_images_channel, 1)
+    acquire(germ)
+    assert zc.calls[-3:] == ['setup', 'start', 'stop']
+
+
+def test_sequence_cut_short(tmpdir):
+    fs = FlakyRegistry()
+    germ = FakeZMQIOC('tcp://127.0.0.1', fs)
+    set_path(germ, tmpdir)
+    zc = germ.zclient
+    chan = germ.acquire_channel
+    for end in (lambda: put(germ.num_images_channel, 3),
+                lambda: put(chan, 0)):
+        put(germ.num_images_channel, 3)
+        del zc.calls[:]
+        acquire(germ)
+        # armed for the next frame, then the sequence is given up
+        end()
+        assert chan._remaining == 0
+        assert chan._rearm_task is None
+        assert not chan._finishing
+        assert zc.calls == ['setup', 'start', 'stop', 'setup', 'stop']
+        # the frame that was collected is written and registered
+        assert len(fs.resources) == len(tmpdir.listdir())
+
+        # the next acquire is a new sequence, armed afresh
+        del zc.calls[:]
+        acquire(germ)
+        assert zc.calls == ['setup', 'start', 'stop', 'setup']
+        assert chan._remaining == 2
+        # the idle time is not measured from the old sequence
+        assert germ.dead_time_channel.value == 0
+        put(germ.num_images_channel, 1)
+    assert len(fs.resources) == len(tmpdir.listdir()) == 4
+
+
+def test_failed_write_raises_alarm(tmpdir):
+    fs = FlakyRegistry()
+    germ = FakeZMQIOC('tcp://127.0.0.1', fs)
+    chan = germ.acquire_channel
+    # the file can not be made under a file, found once the trigger
+    # has returned
+    tmpdir.join('file').write('')
+    set_path(germ, tmpdir.join('file'))
+    put(germ.num_images_channel, 2)
+    acquire(germ)
+    set_path(germ, tmpdir.join('data'))
+    acquire(germ)
+    assert chan.value == 0
+    assert chan.alarm.severity == 2
+    assert len(fs.resources) == 1
+
+    # cleared by the next sequence; a frame written but not yet
+    # registered is a minor alarm
+    fs.fail = 1
+    put(germ.num_images_channel, 1)
+    acquire(germ)
+    assert chan.alarm.severity == 1
+    assert germ.registrar.outstanding == 1
+    acquire(germ)
+    assert not chan.alarm.severity
+    assert len(fs.resources) == 3
+
+
+def test_udp_sequence_of_triggers(tmpdir):
+    fs = FlakyRegistry()
+    germ = udp_ioc(tmpdir, fs)
+    put(germ.num_images_channel, 3)
+    put(germ.copy_wait_channel, 1)
+    zc = germ.zclient
+    collector = germ.udp_client.ctrl_sock
+    collector.truncated.add(2)
+    seen = []
+    for n in range(3):
+        acquire(germ)
+        assert germ.acquire_channel.value == 0
+        assert not germ.acquire_channel.alarm.severity
+        assert germ.last_frame_channel.value == n + 1
+        # waited on the copies
+        assert len(copied(tmpdir)) == n + 1 + (n > 0)
+        seen.append(uids(germ))
+    # armed once, then again while the collector wrote each frame out
+    assert zc.calls == ['setup', 'start', 'stop'] * 3
+    assert germ.acquire_channel._rearm_task is None
+    # the sidecar of a truncated frame goes with it, though none lost
+    sidecars = [p for p in copied(tmpdir) if p.endswith('.loss.json')]
+    assert len(sidecars) == 1
+    # let the registrations queued in the background through
+    ASYNCIO.run(germ.backend.sleep, 0.1)
+    germ.registrar._executor.shutdown()
+    assert len(fs.resources) == 3
+    assert all(uid in fs.datums for frame in seen for uid in frame)
+
+
+def test_udp_deferred_registration(tmpdir):
+    fs = FlakyRegistry()
+    germ = udp_ioc(tmpdir, fs)
+    put(germ.defer_registration_channel, 1)
+    put(germ.copy_wait_channel, 1)
+    collector = germ.udp_client.ctrl_sock
+
+    acquire(germ)
+    # registered once the copy was in, before acquire went back to 0
+    assert len(copied(tmpdir)) == 1
+    assert len(fs.resources) == 1
+    (spec, root, rpath, _), = fs.resources.values()
+    assert spec == 'BinaryGeRM'
+    assert tmpdir.join('dest').join(rpath).check(file=True)
+
+    # a frame that never made it to disk is not pointed at
+    collector.unwritten.add(2)
+    acquire(germ)
+    assert germ.acquire_channel.value == 0
+    assert germ.acquire_channel.alarm.severity == 2
+    assert _channel_str(germ.copy_error_channel)
+    assert len(fs.resources) == 1
+
+    # copy_wait off, acquire is done before the copy is
+    put(germ.copy_wait_channel, 0)
+    acquire(germ)
+    assert not germ.acquire_channel.alarm.severity
+    germ.copier.join(5)
+    ASYNCIO.run(germ.backend.sleep, 0.1)
+    assert len(fs.resources) == 2
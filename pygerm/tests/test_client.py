@@ -0,0 +1,181 @@
+import numpy as np
+import pytest
+
+from pygerm.client import (payload2event, event2payload, decode_events,
+                           empty_events, validate_payload, EventBlock,
+                           TimestampUnwrapper, RawRing, DATA_TYPES,
+                           TS_BITMASK, TD_BITMASK, encode_sequence,
+                           check_sequence, CMD_DELAY, CMD_REG_WRITE,
+                           MAX_SEQ, ColumnBuffer)
+
+
+def make_events(N=3000):
+    rng = np.random.RandomState(0)
+    chip = rng.randint(0, 12, size=N).astype('<u4')
+    chan = rng.randint(0, 32, size=N).astype('<u4')
+    td = rng.randint(0, 2**9, size=N).astype('<u4')
+    pd = rng.randint(0, 2**12, size=N).astype('<u4')
+    ts = rng.randint(0, 2**29, size=N).astype('<u4')
+    return chip, chan, td, pd, ts
+
+
+def test_decode_roundtrip():
+    events = make_events()
+    payload = event2payload(*events)
+    for byteorder in ('<u4', '>u4'):
+        decoded = payload2event(payload.astype(byteorder))
+        for expected, got in zip(events, decoded):
+            # wide, so callers can do arithmetic on them
+            assert got.dtype == np.uint32
+            assert np.array_equal(got, expected)
+        chip, chan = decoded[:2]
+        assert np.array_equal(chip * 32 + chan,
+                              events[0].astype(int) * 32 + events[1])
+    for k, got in zip(DATA_TYPES, decode_events(payload)):
+        assert got.dtype == np.dtype(f'uint{DATA_TYPES[k]}')
+
+
+def test_decode_into_out():
+    events = make_events()
+    payload = event2payload(*events)
+    out = empty_events(len(events[0]), ['energy', 'chip'])
+    ret = decode_events(payload, out, columns=['energy', 'chip'],
+                        chunk_size=1000)
+    assert all(r is o for r, o in zip(ret, out))
+    assert np.array_equal(out[0], events[3])
+    assert np.array_equal(out[1], events[0])
+
+
+def test_event_block():
+    events = make_events()
+    payload = event2payload(*events)
+    block = EventBlock(payload)
+    assert len(block) == len(events[0])
+    assert block._cache == {}
+
+    assert np.array_equal(block['energy'], events[3])
+    assert list(block._cache) == ['energy']
+    for expected, got in zip(events, block):
+        assert np.array_equal(got, expected)
+
+    sub = block[100:250]
+    assert len(sub) == 150
+    assert np.shares_memory(sub.segments[0], payload)
+    assert np.array_equal(sub['chip'], events[0][100:250])
+
+    joined = EventBlock.concatenate([block[:1000], block[1000:2500],
+                                     block[2500:]])
+    assert len(joined.segments) == 3
+    assert all(np.shares_memory(s, payload) for s in joined.segments)
+    assert np.array_equal(joined['timestamp_coarse'], events[4])
+    assert np.array_equal(joined[990:1010]['chan'], events[1][990:1010])
+    # columns decoded in every part are kept, the others are not
+    assert set(joined._cache) == set(DATA_TYPES)
+    other = EventBlock(payload)
+    other['chip']
+    partly = EventBlock.concatenate([sub, other])
+    assert list(partly._cache) == ['chip']
+    assert np.array_equal(partly['chip'][150:], events[0])
+
+
+def test_validate_payload():
+    events = make_events()
+    payload = event2payload(*events)
+
+    words, dropped_words, dropped_events = validate_payload(payload)
+    assert words is payload
+    assert (dropped_words, dropped_events) == (0, 0)
+
+    # lose a word2 and then a word1 further along
+    bad = np.delete(payload, [201, 1000])
+    words, dropped_words, dropped_events = validate_payload(bad)
+    assert (dropped_words, dropped_events) == (2, 2)
+    keep = np.ones(len(events[0]), dtype=bool)
+    keep[[100, 500]] = False
+    for expected, got in zip(events, payload2event(words)):
+        assert np.array_equal(got, expected[keep])
+
+
+def test_timestamp_unwrapper():
+    period = TS_BITMASK + 1
+    true_ticks = np.cumsum(np.full(5000, period // 1000, dtype=np.int64))
+    ts = (true_ticks % period).astype(np.uint32)
+    td = np.arange(5000) % (TD_BITMASK + 1)
+
+    unwrapper = TimestampUnwrapper()
+    chunks = [unwrapper.event_time(ts[s:s + 700], td[s:s + 700])
+              for s in range(0, 5000, 700)]
+    t = np.concatenate(chunks)
+    assert t.dtype == np.int64
+    assert np.array_equal(t, true_ticks * (TD_BITMASK + 1) + td)
+
+    # events a little out of order either side of a roll-over, one
+    # chunk ending on a late event
+    third = period // 3
+    true_ticks = np.array([period - 10, period + 5, period - 5, period + 8,
+                           period + third, period + 2 * third,
+                           2 * period - 3, 2 * period + 1, 2 * period - 1,
+                           2 * period + 4])
+    ts = true_ticks % period
+    unwrapper = TimestampUnwrapper()
+    t = np.concatenate([unwrapper.unwrap(ts[:3]), unwrapper.unwrap(ts[3:9]),
+                        unwrapper.unwrap(ts[9:])])
+    assert np.array_equal(t, true_ticks)
+    assert unwrapper.wraps == true_ticks[-1] // period
+
+
+def test_raw_ring():
+    payload = event2payload(*make_events(100))
+    ring = RawRing(3 * len(payload))
+    views = [ring.put(payload) for _ in range(3)]
+    assert ring.occupancy == 1
+    assert ring.put(payload) is None
+    assert ring.overflows == 1
+
+    # a block still refers to the first region, so the ring stays full
+    block = EventBlock(views[0])[10:20]
+    del views[:2]
+    assert ring.put(payload) is None
+    assert ring.used == 2 * len(payload)
+
+    del block
+    again = ring.put(payload)
+    assert np.array_equal(again, payload)
+    assert not again.flags.writeable
+    assert ring.high_water == 3 * len(payload)
+
+
+def test_sequence():
+    from pygerm import TRIGGER_SETUP_SEQ
+    commands = encode_sequence(TRIGGER_SETUP_SEQ)
+    assert commands.shape == (len(TRIGGER_SETUP_SEQ), 3)
+    assert commands[0].tolist() == [CMD_REG_WRITE, 0x0, 64]
+    assert commands[5].tolist() == [CMD_DELAY, 0, 10000]
+
+    reply = check_sequence(commands, commands.tobytes())
+    assert np.array_equal(reply, commands)
+
+    with pytest.raises(RuntimeError):
+        check_sequence(commands, commands[:-1].tobytes())
+    bad = commands.copy()
+    bad[3] = 0xdead
+    with pytest.raises(RuntimeError):
+        check_sequence(commands, bad.tobytes())
+    # the server refuses a sequence too long for it
+    refused = np.array([0xdead, 0xdead, len(commands)], dtype=np.uint32)
+    with pytest.raises(RuntimeError, match='refused'):
+        check_sequence(commands, refused.tobytes())
+
+    with pytest.raises(ValueError):
+        encode_sequence([(0x10, 1)] * (MAX_SEQ + 1))
+
+
+def test_column_buffer():
+    buf = ColumnBuffer(np.uint16, capacity=3)
+    for k in range(5):
+        buf.append(np.arange(k))
+    assert len(buf) == 10
+    assert np.array_equal(buf.values,
+                          np.concatenate([np.arange(k) for k in range(5)]))
+    buf.clear()
+    assert len(buf.values) == 0
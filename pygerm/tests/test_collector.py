@@ -0,0 +1,192 @@
+import json
+import socket
+import struct
+import threading
+
+import numpy as np
+import pytest
+import zmq
+
+from pygerm.client import (event2payload, validate_payload, decode_events,
+                           N_CHANS, N_PIXELS)
+from pygerm.collector import UDPCollector, packetize, loss_path
+from pygerm.handler import BinaryGeRMHandler
+from pygerm.live import LiveSpectrum
+
+
+def collect(tmpdir, datagrams, **kwargs):
+    # run the IOC's side of one frame, returning the reply and path
+    context = zmq.Context()
+    kwargs.setdefault('rcvbuf', 2**20)
+    kwargs.setdefault('buffer_bytes', 2**21)
+    col = UDPCollector(None, ctrl_url='tcp://127.0.0.1:*',
+                       data_addr=('127.0.0.1', 0), context=context,
+                       **kwargs)
+    server = threading.Thread(target=col.serve_once)
+    server.start()
+
+    req = context.socket(zmq.REQ)
+    req.connect(col.ctrl_sock.getsockopt(zmq.LAST_ENDPOINT))
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    base = str(tmpdir.join('frame'))
+    try:
+        req.send(base.encode())
+        assert req.recv() == b'Received Filename'
+        for p in datagrams:
+            udp.sendto(p, col.data_sock.getsockname())
+        req.send(b'ack')
+        meta = struct.unpack('QQQQ', req.recv())
+        req.send(b'ack')
+        path = req.recv().decode()
+        server.join(5)
+    finally:
+        udp.close()
+        req.close(linger=0)
+        col.close()
+        context.term()
+    return meta, path, col
+
+
+def make_packets(n, frame=7, overfill=3, counter=0):
+    words = event2payload(*(np.arange(n) % m
+                            for m in (12, 32, 2**9, 2**12, 2**29)))
+    return packetize(words, frame, overfill=overfill, counter=counter)
+
+
+def expected_words(packets, dropped=()):
+    return np.concatenate([np.frombuffer(p[4:], '>u4')
+                           for k, p in enumerate(packets)
+                           if k not in dropped])
+
+
+@pytest.mark.parametrize('lossy', [False, True])
+@pytest.mark.parametrize('buffer_bytes', [2**21, 2**16])
+def test_collector_handshake(tmpdir, buffer_bytes, lossy):
+    packets = make_packets(20000)
+    sent = list(packets)
+    dropped = []
+    if lossy:
+        dropped = [3, 4, 20]
+        sent = [sent[k] for k in range(len(sent)) if k not in dropped]
+        # out of order within the window, and one twice
+        sent[5], sent[7] = sent[7], sent[5]
+        sent.insert(12, sent[10])
+    live = LiveSpectrum(64)
+    # the end of an earlier frame is thrown away
+    (frame, count, overfill, lost), path, col = collect(
+        tmpdir, [packets[-1]] + sent, buffer_bytes=buffer_bytes,
+        write_chunk=4096, window=2, live=live, live_packets=4)
+
+    base = str(tmpdir.join('frame'))
+    assert path == base + '_007.bin'
+    raw = np.fromfile(path, dtype='>u4')
+    assert np.array_equal(raw, expected_words(packets, dropped))
+    assert list(raw[[0, 1, -2, -1]]) == [0xfeedface, 7, 3, 0xdecafbad]
+    assert (frame, count, overfill) == (7, (len(raw) - 4) // 2, 3)
+    assert lost == 511 * len(dropped)
+    assert col.strays == 1
+    # the gaps are whole packets, so nothing has to be thrown away
+    assert validate_payload(raw[2:-2].astype('u4'))[1] == 0
+    # every event written was binned once, as it came in
+    chip, chan, pd = decode_events(raw[2:-2],
+                                   columns=('chip', 'chan', 'energy'))
+    expected, _, _ = np.histogram2d(
+        pd, chip.astype(int) * N_CHANS + chan,
+        bins=[live.bin_edges, np.arange(N_PIXELS + 1)])
+    assert live.events == count
+    assert np.array_equal(live.spectrum, expected)
+    report = BinaryGeRMHandler(path).loss()
+    if lossy:
+        with open(loss_path(path)) as fin:
+            assert json.load(fin) == report
+        assert report['missing'] == [[3, 5], [20, 21]]
+        assert report['gaps'] == [[3 * 511 - 1, 2 * 511],
+                                  [18 * 511 - 1, 511]]
+        assert report['duplicates'] == 1
+    else:
+        assert report is None
+
+
+def test_collector_strays(tmpdir):
+    packets = make_packets(41 * 511 - 100)
+    assert len(packets) == 41
+    counter = struct.pack('!I', 500)
+    # far ahead, and just past the end before the end arrives
+    sent = (packets[:20] + [counter + packets[20][4:]] + packets[20:-1] +
+            [struct.pack('!I', 41) + packets[5][4:], packets[-1]])
+    (frame, count, _, lost), path, col = collect(tmpdir, sent, window=4)
+    assert lost == 0
+    assert col.strays == 2
+    assert np.array_equal(np.fromfile(path, dtype='>u4'),
+                          expected_words(packets))
+    assert BinaryGeRMHandler(path).loss() is None
+    assert len(BinaryGeRMHandler(path)('chip')) == count
+
+
+def test_collector_start_of_frame(tmpdir):
+    packets = make_packets(5000)
+    # before the start of the frame
+    sent = packets[2:4] + packets[:2] + packets[4:]
+    (frame, count, _, lost), path, _ = collect(tmpdir, sent, window=4)
+    assert (frame, count, lost) == (7, 5000, 0)
+    assert np.array_equal(np.fromfile(path, dtype='>u4'),
+                          expected_words(packets))
+
+    # a lost start is written back and numbered after the last frame
+    (frame, count, _, lost), path, col = collect(tmpdir, packets[1:],
+                                                 window=4)
+    assert frame == 0 and path.endswith('_000.bin')
+    assert (count, lost) == (5000 - 510, 510)
+    raw = np.fromfile(path, dtype='>u4')
+    assert list(raw[:2]) == [0xfeedface, 0]
+    assert np.array_equal(raw[2:], expected_words(packets, [0]))
+    handler = BinaryGeRMHandler(path)
+    assert len(handler('chip')) == count
+    assert handler.loss()['sof_lost']
+    assert handler.loss()['gaps'] == [[0, 510]]
+
+
+def test_collector_counter_runs_on(tmpdir):
+    # the FPGA's counter carries on from frame to frame, and wraps
+    context = zmq.Context()
+    col = UDPCollector(None, ctrl_url='tcp://127.0.0.1:*',
+                       data_addr=('127.0.0.1', 0), context=context,
+                       rcvbuf=2**20, buffer_bytes=2**21, window=4)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    base = str(tmpdir.join('frame'))
+    counter = 2**32 - 3
+    try:
+        for frame in (7, 8, 9):
+            packets = make_packets(5000, frame=frame, counter=counter)
+            counter += len(packets)
+            if frame == 9:
+                # a lost start is taken to be where the last frame ended
+                sent = packets[1:]
+                dropped = [0]
+            else:
+                # before the start of the frame
+                sent = packets[2:4] + packets[:2] + packets[4:]
+                dropped = []
+            for p in sent:
+                udp.sendto(p, col.data_sock.getsockname())
+            assert col.receive(base)[0] == frame
+            assert col.strays == col.late == 0
+            assert col.lost_events == 510 * len(dropped)
+            raw = np.fromfile(col.write(), dtype='>u4')
+            assert list(raw[:2]) == [0xfeedface, frame]
+            assert np.array_equal(raw[2 * len(dropped):],
+                                  expected_words(packets, dropped))
+    finally:
+        udp.close()
+        col.close()
+        context.term()
+
+
+def test_collector_nothing_sent(tmpdir):
+    # gives up rather than holding the IOC up
+    (frame, count, overfill, lost), path, col = collect(
+        tmpdir, [], frame_timeout=0.2)
+    assert (count, lost) == (0, 0)
+    assert col.truncated
+    raw = np.fromfile(path, dtype='>u4')
+    assert list(raw) == [0xfeedface, frame, 0, 0xdecafbad]
@@ -0,0 +1,145 @@
+import curio
+import numpy as np
+import pytest
+import zmq
+
+from pygerm.client import event2payload, EventBlock
+from pygerm.client.curio_zmq import ZClientCurio, ZClientCurioBase
+from pygerm.client.asyncio_zmq import ZClientAsyncio, ZClientAsyncioBase
+
+backends = pytest.mark.parametrize(
+    'zclient_class', [ZClientCurio, ZClientAsyncio],
+    ids=lambda cls: cls.backend.name)
+
+
+def run(backend, func):
+    # the fake sockets do not need curio.zmq's kernel
+    if backend.name == 'curio':
+        return curio.run(func)
+    return backend.run(func)
+
+
+class FakeSub:
+    def __init__(self, messages, backend):
+        self.messages = list(messages)
+        self.backend = backend
+
+    async def recv_multipart(self, copy=True):
+        if not self.messages:
+            await self.backend.sleep(1)
+        topic, payload = self.messages.pop(0)
+        if copy:
+            return [topic, payload]
+        return [zmq.Frame(topic), zmq.Frame(payload)]
+
+
+@backends
+@pytest.mark.parametrize('decode_workers, memory_budget',
+                         [(0, None), (3, None), (0, 8000), (3, 8000)])
+def test_read_frame_in_order(tmpdir, zclient_class, decode_workers,
+                             memory_budget):
+    n = 20
+    bunches = [event2payload(*(np.full(100 + k, v, dtype='<u4')
+                               for v in (k % 12, 1, 2, 3, k)))
+               for k in range(n)]
+    messages = [(b'data', b.tobytes()) for b in bunches]
+    messages.append((b'meta', np.array([7, 0], dtype=np.uint32).tobytes()))
+
+    context = zmq.Context()
+    zc = zclient_class('tcp://127.0.0.1', zmq=zmq, context=context,
+                       decode_workers=decode_workers, ring_words=2**16,
+                       memory_budget=memory_budget, spill_dir=str(tmpdir))
+    context.destroy(linger=0)
+    backend = zc.backend
+    zc.data_sock = FakeSub(messages, backend)
+    zc.collecting = True
+
+    async def read():
+        reader = await backend.spawn(zc.read_forever, daemon=True)
+        frame = await zc.read_frame()
+        await backend.cancel(reader)
+        return frame
+
+    fr_num, ev_count, data, overfill = run(backend, read)
+    assert fr_num == 7
+    assert ev_count == sum(100 + k for k in range(n))
+    block = EventBlock.concatenate(data)
+    assert np.array_equal(block['timestamp_coarse'],
+                          np.repeat(np.arange(n), [100 + k for k in range(n)]))
+    if memory_budget is None:
+        assert [len(b) for b in data] == [100 + k for k in range(n)]
+        assert zc.spilled_events == 0
+    else:
+        assert zc.spilled_events > 0
+        assert len(data[0]) == zc.spilled_events
+        # over by at most one bunch: 8 raw + 10 decoded bytes per event
+        assert zc.high_water <= memory_budget + 18 * (100 + n)
+
+
+class FakeRep:
+    # answers control requests like the zmq server
+    def __init__(self):
+        self.registers = {0xd4: 1000}
+        self.requests = 0
+        self.longest = 0
+        self._reply = None
+
+    def _run(self, part):
+        cmd, addr, value = np.frombuffer(part, dtype=np.uint32)
+        if cmd == 0:
+            value = self.registers.get(int(addr), 0)
+        elif cmd == 1:
+            self.registers[int(addr)] = int(value)
+        return np.array([cmd, addr, value], dtype=np.uint32).tobytes()
+
+    async def send(self, part):
+        await self.send_multipart([part])
+
+    async def send_multipart(self, parts):
+        self.requests += 1
+        self.longest = max(self.longest, len(parts))
+        self._reply = b''.join(self._run(bytes(p)) for p in parts)
+
+    async def recv(self):
+        return self._reply
+
+
+@pytest.mark.parametrize('zclient_class',
+                         [ZClientCurioBase, ZClientAsyncioBase],
+                         ids=lambda cls: cls.backend.name)
+@pytest.mark.parametrize('batch', [True, False])
+def test_register_shadow(zclient_class, batch):
+    context = zmq.Context()
+    zc = zclient_class('tcp://127.0.0.1', zmq=zmq, context=context,
+                       max_age=None, batch=batch)
+    context.destroy(linger=0)
+    zc.ctrl_sock = rep = FakeRep()
+
+    async def check():
+        assert await zc.read(0xd4) == 1000
+        assert await zc.read(0xd4) == 1000
+        await zc.write(0xd4, 2000)
+        assert await zc.read(0xd4) == 2000
+        # changed behind our back, only seen when asked for
+        rep.registers[0xd4] = 3000
+        assert await zc.read(0xd4) == 2000
+        assert await zc.read(0xd4, max_age=0) == 3000
+        await zc.execute_sequence([(0x10, 1), (None, 0.01)])
+        rep.registers[0x10] = 5
+        assert await zc.refresh() == {0xd4: 3000, 0x10: 5}
+
+    run(zc.backend, check)
+    if batch:
+        assert rep.requests == 5
+        assert (zc.hits, zc.misses) == (3, 2)
+        assert zc.hit_rate == 0.6
+    else:
+        # the refresh is a read per register
+        assert rep.requests == 6
+        assert (zc.hits, zc.misses) == (3, 4)
+    assert zc.last_latency > 0
+
+    # an older server only takes one command per request
+    rep.longest = 0
+    run(zc.backend, zc.setup_frame)
+    assert (rep.longest > 1) == batch
@@ -1,7 +1,12 @@
 import numpy as np
 import h5py
+import os
+import tempfile
 
-from pygerm.client import DATA_TYPEMAP, event2payload
+from pygerm.client import (DATA_TYPEMAP, DATA_TYPES, EventBlock,
+                           event2payload, pixel_index)
+from pygerm.handler import GeRMHandler, index_path
+from pygerm.writers import write_h5_frame, StreamingH5Writer
 
 
 # some setup
@@ -33,3 +38,63 @@ def hdf52germ(fpath):
     new_dict['pd'] = res['energy']
     new_dict['ts'] = res['timestamp_coarse']
     return event2payload(**new_dict)
+
+
+def test_germ_handler_pixel_index():
+    fpath = tempfile.mktemp()
+    rng = np.random.RandomState(0)
+    chip = rng.randint(0, 12, size=2000)
+    chan = rng.randint(0, 32, size=2000)
+    pd = rng.randint(0, 4096, size=2000)
+    with h5py.File(fpath, 'w') as fout:
+        g = fout.create_group('GeRM')
+        for k, v in (('chip', chip), ('chan', chan), ('energy', pd)):
+            g.create_dataset(k, data=v.astype(f'uint{DATA_TYPES[k]}'))
+        order, offsets = pixel_index(chip, chan)
+        g.create_dataset('pixel_order', data=order)
+        g.create_dataset('pixel_offsets', data=offsets)
+
+    handler = GeRMHandler(fpath)
+    assert np.array_equal(handler('energy', start=10, stop=20), pd[10:20])
+    pix = chip * 32 + chan
+    assert np.array_equal(handler.pixel_events(42), pd[pix == 42])
+    assert not os.path.exists(index_path(fpath))
+    handler.close()
+
+
+def test_raw_layout():
+    events = [np.random.randint(0, 2**w, size=5000).astype('<u4')
+              for w in (4, 5, 9, 12, 29)]
+    payload = event2payload(*events)
+    bunches = [EventBlock(payload[:4000]), EventBlock(payload[4000:])]
+
+    for layout, index in (('columns', True), ('raw', False)):
+        fpath = tempfile.mktemp()
+        write_h5_frame(fpath, bunches, 5000, layout=layout, index=index)
+        with h5py.File(fpath, 'r') as fin:
+            assert ('pixel_offsets' in fin['GeRM']) == index
+        handler = GeRMHandler(fpath)
+        for k, v in zip(DATA_TYPES, events):
+            assert np.array_equal(handler(k), v)
+            assert np.array_equal(handler(k, start=1990, stop=2010),
+                                  v[1990:2010])
+        pix = events[0] * 32 + events[1]
+        assert np.array_equal(handler.pixel_events(100), events[3][pix == 100])
+        handler.close()
+
+
+def test_streaming_writer():
+    events = [np.random.randint(0, 2**w, size=3000).astype('<u4')
+              for w in (4, 5, 9, 12, 29)]
+    payload = event2payload(*events)
+
+    for layout in ('columns', 'raw'):
+        fpath = tempfile.mktemp()
+        with StreamingH5Writer(fpath, layout=layout) as writer:
+            for s in range(0, 6000, 1000):
+                writer.append(EventBlock(payload[s:s + 1000]))
+        assert writer.ev_count == 3000
+        handler = GeRMHandler(fpath)
+        for k, v in zip(DATA_TYPES, events):
+            assert np.array_equal(handler(k), v)
+        handler.close()
@@ -0,0 +1,70 @@
+import numpy as np
+import zmq
+
+from pygerm.client import event2payload, N_CHANS, N_PIXELS
+from pygerm.live import LiveSpectrum, recv_spectrum
+
+
+def _events(n):
+    chip = np.arange(n) % 14
+    chan = np.arange(n) % 32
+    pd = (np.arange(n) * 7) % 2**12
+    return chip, chan, pd, event2payload(chip, chan, np.arange(n) % 2**9, pd,
+                                         np.arange(n))
+
+
+def test_live_spectrum_corrected():
+    chip, chan, pd, words = _events(5000)
+    corr = np.stack([np.linspace(0.01, 0.02, N_PIXELS),
+                     np.linspace(0, 5, N_PIXELS)])
+    live = LiveSpectrum(50, corr, backlog=1000)
+    for start in range(0, len(words), 998):
+        live.add(words[start:start + 998].astype('>u4'))
+
+    # chips 12 and 13 are not pixels
+    good = chip < 12
+    pixel = (chip * N_CHANS + chan)[good]
+    energy = pd[good] * corr[0, pixel] + corr[1, pixel]
+    expected, _, _ = np.histogram2d(energy, pixel,
+                                    bins=[live.bin_edges,
+                                          np.arange(N_PIXELS + 1)])
+    assert live.events == 5000
+    assert np.array_equal(live.spectrum, expected)
+
+    live.start(2)
+    assert live.events == 0
+    assert not live.spectrum.any()
+
+
+def test_live_spectrum_publish():
+    context = zmq.Context()
+    live = LiveSpectrum(16, url='tcp://127.0.0.1:*', interval=0,
+                        context=context)
+    sub = context.socket(zmq.SUB)
+    sub.setsockopt(zmq.SUBSCRIBE, b'spectrum')
+    sub.connect(live.sock.getsockopt(zmq.LAST_ENDPOINT))
+    try:
+        live.start(5)
+        live.add(_events(100)[-1])
+        # until the subscription has gone through
+        for _ in range(100):
+            live.poll()
+            if sub.poll(50):
+                break
+        header, edges, spectrum = recv_spectrum(sub)
+        assert header['frame'] == 5
+        assert header['events'] == 100
+        assert not header['final']
+        assert np.array_equal(edges, live.bin_edges)
+        assert np.array_equal(spectrum, live.spectrum)
+
+        while sub.poll(0):
+            sub.recv_multipart()
+        live.publish(final=True, lost_events=3)
+        header, _, _ = recv_spectrum(sub)
+        assert header['final'] and header['lost_events'] == 3
+        assert header['elapsed'] >= 0
+    finally:
+        sub.close(linger=0)
+        live.close()
+        context.destroy(linger=0)
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from pygerm.registry import FrameRegistrar, RegistrationJournal, chunk_datums
+
+
+class FlakyRegistry:
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.resources = {}
+        self.datums = {}
+        self.bulk_calls = 0
+
+    def insert_resource(self, spec, rpath, rkwargs, root=None, uid=None,
+                        ignore_duplicate_error=False):
+        if self.fail:
+            self.fail -= 1
+            raise IOError('registry is down')
+        self.resources[uid] = (spec, root, rpath, rkwargs)
+        return uid
+
+    def insert_datum(self, res, datum_id, kwargs,
+                     ignore_duplicate_error=False):
+        self.datums[datum_id] = (res, kwargs)
+
+    def bulk_insert_datum(self, res, datum_ids, datum_kwarg_list):
+        self.bulk_calls += 1
+        for datum_id, kwargs in zip(datum_ids, datum_kwarg_list):
+            self.insert_datum(res, datum_id, kwargs)
+
+
+def test_registrar_journal(tmpdir):
+    path = str(tmpdir.join('reg.journal'))
+    datums = [('a', {'column': 'chip'})] + chunk_datums('chip', 'a', 10, 4)
+    assert [d for d, _ in datums] == ['a', 'a/0', 'a/1', 'a/2']
+    assert datums[-1][1] == {'column': 'chip', 'start': 8, 'stop': 10}
+
+    fs = FlakyRegistry(fail=1)
+    reg = FrameRegistrar(fs, journal=RegistrationJournal(path))
+    fut = reg.submit('GeRM', 'f.h5', {}, datums)
+    assert fut.exception(1) is not None
+    assert reg.last_error
+    assert reg.outstanding == 1
+
+    # picked up by a new IOC from the journal
+    fs = FlakyRegistry()
+    reg = FrameRegistrar(fs, journal=RegistrationJournal(path))
+    reg._executor.shutdown()
+    assert len(fs.resources) == 1
+    assert set(fs.datums) == {'a', 'a/0', 'a/1', 'a/2'}
+    assert len(reg.journal) == 0
+
+    reg = FrameRegistrar(fs, journal=RegistrationJournal(path))
+    uid = reg.submit('GeRM', 'g.h5', {}, [('b', {'column': 'chan'})]).result(1)
+    assert fs.resources[uid] == ('GeRM', '/', 'g.h5', {})
+    assert fs.bulk_calls == 1
+    assert reg.last_error == ''
+    assert len(RegistrationJournal(path).pending()) == 0
+
+
+class BlockedRegistry(FlakyRegistry):
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+
+    def insert_resource(self, *args, **kwargs):
+        self.gate.wait(5)
+        return super().insert_resource(*args, **kwargs)
+
+
+def test_registrar_queue_full(tmpdir):
+    path = str(tmpdir.join('reg.journal'))
+    fs = BlockedRegistry()
+    reg = FrameRegistrar(fs, journal=RegistrationJournal(path), maxsize=1)
+    futs = [reg.submit('GeRM', '0.h5', {}, [('0', {})], block=False)]
+    # journaled once the worker takes it
+    deadline = time.monotonic() + 5
+    while not len(reg.journal) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    futs.append(reg.submit('GeRM', '1.h5', {}, [('1', {})], block=False))
+    # one on the worker, one queued
+    with pytest.raises(queue.Full):
+        reg.submit('GeRM', '2.h5', {}, [('2', {})], block=False)
+    # the refused one is never journaled
+    assert len(reg.journal) == 1
+    fs.gate.set()
+    for fut in futs:
+        fut.result(5)
+    reg._executor.shutdown()
+    # nothing is left for a restart to replay
+    assert len(fs.resources) == 2
+    assert len(RegistrationJournal(path).pending()) == 0
+
+
+class ThreadJournal(RegistrationJournal):
+    def __init__(self, path):
+        super().__init__(path)
+        self.threads = []
+
+    def append(self, entry):
+        self.threads.append(threading.current_thread())
+        super().append(entry)
+
+
+def test_registrar_journals_off_caller(tmpdir):
+    fs = FlakyRegistry()
+    journal = ThreadJournal(tmpdir.join('reg.journal'))
+    reg = FrameRegistrar(fs, journal=journal)
+    reg.submit('GeRM', 'f.h5', {}, [('a', {})], block=False).result(5)
+    # the caller (the IOC's event loop) does not wait on the fsync
+    assert journal.threads
+    assert threading.current_thread() not in journal.threads
+    assert len(journal) == 0
@@ -0,0 +1,43 @@
+import time
+
+import numpy as np
+import zmq
+
+from pygerm.client import event2payload
+from pygerm.client.sync_zmq import ZClientWriter
+
+
+def test_writer_session(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    context = zmq.Context()
+    pub = context.socket(zmq.PUB)
+    port = pub.bind_to_random_port('tcp://127.0.0.1')
+
+    class Writer(ZClientWriter):
+        ZMQ_DATA_PORT = str(port)
+
+    events = [np.arange(10) % 12, np.arange(10) % 32, np.arange(10),
+              np.arange(10) * 100, np.arange(10) * 7]
+    with Writer('tcp://127.0.0.1', prewarm=2) as zc:
+        assert zc._monitor is None
+        # anything published from here on is seen
+        pub.send_multipart([b'data', b'stale'])
+        pub.send_multipart([b'meta', np.array([1, 0], 'u4')])
+        assert zc.data_sock.poll(2000)
+        time.sleep(0.1)
+        assert zc.drain() == 2
+
+        for _ in range(3):
+            pub.send_multipart([b'data', event2payload(*events)])
+        pub.send_multipart([b'meta', np.array([2, 0], 'u4')])
+        totallen, bitrate, pd, td, addr = zc.get_data(0, fname='raw.bin')
+    assert zc.data_sock.closed
+    assert totallen == 3 * 2 * 10
+    assert zc.last_frame == 2
+    assert zc.stats['events'] == 30
+    assert np.array_equal(pd, np.tile(events[3], 3))
+    assert np.array_equal(td, np.tile(events[2], 3))
+    assert np.array_equal(addr, np.tile((events[1] << 5) + events[0], 3))
+    assert tmpdir.join('raw.bin').size() == 3 * 2 * 10 * 4
+    pub.close(linger=0)
+    context.term()
@@ -0,0 +1,41 @@
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+from pygerm.transfer import copy_file, CopyManager
+
+
+def test_copy_file():
+    d = tempfile.mkdtemp()
+    src = os.path.join(d, 'src.bin')
+    data = np.random.randint(0, 2**32, size=100000, dtype='u4').tobytes()
+    with open(src, 'wb') as fout:
+        fout.write(data)
+
+    dest = os.path.join(d, 'dest.bin')
+    nbytes, crc = copy_file(src, dest, block_size=4096 * 7)
+    assert nbytes == len(data)
+    assert crc == zlib.crc32(data)
+    with open(dest, 'rb') as fin:
+        assert fin.read() == data
+    assert not os.path.exists(dest + '.part')
+
+
+def test_copy_manager():
+    d = tempfile.mkdtemp()
+    src = os.path.join(d, 'src.bin')
+    with open(src, 'wb') as fout:
+        fout.write(b'germ' * 1000)
+
+    # one worker, so the failure is the last copy to finish
+    cm = CopyManager(max_workers=1, retries=1, retry_delay=0)
+    good = cm.submit(src, os.path.join(d, 'a', 'b', 'dest.bin'))
+    bad = cm.submit(os.path.join(d, 'missing.bin'),
+                    os.path.join(d, 'dest2.bin'))
+    cm.join(5)
+    assert good.result() == (4000, zlib.crc32(b'germ' * 1000))
+    assert bad.exception() is not None
+    assert 'missing.bin' in cm.last_error
+    assert cm.depth == 0
@@ -0,0 +1,28 @@
+import threading
+
+from pygerm.workers import BoundedExecutor
+
+
+def test_bounded_executor():
+    ex = BoundedExecutor(max_workers=1, maxsize=1)
+    gate = threading.Event()
+    first = ex.submit(gate.wait)
+    second = ex.submit(lambda x: x * 2, 21)
+    # one running and one waiting fills it
+    assert ex.depth == 2
+
+    blocked = threading.Thread(target=ex.submit, args=(int,))
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive()
+
+    gate.set()
+    assert first.result(1)
+    assert second.result(1) == 42
+    blocked.join(1)
+    # a call is out of the depth by the time its result is seen
+    for _ in range(100):
+        ex.submit(int).result(1)
+        assert ex.depth == 0
+    ex.shutdown()
+    assert ex.depth == 0
@@ -0,0 +1,176 @@
+from concurrent.futures import wait
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+
+from .workers import BoundedExecutor
+
+# bytes per copy_file_range / sendfile call
+COPY_BLOCK = 2**26
+
+
+def _kernel_copy(fin, fout, offset, count):
+    # copy count bytes at offset, keeping the data in the kernel
+    done = 0
+    while done < count:
+        pos = offset + done
+        try:
+            n = os.copy_file_range(fin, fout, count - done, pos, pos)
+        except (AttributeError, OSError):
+            # older kernels / pythons, or a filesystem pair that does not
+            # support it
+            os.lseek(fout, pos, os.SEEK_SET)
+            n = os.sendfile(fout, fin, pos, count - done)
+        if n == 0:
+            raise IOError(f"source ended after {pos} bytes")
+        done += n
+
+
+def _crc32(fd, size):
+    if not size:
+        return 0
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            return zlib.crc32(view)
+
+
+def copy_file(src, dest, *, checksum=True, block_size=COPY_BLOCK):
+    '''Copy a file using kernel-side copies
+
+    The data goes through ``os.copy_file_range`` (or ``os.sendfile``)
+    so it is never copied through a user space buffer; the checksum
+    reads the source pages through a mapping.  The copy is written to
+    ``dest + '.part'`` and renamed into place once complete, so readers
+    never see a partial file.
+
+    Parameters
+    ----------
+    src, dest : str
+        The file to copy and where to put it
+
+    checksum : bool, optional
+        Compute the CRC32 of each block from the (mapped) source as it
+        is copied and check the finished copy against it
+
+    block_size : int, optional
+        Bytes per kernel copy call
+
+    Returns
+    -------
+    nbytes : int
+
+    crc : int or None
+    '''
+    src, dest = str(src), str(dest)
+    part = dest + '.part'
+    with open(src, 'rb') as fin, open(part, 'wb') as fout:
+        size = os.fstat(fin.fileno()).st_size
+        crc = 0 if checksum else None
+        if checksum and size:
+            mm = mmap.mmap(fin.fileno(), size, access=mmap.ACCESS_READ)
+            view = memoryview(mm)
+        try:
+            for offset in range(0, size, block_size):
+                count = min(block_size, size - offset)
+                _kernel_copy(fin.fileno(), fout.fileno(), offset, count)
+                if checksum:
+                    crc = zlib.crc32(view[offset:offset + count], crc)
+        finally:
+            if checksum and size:
+                view.release()
+                mm.close()
+    if checksum:
+        with open(part, 'rb') as fin:
+            if _crc32(fin.fileno(), size) != crc:
+                raise IOError(f"checksum mismatch copying {src} to {dest}")
+    shutil.copymode(src, part)
+    os.replace(part, dest)
+    return size, crc
+
+
+class CopyManager:
+    '''Copy files in the background with a bounded queue and retries
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Copies to run at once
+
+    maxsize : int, optional
+        Copies that may wait, `submit` blocks (or raises `queue.Full`)
+        once this many are queued
+
+    retries : int, optional
+        Attempts after the first before giving up on a file
+
+    retry_delay : float, optional
+        Seconds before the first retry, doubling for each one after
+
+    checksum : bool, optional
+        See `copy_file`
+    '''
+    def __init__(self, *, max_workers=2, maxsize=8, retries=3,
+                 retry_delay=1, checksum=True):
+        self._executor = BoundedExecutor(max_workers=max_workers,
+                                         maxsize=maxsize, name='germ-copy')
+        self._lock = threading.Lock()
+        self._futures = set()
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.checksum = checksum
+        # the last error message, '' once a copy succeeds again
+        self.last_error = ''
+        # bytes / second of the last copy
+        self.throughput = 0
+        self.bytes_copied = 0
+
+    @property
+    def depth(self):
+        '''The number of copies queued or running'''
+        return self._executor.depth
+
+    def submit(self, src, dest, *, block=True):
+        '''Queue a copy
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            The result is ``(nbytes, crc)``
+        '''
+        fut = self._executor.submit(self._copy, src, dest, block=block)
+        with self._lock:
+            self._futures.add(fut)
+        fut.add_done_callback(self._discard)
+        return fut
+
+    def join(self, timeout=None):
+        '''Wait for every copy submitted so far to finish'''
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout=timeout)
+
+    def _discard(self, fut):
+        with self._lock:
+            self._futures.discard(fut)
+
+    def _copy(self, src, dest):
+        os.makedirs(os.path.dirname(str(dest)), exist_ok=True)
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                nbytes, crc = copy_file(src, dest, checksum=self.checksum)
+            except Exception as e:
+                self.last_error = f'{src}: {e}'
+                print(f'copy of {src} failed (attempt {attempt + 1}): {e}')
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2**attempt)
+            else:
+                self.throughput = nbytes / max(time.monotonic() - start,
+                                               1e-9)
+                self.bytes_copied += nbytes
+                self.last_error = ''
+                return nbytes, crc
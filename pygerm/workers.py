@@ -0,0 +1,94 @@
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+
+class BoundedExecutor:
+    '''Run calls on dedicated worker threads with a bounded queue
+
+    This is used to keep slow, blocking work (file writes, copies,
+    registry inserts) off of the event loop while putting a limit on
+    how much can pile up behind it.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        The number of worker threads
+
+    maxsize : int, optional
+        The number of calls that may wait for a worker, `submit` blocks
+        when the queue is full
+
+    name : str, optional
+        The prefix for the thread names
+    '''
+    def __init__(self, max_workers=1, maxsize=4, name='germ-worker'):
+        self._queue = queue.Queue(maxsize)
+        self._pending = 0
+        self._lock = threading.Lock()
+        # seconds the last call spent running
+        self.last_runtime = 0
+        self._threads = [threading.Thread(target=self._work,
+                                          name=f'{name}-{n}', daemon=True)
+                         for n in range(max_workers)]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def depth(self):
+        '''The number of calls queued or running'''
+        return self._pending
+
+    def submit(self, func, *args, block=True, **kwargs):
+        '''Queue ``func(*args, **kwargs)``, blocking while the queue is full
+
+        If `block` is False `queue.Full` is raised instead of waiting.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        '''
+        fut = Future()
+        with self._lock:
+            self._pending += 1
+        try:
+            self._queue.put((fut, func, args, kwargs), block=block)
+        except queue.Full:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return fut
+
+    def shutdown(self, wait=True):
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fut, func, args, kwargs = item
+            if not fut.set_running_or_notify_cancel():
+                with self._lock:
+                    self._pending -= 1
+                continue
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+            else:
+                error = None
+            self.last_runtime = time.monotonic() - start
+            # out of `depth` before anyone waiting on the future wakes
+            with self._lock:
+                self._pending -= 1
+            if error is None:
+                fut.set_result(result)
+            else:
+                fut.set_exception(error)
@@ -0,0 +1,128 @@
+import h5py
+
+from .client import DATA_TYPES, EventBlock, pixel_index
+
+# events per HDF5 chunk of the raw layout
+RAW_CHUNK = 2**16
+
+
+def write_h5_frame(fname, bunches, ev_count, *, layout='columns',
+                   index=False):
+    '''Write the bunches of a frame to a new HDF5 file
+
+    Parameters
+    ----------
+    fname : str
+        The file to create, must not exist
+
+    bunches : list of EventBlock
+        The data as read from the detector
+
+    ev_count : int
+        The total number of events in `bunches`
+
+    layout : {'columns', 'raw'}, optional
+        'columns' writes one dataset per entry in `DATA_TYPES`, 'raw'
+        writes the packed word pairs as a single (N, 2) dataset which
+        `GeRMHandler` decodes on read.
+
+    index : bool, optional
+        Also write the pixel index (see `client.pixel_index`) so readers
+        can go straight to a pixel.  Without it `GeRMHandler` builds the
+        index on first use.
+    '''
+    with h5py.File(str(fname), 'w-') as fout:
+        g = fout.create_group('GeRM')
+        g.attrs['layout'] = layout
+        if layout == 'raw':
+            dset = g.create_dataset(
+                'raw', shape=(ev_count, 2), dtype='<u4',
+                chunks=(min(RAW_CHUNK, max(ev_count, 1)), 2))
+            offset = 0
+            for payload in bunches:
+                for seg in payload.segments:
+                    dset[offset:offset+len(seg)] = seg
+                    offset += len(seg)
+        elif layout == 'columns':
+            dsets = {k: g.create_dataset(k, shape=(ev_count,),
+                                         dtype=f'uint{w}')
+                     for k, w in DATA_TYPES.items()}
+            offset = 0
+            for payload in bunches:
+                bunch_len = len(payload)
+                for k in DATA_TYPES:
+                    dsets[k][offset:offset+bunch_len] = payload[k]
+                offset += bunch_len
+        else:
+            raise ValueError(f"unknown layout {layout!r}")
+
+        if not index:
+            return
+        # the chip / chan the 'columns' layout decoded are reused
+        block = EventBlock.concatenate(bunches)
+        order, offsets = pixel_index(block['chip'], block['chan'])
+        g.create_dataset('pixel_order', data=order)
+        g.create_dataset('pixel_offsets', data=offsets)
+
+
+class StreamingH5Writer:
+    '''Append bunches to a new HDF5 frame file as they arrive
+
+    The datasets are chunked and extended on every `append` so only
+    the bunch being written has to be held in memory.  The file uses
+    the same layouts as `write_h5_frame`, but no pixel index is
+    written; `GeRMHandler` builds one on first use.
+
+    Parameters
+    ----------
+    fname : str
+        The file to create, must not exist
+
+    layout : {'columns', 'raw'}, optional
+        See `write_h5_frame`
+    '''
+    def __init__(self, fname, *, layout='columns'):
+        if layout not in ('columns', 'raw'):
+            raise ValueError(f"unknown layout {layout!r}")
+        self.fname = fname
+        self.layout = layout
+        self.ev_count = 0
+        self._file = h5py.File(str(fname), 'w-')
+        g = self._file.create_group('GeRM')
+        g.attrs['layout'] = layout
+        if layout == 'raw':
+            self._dsets = {'raw': g.create_dataset(
+                'raw', shape=(0, 2), maxshape=(None, 2), dtype='<u4',
+                chunks=(RAW_CHUNK, 2))}
+        else:
+            self._dsets = {k: g.create_dataset(
+                k, shape=(0,), maxshape=(None,), dtype=f'uint{w}',
+                chunks=(RAW_CHUNK,))
+                for k, w in DATA_TYPES.items()}
+
+    def append(self, payload):
+        '''Write an `EventBlock` to the end of the frame'''
+        start = self.ev_count
+        stop = start + len(payload)
+        for dset in self._dsets.values():
+            dset.resize(stop, axis=0)
+        if self.layout == 'raw':
+            offset = start
+            for seg in payload.segments:
+                self._dsets['raw'][offset:offset+len(seg)] = seg
+                offset += len(seg)
+        else:
+            for k, dset in self._dsets.items():
+                dset[start:stop] = payload[k]
+        self.ev_count = stop
+        # keep what is on disk readable if the IOC goes down mid-frame
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
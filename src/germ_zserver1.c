@@ -14,6 +14,10 @@
 #define CMD_REG_READ  0
 #define CMD_REG_WRITE 1
 #define CMD_START_DMA 2
+#define CMD_DELAY     3
+
+// most commands in one multipart sequence
+#define MAX_SEQ 256
 
 #define FIFODATAREG 24
 #define FIFORDCNTREG 25
@@ -387,6 +391,9 @@ int main (int argc, char *argv[] )
 {
     pthread_t evt_thread_pid, evtrate_thread_pid;
     int cmdbuf[3];
+    int seqbuf[MAX_SEQ][3];
+    int nseq, more;
+    size_t more_size;
     int nbytes;
     void *context = zmq_ctx_new();
     void *responder = zmq_socket(context, ZMQ_REP);
@@ -440,37 +447,64 @@ int main (int argc, char *argv[] )
     pthread_create(&evtrate_thread_pid, NULL, event_rate, NULL);
 
     while (1) {
-        if ((nbytes = zmq_recv(responder, cmdbuf, sizeof(int)*3, 0)) < 0) {
-            break;
+        /* a request is one or more 12 byte commands, one per message
+         * part.  They are run in order and answered with a single
+         * reply holding the (possibly updated) commands back to back.
+         * A request of more than MAX_SEQ commands is refused before
+         * any of it is run, with the one reply 0xdead 0xdead N */
+        nseq = 0;
+        do {
+            if ((nbytes = zmq_recv(responder, cmdbuf, sizeof(int)*3, 0)) < 0) {
+                return 0;
+            }
+            more_size = sizeof(more);
+            zmq_getsockopt(responder, ZMQ_RCVMORE, &more, &more_size);
+            printf("recv: %i bytes, %x %x %x\n", nbytes, cmdbuf[0], cmdbuf[1], cmdbuf[2]);
+            if (nseq < MAX_SEQ)
+                memcpy(seqbuf[nseq], cmdbuf, sizeof(cmdbuf));
+            nseq++;
+        } while (more);
+
+        if (nseq > MAX_SEQ) {
+            printf("refusing a sequence of %i commands\n", nseq);
+            cmdbuf[0] = 0xdead;
+            cmdbuf[1] = 0xdead;
+            cmdbuf[2] = nseq;
+            zmq_send(responder, cmdbuf, sizeof(cmdbuf), 0);
+            continue;
         }
-        printf("recv: %i bytes, %x %x %x\n", nbytes, cmdbuf[0], cmdbuf[1], cmdbuf[2]);
-        cmd = cmdbuf[0];
-        addr = cmdbuf[1];
-        value = cmdbuf[2];
-
-        switch (cmd) {
-            case CMD_REG_READ:
-                // do read register
-                value = read_reg(addr);
-                cmdbuf[2] = value;
-		zmq_send(responder, cmdbuf, sizeof(cmdbuf), 0);
-                break;
-
-            case CMD_REG_WRITE:
-                // do write
-                write_reg(addr, value);
-                zmq_send(responder, cmdbuf, sizeof(cmdbuf), 0);
-                break;
-
-            default:
-                cmdbuf[0] = 0xdead;
-                cmdbuf[1] = 0xdead;
-                cmdbuf[2] = 0xdead;
-                zmq_send(responder, cmdbuf, sizeof(cmdbuf), 0);
-                break;
 
+        for (i = 0; i < nseq; i++) {
+            cmd = seqbuf[i][0];
+            addr = seqbuf[i][1];
+            value = seqbuf[i][2];
+
+            switch (cmd) {
+                case CMD_REG_READ:
+                    // do read register
+                    value = read_reg(addr);
+                    seqbuf[i][2] = value;
+                    break;
+
+                case CMD_REG_WRITE:
+                    // do write
+                    write_reg(addr, value);
+                    break;
+
+                case CMD_DELAY:
+                    // pause within a sequence, value in us
+                    usleep(value);
+                    break;
+
+                default:
+                    seqbuf[i][0] = 0xdead;
+                    seqbuf[i][1] = 0xdead;
+                    seqbuf[i][2] = 0xdead;
+                    break;
+            }
         }
 
+        zmq_send(responder, seqbuf, nseq * sizeof(cmdbuf), 0);
     }
     return 0;
 }